@@ -10,7 +10,7 @@ from matplotlib.backends.backend_agg import FigureCanvasAgg
 matplotlib.rcParams['font.size'] = 16.0
 import lmfit
 
-from kid_readout.analysis import kid_eqns
+from kid_readout.analysis.physics import kid_eqns
 
 default_settings = dict(fractional_f_0_err_limit = 1e-6,
                         fractional_Q_err_limit = 0.06,
@@ -25,7 +25,7 @@ all_settings = dict()
 all_settings.update(default_settings)
 all_settings.update(settings)
 
-from kid_readout.analysis import kid_eqns
+from kid_readout.analysis.physics import kid_eqns
 reload(kid_eqns)
 import itertools
 def plot_mattis_bardeen(data,axs=None,min_fit_temp=0,error_factor=100.0):
@@ -124,6 +124,33 @@ def plot_mattis_bardeen(data,axs=None,min_fit_temp=0,error_factor=100.0):
     fig.legend(ax1.lines,[x.get_label() for x in ax1.lines],loc='upper right',prop=dict(size='xx-small'))
 #    ax2.legend(loc='lower left',prop=dict(size='xx-small'),bbox_to_anchor=ax5.get_position())
     
+def fit_all_resonators(data,min_fit_temp=0,error_factor=100.0):
+    """
+    Fit the fractional frequency shift and Qi of every resonator in data at once with DarkKIDModelFractionalArray,
+    using the same errors as plot_mattis_bardeen. Return the fitted model and the resonator indices in model order.
+    """
+    data = data[data.sweep_primary_package_temperature > min_fit_temp]
+    indices = np.unique(data.resonator_index)
+    groups = [data[data.resonator_index == index] for index in indices]
+    num_temps = max(len(group) for group in groups)
+    T,f0,Qi,f0_err,Qi_err = [np.nan*np.ones((len(groups),num_temps)) for k in range(5)]
+    for row,group in enumerate(groups):
+        n = len(group)
+        T[row,:n] = group.sweep_primary_package_temperature
+        f0[row,:n] = group.fractional_delta_f_0
+        Qi[row,:n] = group.Q_i
+        qerr = np.array(group.Q_err)
+        qerr[qerr <= 0] = np.median(qerr)
+        Qi_err[row,:n] = qerr/error_factor
+        ferr = np.array(group.f_0_err/group.f_0)
+        ferr[ferr <= 0] = np.median(ferr)
+        f0_err[row,:n] = ferr
+    km = kid_eqns.DarkKIDModelFractionalArray(len(groups))
+    converged = km.fit(T,f0,Qi,f0_err=f0_err,Qi_err=Qi_err)
+    if not np.all(converged):
+        print "fit did not converge for resonators", indices[~converged]
+    return km,indices
+
 def apply_limits(data,limits_dict):
     for name,limits in limits_dict.items():
         if name in data.columns:
@@ -11,7 +11,7 @@ from kid_readout.analysis.noise_measurement import load_noise_pkl
 import glob
 import time
 import kid_readout.analysis.timeseries.noise_fit
-from kid_readout.analysis import kid_response
+from kid_readout.analysis import kid_response, mcfit
 
 def build_simple_archives(pklglob,index_to_id=None):
     pklnames = glob.glob(pklglob)
@@ -135,27 +135,46 @@ def compute_reconstructed_power(df,calibration):
 
 
 
+def _response_fitter(x):
+    x['f_0_max'] = x.f_0.max()
+    x['frac_f0'] = 1-x.f_0/x.f_0_max
+    mask = (x.sweep_primary_load_temperature<5) & (x.zbd_power > 0)
+    return kid_readout.analysis.kid_response.MCMCKidResponseFitter(x[mask]['frac_f0'],x[mask]['zbd_power'],
+                                                                   errors = np.where(x[mask]['zbd_power']>1e-7,
+                                                                                     x[mask]['zbd_power']*1e-2,
+                                                                                     1e-8))
+
+
+def _add_response_fit(x, fit):
+    x['response_break_point']=fit.mcmc_params['break_point'].value
+    x['response_scale']=fit.mcmc_params['scale'].value
+    x['response_break_point_err']=fit.mcmc_params['break_point'].stderr
+    x['response_scale_err']=fit.mcmc_params['scale'].stderr
+    #x['watts_to_ppm'] = (2*pp[0]*x['noise_on_frac_f0']+pp[1])
+    x['reconstructed_power'] = fit.to_power(x['frac_f0'])
+    return x
+
+
 def build_response_fit_function(make_plots=False, mcmc_length=500, mcmc_burn_in=400):
     def fit_response_mcmc(x):
-        x['f_0_max'] = x.f_0.max()
-        x['frac_f0'] = 1-x.f_0/x.f_0_max
-        mask = (x.sweep_primary_load_temperature<5) & (x.zbd_power > 0)
-        fit = kid_readout.analysis.kid_response.MCMCKidResponseFitter(x[mask]['frac_f0'],x[mask]['zbd_power'],
-                                                                      errors = np.where(x[mask]['zbd_power']>1e-7,
-                                                                                        x[mask]['zbd_power']*1e-2,
-                                                                                        1e-8))
+        fit = _response_fitter(x)
         fit.run(burn_in=mcmc_burn_in,length=mcmc_length)
         if make_plots:
             blah = fit.triangle()
-        x['response_break_point']=fit.mcmc_params['break_point'].value
-        x['response_scale']=fit.mcmc_params['scale'].value
-        x['response_break_point_err']=fit.mcmc_params['break_point'].stderr
-        x['response_scale_err']=fit.mcmc_params['scale'].stderr
-        #x['watts_to_ppm'] = (2*pp[0]*x['noise_on_frac_f0']+pp[1])
-        x['reconstructed_power'] = fit.to_power(x['frac_f0'])
-        return x
+        return _add_response_fit(x, fit)
     return fit_response_mcmc
 
+
+def fit_responses_mcmc(df, mcmc_length=500, mcmc_burn_in=400, processes=None):
+    """
+    Fit the response of every resonator, like df.groupby('resonator_id').apply(build_response_fit_function()), but
+    with the independent MCMC chains run in parallel using the given number of processes (default: one per CPU).
+    """
+    groups = [x.copy() for rid, x in df.groupby('resonator_id')]
+    fits = [_response_fitter(x) for x in groups]
+    mcfit.run_parallel(fits, length=mcmc_length, burn_in=mcmc_burn_in, processes=processes)
+    return pd.concat([_add_response_fit(x, fit) for x, fit in zip(groups, fits)], ignore_index=True)
+
 def normalize_f0(x):
     x['f_0_max'] = x[x.sweep_primary_package_temperature < 0.3]['f_0'].max()
     x['frac_f0'] = (x['f_0_max'] - x['f_0']) / x['f_0_max']
@@ -1,3 +1,7 @@
+import logging
+import multiprocessing
+from collections import namedtuple
+
 import numpy as np
 from scipy.misc import logsumexp
 import emcee
@@ -6,6 +10,7 @@ import lmfit
 from kid_readout.analysis.fitter import Fitter
 from kid_readout.analysis.resonator.legacy_resonator import Resonator
 
+logger = logging.getLogger(__name__)
 
 parameter_list = ['f_0',
                  'A_mag',
@@ -27,6 +32,191 @@ def convert_to_lmfit_params(raw_params,base_params,raw_param_list=parameter_list
             lm_params.add(name,value=param.value)
     return lm_params
 
+# Stands in for an lmfit Parameter in model functions, which only use the value attribute.
+ParameterValue = namedtuple('ParameterValue', ['value'])
+
+
+class VectorizedPosterior(object):
+    """
+    The log-probability of a model with uniform priors and Gaussian errors, evaluated for many walkers at once.
+
+    Model functions have the form model(params, x) and read parameters as params[name].value. Most models are pure
+    NumPy, so they can be evaluated for all walkers in one call by giving each varying parameter a value of shape
+    (num_walkers, 1), which broadcasts against x to give a (num_walkers, num_points) result. If a model does not
+    broadcast this way it is evaluated once per walker instead.
+
+    The log-likelihood is the same as that of MCMCFitter.basic_loglikelihood: the sum over points of
+    -log(abs(error)) - abs((y - model) / error)**2 / 2, where the division is complex for complex data.
+
+    Instances can be pickled as long as the model is a module-level function, so chains can run in other processes.
+    """
+
+    def __init__(self, model, x_data, y_data, errors, parameter_names, parameter_mins, parameter_maxs,
+                 fixed_values=None, mask=None):
+        """
+        Parameters
+        ----------
+        model : callable
+            A function model(params, x) that returns the modeled values.
+        x_data, y_data : array-like
+            The data; y_data may be complex.
+        errors : array-like or None
+            The errors on y_data, with the same type; None means all errors are one.
+        parameter_names : list(str)
+            The names of the varying parameters, in the order of the walker positions.
+        parameter_mins, parameter_maxs : list(float)
+            The bounds of the uniform priors on the varying parameters.
+        fixed_values : dict
+            The values of any other parameters that the model uses.
+        mask : array-like(bool) or None
+            Only points where mask is True are used; the default is to use all points. The MCMC classes below do not
+            pass the mask of their Fitter, so that their posteriors match basic_logprob().
+        """
+        x_data = np.asarray(x_data)
+        y_data = np.asarray(y_data)
+        if mask is None:
+            mask = np.ones(y_data.shape, dtype=np.bool)
+        mask = np.asarray(mask)
+        self.model = model
+        self.x_data = x_data[mask]
+        self.y_data = np.ascontiguousarray(y_data[mask])
+        if errors is None:
+            self.errors = np.ones(self.y_data.shape, dtype=self.y_data.dtype)
+        else:
+            self.errors = np.ascontiguousarray(np.asarray(errors)[mask])
+        self.parameter_names = list(parameter_names)
+        self.parameter_mins = np.array(parameter_mins, dtype='float')
+        self.parameter_maxs = np.array(parameter_maxs, dtype='float')
+        if fixed_values is None:
+            fixed_values = {}
+        self.fixed_values = dict(fixed_values)
+        self.vectorized = True
+        self._log_normalization = -np.sum(np.log(np.abs(self.errors)))
+
+    def __call__(self, position):
+        """
+        Return the log-probability at a single position; this is the function given to emcee.
+        """
+        return self.logprob(np.atleast_2d(position))[0]
+
+    def parameters(self, positions):
+        """
+        Return a mapping like lmfit.Parameters in which each varying parameter has a value of shape
+        (num_walkers, 1) from the given (num_walkers, num_parameters) positions.
+        """
+        params = dict((name, ParameterValue(value)) for name, value in self.fixed_values.items())
+        for index, name in enumerate(self.parameter_names):
+            params[name] = ParameterValue(positions[:, index, None])
+        return params
+
+    def model_values(self, positions):
+        """
+        Return the model evaluated at each position, with shape (num_walkers, num_points).
+        """
+        expected_shape = (positions.shape[0],) + self.y_data.shape
+        if self.vectorized:
+            # A model that does not broadcast typically fails to convert an array to a scalar or to combine arrays.
+            try:
+                values = np.asarray(self.model(self.parameters(positions), self.x_data))
+            except (TypeError, ValueError, IndexError):
+                logger.info("Model %s does not broadcast over walkers; evaluating it once per walker",
+                            getattr(self.model, '__name__', self.model), exc_info=True)
+            else:
+                if values.shape == expected_shape:
+                    return values
+                logger.info("Model %s returned shape %s instead of %s; evaluating it once per walker",
+                            getattr(self.model, '__name__', self.model), values.shape, expected_shape)
+            self.vectorized = False
+        values = np.empty(expected_shape, dtype=self.y_data.dtype)
+        for walker, position in enumerate(positions):
+            params = dict((name, ParameterValue(value)) for name, value in self.fixed_values.items())
+            for name, value in zip(self.parameter_names, position):
+                params[name] = ParameterValue(value)
+            values[walker] = self.model(params, self.x_data)
+        return values
+
+    def logprob(self, positions):
+        """
+        Return the log-probability of each of the (num_walkers, num_parameters) positions; positions outside the prior
+        bounds have log-probability -inf and the model is not evaluated there.
+        """
+        positions = np.asarray(positions, dtype='float')
+        result = np.empty(positions.shape[0])
+        result.fill(-np.inf)
+        in_bounds = np.all((positions >= self.parameter_mins) & (positions <= self.parameter_maxs), axis=1)
+        if np.any(in_bounds):
+            model = np.ascontiguousarray(self.model_values(positions[in_bounds]), dtype=self.y_data.dtype)
+            residual = (self.y_data - model) / self.errors
+            result[in_bounds] = self._log_normalization - 0.5 * np.sum(np.abs(residual) ** 2, axis=1)
+        return result
+
+
+class WalkerMap(object):
+    """
+    Used as the pool of an emcee.EnsembleSampler so that each step evaluates the log-probability of all walkers in one
+    vectorized call instead of once per walker.
+    """
+
+    def __init__(self, posterior):
+        self.posterior = posterior
+
+    def map(self, function, positions):
+        return list(self.posterior.logprob(np.array(list(positions))))
+
+
+def sample(posterior, initial, length, seed=None):
+    """
+    Run an ensemble sampler with walkers starting at the (num_walkers, num_parameters) array initial.
+
+    Returns
+    -------
+    chain : numpy.ndarray
+        The walker positions, with shape (num_walkers, length, num_parameters).
+    lnprobability : numpy.ndarray
+        The log-probability of each position, with shape (num_walkers, length).
+    """
+    nwalkers, ndim = initial.shape
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, posterior, pool=WalkerMap(posterior))
+    if seed is not None:
+        sampler.random_state = np.random.RandomState(seed).get_state()
+    sampler.run_mcmc(initial, length)
+    return sampler.chain, sampler.lnprobability
+
+
+def _sample_job(args):
+    return sample(*args)
+
+
+def run_parallel(samplers, length=500, burn_in=100, nwalkers=32, processes=None):
+    """
+    Run the chains of several independent MCMC objects, for example one per resonator, in separate processes.
+
+    Parameters
+    ----------
+    samplers : list(GeneralMCMC or MCMCFitter)
+        The objects to run; each gets the same results as if its run() method had been called.
+    length, burn_in, nwalkers : int
+        As in run().
+    processes : int or None
+        The number of worker processes; the default is the number of CPUs. If 1, the chains run in this process.
+    """
+    jobs = []
+    for sampler in samplers:
+        sampler.setup_sampler(nwalkers=nwalkers)
+        jobs.append((sampler.posterior, sampler.initial, length, np.random.randint(2 ** 31)))
+    if processes == 1:
+        results = [_sample_job(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_sample_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    for sampler, (chain, lnprobability) in zip(samplers, results):
+        sampler.set_samples(chain, burn_in)
+
+
 class GeneralMCMC():
     def __init__(self, fitter):
         self.fitter = fitter
@@ -84,15 +274,22 @@ class GeneralMCMC():
         for dim in range(ndim):
             min,max = self.parameter_mins[dim], self.parameter_maxs[dim]
             self.initial[:,dim] = np.random.uniform(min,max,size=nwalkers)
-        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.basic_logprob,threads=4)
+        fixed_values = dict((name, self.fitter.result.params[name].value) for name in self.fixed_parameters)
+        self.posterior = VectorizedPosterior(self.fitter._model, self.fitter.x_data, self.fitter.y_data,
+                                             self.fitter.errors, self.parameter_list, self.parameter_mins,
+                                             self.parameter_maxs, fixed_values=fixed_values)
+        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.posterior,pool=WalkerMap(self.posterior))
 
     def run(self,length=500,burn_in=100,nwalkers=32):
         self.setup_sampler(nwalkers=nwalkers)
         self.sampler.run_mcmc(self.initial,length)
-        self.samples = self.sampler.chain[:,burn_in:,:].reshape((-1,self.ndim))
+        self.set_samples(self.sampler.chain,burn_in)
+
+    def set_samples(self,chain,burn_in):
+        self.samples = chain[:,burn_in:,:].reshape((-1,self.ndim))
         for dim,name in enumerate(self.parameter_list):
-            self.fitter.params[name].value = self.samples[:,dim].mean()
-            self.fitter.params[name].stderr = self.samples[:,dim].std()
+            self.fitter.result.params[name].value = self.samples[:,dim].mean()
+            self.fitter.result.params[name].stderr = self.samples[:,dim].std()
 
     def triangle(self,*args,**kwargs):
         import triangle
@@ -141,7 +338,10 @@ class MCMCFitter(Fitter):
     def run(self,length=500,burn_in=100,nwalkers=32):
         self.setup_sampler(nwalkers=nwalkers)
         self.sampler.run_mcmc(self.initial,length)
-        self.samples = self.sampler.chain[:,burn_in:,:].reshape((-1,self.ndim))
+        self.set_samples(self.sampler.chain,burn_in)
+
+    def set_samples(self,chain,burn_in):
+        self.samples = chain[:,burn_in:,:].reshape((-1,self.ndim))
         self.mcmc_params = self.result.params.copy()
         for dim in range(self.ndim):
             self.mcmc_params[self.mcmc_params.keys()[dim]].value = self.samples[:,dim].mean()
@@ -159,7 +359,16 @@ class MCMCFitter(Fitter):
         for dim in range(ndim):
             min,max = self.get_param_bounds_by_index(dim,error_factor=error_factor)
             self.initial[:,dim] = np.random.uniform(min,max,size=nwalkers)
-        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.basic_logprob)
+        self.setup_posterior(self.parameter_list[:ndim])
+        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.posterior,pool=WalkerMap(self.posterior))
+
+    def setup_posterior(self,parameter_names):
+        bounds = [self.get_param_bounds_by_index(index) for index in range(len(parameter_names))]
+        fixed_values = dict((name, param.value) for name, param in self.result.params.items()
+                            if name not in parameter_names)
+        self.posterior = VectorizedPosterior(self._model, self.x_data, self.y_data, self.errors, parameter_names,
+                                             [min for min, max in bounds], [max for min, max in bounds],
+                                             fixed_values=fixed_values)
 
 
 class MCMCResonator(Resonator,MCMCFitter):
@@ -177,7 +386,8 @@ class MCMCResonator(Resonator,MCMCFitter):
             vals[vals > max] = max
             vals[vals < min] = min
             self.initial[:,dim] = vals
-        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.basic_logprob)
+        self.setup_posterior(self.parameter_list[:ndim])
+        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.posterior,pool=WalkerMap(self.posterior))
 
     def basic_loglikelihood(self,params):
         model = self.model(params = convert_to_lmfit_params(params,self.result.params))
@@ -3,6 +3,8 @@ import scipy.special
 
 import lmfit
 
+from kid_readout.analysis.physics import mbtable
+
 h = 6.626e-34 # J/s
 hbar = 1.054571e-34 #J/s
 kB = 1.38065e-23 #J/K
@@ -328,6 +330,248 @@ class DarkKIDModelFractional(DarkKIDModel):
     
     
 
+class DarkKIDModelFractionalArray(object):
+    """
+    The DarkKIDModelFractional equations evaluated for many resonators at once.
+
+    Each parameter is an array with shape (num_resonators,). Temperature arrays have shape (num_resonators, num_T), or
+    (num_T,) if all resonators share the same temperatures, and may be padded with NaN where a resonator has fewer
+    points. All resonators are evaluated in one NumPy pass, and fit() fits all of them together instead of running
+    lmfit once per resonator.
+    """
+
+    parameter_names = ['nqp0', 'delta_0', 'F_TLS', 'Tc', 'delta_loss', 'alpha', 'foffset']
+    # These match the defaults, bounds, and varying parameters of DarkKIDModelFractional.
+    default_values = dict(nqp0=0, delta_0=0, F_TLS=1.0, Tc=1.46, delta_loss=0.0, alpha=.66, foffset=0)
+    default_mins = dict(nqp0=0, delta_0=0, F_TLS=-np.inf, Tc=1, delta_loss=0, alpha=0.1, foffset=-1e-4)
+    default_maxs = dict(nqp0=1e5, delta_0=.1, F_TLS=np.inf, Tc=2, delta_loss=1e-1, alpha=1, foffset=1e-4)
+    default_vary = dict(nqp0=False, delta_0=True, F_TLS=False, Tc=False, delta_loss=True, alpha=True, foffset=True)
+
+    def __init__(self, num_resonators, f0_nom=100e6, N0=1.72e10, **values):
+        """
+        Parameters
+        ----------
+        num_resonators : int
+            The number of resonators.
+        f0_nom : float or numpy.ndarray
+            The nominal resonance frequency of each resonator, in Hz.
+        N0 : float
+            The single-spin density of states.
+        values : float or numpy.ndarray
+            Initial values for any of the parameters in parameter_names; the others take the default values.
+        """
+        self.num_resonators = num_resonators
+        self.f0_nom = np.asarray(f0_nom, dtype='float')
+        self.N0 = N0
+        self.values = dict((name, np.array(np.broadcast_to(values.get(name, self.default_values[name]),
+                                                           (num_resonators,)), dtype='float'))
+                           for name in self.parameter_names)
+        self.stderr = dict((name, np.zeros(num_resonators)) for name in self.parameter_names)
+        self.mins = dict(self.default_mins)
+        self.maxs = dict(self.default_maxs)
+        self.vary = dict(self.default_vary)
+        self.chi_squared = None
+
+    def _value(self, name, values):
+        # Parameters have shape (num_resonators, 1) so that they broadcast against temperature.
+        if values is None:
+            values = self.values
+        return np.asarray(values[name])[:, None]
+
+    def _f0_nom(self, values):
+        # The values may hold the frequencies of a subset of the resonators.
+        f0_nom = self.f0_nom if values is None else np.asarray(values.get('f0_nom', self.f0_nom))
+        if f0_nom.ndim:
+            return f0_nom[:, None]
+        return f0_nom
+
+    def Delta(self, values=None):
+        return 1.74 * kBeV * self._value('Tc', values)
+
+    def xi(self, T, values=None):
+        return (h*self._f0_nom(values))/(2*kB*T)
+
+    def nqp(self, T, values=None):
+        Delta = self.Delta(values)
+        return (2 * self.N0 * np.sqrt(2*np.pi*kBeV*T*Delta) * np.exp(-Delta/(kBeV*T)) +
+                self._value('nqp0', values))
+
+    def _s1s2(self, T, values):
+        # During a fit with fixed Tc these depend only on temperature, so fit() computes them once.
+        if values is not None and 's1' in values:
+            return values['s1'], values['s2']
+        return s1s2(T, self._value('Tc', values), self._f0_nom(values))
+
+    def _tls_factor(self, T, values):
+        if values is not None and 'tls_factor' in values:
+            return values['tls_factor']
+        xi = np.broadcast_to(self.xi(T, values), np.broadcast(T, self._f0_nom(values)).shape)
+        # The complex digamma function does not return for NaN arguments, so padding is skipped.
+        finite = np.isfinite(xi)
+        factor = np.nan * np.ones(xi.shape)
+        factor[finite] = np.real(scipy.special.psi(0.5+(xi[finite]/(1j*np.pi)))) - np.log(xi[finite]*2)
+        return factor
+
+    def f_res(self, T, values=None):
+        s1, s2 = self._s1s2(T, values)
+        return -(self._value('alpha', values) * s2 * self.nqp(T, values)) / (4 * self.N0 * self.Delta(values))
+
+    def Qi(self, T, values=None):
+        s1, s2 = self._s1s2(T, values)
+        return (2*self.N0*self.Delta(values))/(self._value('alpha', values)*s1*self.nqp(T, values))
+
+    def tls_shift(self, T, values=None):
+        return self._value('F_TLS', values)*self._value('delta_0', values)/np.pi * self._tls_factor(T, values)
+
+    def delta_tls(self, T, values=None):
+        return self._value('delta_0', values) * np.tanh(self.xi(T, values)) + self._value('delta_loss', values)
+
+    def total_Qi(self, T, values=None):
+        return 1/(1/self.Qi(T, values) + self._value('F_TLS', values)*self.delta_tls(T, values))
+
+    def total_fres(self, T, values=None):
+        return self.f_res(T, values) + self.tls_shift(T, values) + self._value('foffset', values)
+
+    def fit(self, T, f0=None, Qi=None, f0_err=None, Qi_err=None, max_iterations=200, ftol=1e-10):
+        """
+        Fit every resonator's fractional frequency shift, internal quality factor, or both, depending on which data
+        are given.
+
+        The resonators are fit jointly by a Levenberg-Marquardt iteration in which every resonator has its own damping
+        and convergence, so each iteration costs one batched model evaluation per varying parameter plus one, no matter
+        how many resonators there are. Parameters are kept within their bounds by clipping.
+
+        Parameters
+        ----------
+        T : numpy.ndarray
+            The temperatures, with shape (num_resonators, num_T) or (num_T,); NaN values are ignored.
+        f0, Qi : numpy.ndarray or None
+            The fractional frequency shifts and internal quality factors, with the same shape as T.
+        f0_err, Qi_err : numpy.ndarray or None
+            The corresponding errors; if None, the residuals are not weighted, as in KIDModel.
+        max_iterations : int
+            The maximum number of iterations.
+        ftol : float
+            A resonator has converged when an accepted step reduces its chi-squared by less than this fraction.
+
+        Returns
+        -------
+        numpy.ndarray(bool)
+            True for each resonator whose fit converged. A fit fails, and stops, if its damping grows past 1e10
+            because no step reduces its chi-squared, for example because the model is not finite. The fit values and
+            standard errors are stored in values and stderr, and the chi-squared values in chi_squared.
+        """
+        T = np.broadcast_to(np.asarray(T, dtype='float'), (self.num_resonators, np.shape(T)[-1]))
+        data = []
+        for y, err in ((f0, f0_err), (Qi, Qi_err)):
+            if y is not None:
+                y = np.broadcast_to(np.asarray(y, dtype='float'), T.shape)
+                err = np.ones(T.shape) if err is None else np.broadcast_to(np.asarray(err, dtype='float'), T.shape)
+                data.append((y, err))
+        if not data:
+            raise ValueError("At least one of f0 and Qi must be given.")
+        valid = np.isfinite(T)
+        for y, err in data:
+            valid &= np.isfinite(y) & np.isfinite(err)
+        safe_T = np.where(valid, T, 1)
+        names = [name for name in self.parameter_names if self.vary[name]]
+        lower = np.array([self.mins[name] for name in names])
+        upper = np.array([self.maxs[name] for name in names])
+        span = np.where(np.isfinite(upper - lower), upper - lower, 1)
+
+        f0_nom = np.broadcast_to(self.f0_nom, (self.num_resonators,))
+        temperature_terms = {'f0_nom': f0_nom}
+        if not self.vary['Tc']:
+            temperature_terms['s1'], temperature_terms['s2'] = self._s1s2(safe_T, None)
+            temperature_terms['tls_factor'] = self._tls_factor(safe_T, None)
+
+        def residual(x, indices):
+            values = dict((name, value[indices]) for name, value in self.values.items())
+            values.update(zip(names, x.T))
+            values.update((name, value[indices]) for name, value in temperature_terms.items())
+            models = []
+            if f0 is not None:
+                models.append(self.total_fres(safe_T[indices], values))
+            if Qi is not None:
+                models.append(self.total_Qi(safe_T[indices], values))
+            return np.concatenate([np.where(valid[indices], (y[indices] - model) / err[indices], 0)
+                                   for (y, err), model in zip(data, models)], axis=1)
+
+        def jacobian(x, r, indices):
+            step = 1e-7 * np.maximum(np.abs(x), 1e-3 * span)
+            step = np.where(x + step > upper, -step, step)
+            columns = []
+            for k in range(len(names)):
+                shifted = x.copy()
+                shifted[:, k] += step[:, k]
+                columns.append((residual(shifted, indices) - r) / step[:, k, None])
+            return np.stack(columns, axis=-1)
+
+        x = np.clip(np.vstack([self.values[name] for name in names]).T, lower, upper)
+        all_indices = np.arange(self.num_resonators)
+        r = residual(x, all_indices)
+        chi_squared = np.sum(r ** 2, axis=1)
+        damping = np.full(self.num_resonators, 1e-3)
+        converged = np.zeros(self.num_resonators, dtype=np.bool)
+        failed = np.zeros(self.num_resonators, dtype=np.bool)
+        identity = np.eye(len(names))
+        for iteration in range(max_iterations):
+            active = ~(converged | failed)
+            if not np.any(active):
+                break
+            indices = np.flatnonzero(active)
+            J = jacobian(x[active], r[active], indices)
+            A = np.einsum('nmi,nmj->nij', J, J)
+            g = np.einsum('nmi,nm->ni', J, r[active])
+            diagonal = np.maximum(np.einsum('nii->ni', A), 1e-30)
+            damped = A + damping[active, None, None] * diagonal[:, :, None] * identity
+            try:
+                delta = -np.linalg.solve(damped, g[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                # One singular matrix stops the whole batch, so solve them one at a time; a step that can't be solved
+                # is NaN, which is rejected and raises the damping of that resonator.
+                delta = np.full(g.shape, np.nan)
+                for k in range(g.shape[0]):
+                    try:
+                        delta[k] = -np.linalg.solve(damped[k], g[k])
+                    except np.linalg.LinAlgError:
+                        pass
+            trial_x = np.clip(x[active] + delta, lower, upper)
+            trial_r = residual(trial_x, indices)
+            trial_chi_squared = np.sum(trial_r ** 2, axis=1)
+            accepted = trial_chi_squared <= chi_squared[active]
+            done = accepted & (chi_squared[active] - trial_chi_squared <= ftol * chi_squared[active])
+            stalled = ~done & (damping[active] > 1e10)
+            x[indices[accepted]] = trial_x[accepted]
+            r[indices[accepted]] = trial_r[accepted]
+            chi_squared[indices[accepted]] = trial_chi_squared[accepted]
+            damping[indices] = np.where(accepted, damping[indices] / 10, damping[indices] * 10)
+            converged[indices[done]] = True
+            failed[indices[stalled]] = True
+        # As lmfit does, scale each resonator's covariance by its reduced chi-squared.
+        J = jacobian(x, r, all_indices)
+        A = np.einsum('nmi,nmj->nij', J, J)
+        dof = np.maximum(len(data) * valid.sum(axis=1) - len(names), 1)
+        with np.errstate(invalid='ignore'):
+            try:
+                covariance_diagonal = np.einsum('nii->ni', np.linalg.inv(A))
+            except np.linalg.LinAlgError:
+                covariance_diagonal = np.full((A.shape[0], len(names)), np.nan)
+                for k in range(A.shape[0]):
+                    try:
+                        covariance_diagonal[k] = np.diag(np.linalg.pinv(A[k]))
+                    except np.linalg.LinAlgError:
+                        pass
+            stderr = np.sqrt(covariance_diagonal * (chi_squared / dof)[:, None])
+        self.values = dict(self.values)
+        self.stderr = dict((name, np.zeros(self.num_resonators)) for name in self.parameter_names)
+        for k, name in enumerate(names):
+            self.values[name] = x[:, k].copy()
+            self.stderr[name] = stderr[:, k]
+        self.chi_squared = chi_squared
+        return converged
+
+
 class DarkKIDModel2(KIDModel):
     def sigma1(self,T):
         xi = self.xi(T)
@@ -343,4 +587,18 @@ class DarkKIDModel2(KIDModel):
         return ((sigman*(np.pi*self.Delta*qC)/(h*self.f0_nom)) *
                 (1 - (self.nqp(T)/(2*self.N0*self.Delta))*(1+np.sqrt((2*self.Delta)/(np.pi*kBeV*T))*
                                                            np.exp(-xi)*scipy.special.i0(xi))))
-        
\ No newline at end of file
+        
+
+class MattisBardeenKIDModel(KIDModel):
+    """
+    A KIDModel that uses the full Mattis-Bardeen conductivities for thermal quasiparticles, from the precomputed
+    tables in mbtable, instead of the low-temperature approximations.
+    """
+
+    def sigma1(self,T):
+        sigman = self.params['sigman'].value
+        return sigman*mbtable.sigma1(self.Delta, kBeV*T, h*self.f0_nom/qC)
+
+    def sigma2(self,T):
+        sigman = self.params['sigman'].value
+        return sigman*mbtable.sigma2(self.Delta, kBeV*T, h*self.f0_nom/qC)
@@ -38,4 +38,20 @@ def mb_integrand_2(eps,delta,kbt,hf):
             (np.sqrt(delta**2-eps**2)*np.sqrt((eps+hf)**2-delta**2)))
 
 def _mb2(delta, kbt, hf):
-    return trapz2(mb_integrand_2, delta - hf, delta, 1e-10, 6000, args=(delta,kbt,hf))/hf
\ No newline at end of file
+    return trapz2(mb_integrand_2, delta - hf, delta, 1e-10, 6000, args=(delta,kbt,hf))/hf
+
+
+def sigma1(delta, kbt, hf):
+    """
+    Return sigma_1 / sigma_n from the Mattis-Bardeen integral, evaluated numerically for each element of the broadcast
+    inputs, which must all have the same units.
+    """
+    return np.vectorize(_mb1, otypes=[np.float])(delta, kbt, hf)
+
+
+def sigma2(delta, kbt, hf):
+    """
+    Return sigma_2 / sigma_n from the Mattis-Bardeen integral, evaluated numerically for each element of the broadcast
+    inputs, which must all have the same units.
+    """
+    return np.vectorize(_mb2, otypes=[np.float])(delta, kbt, hf)
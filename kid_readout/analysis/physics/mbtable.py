@@ -0,0 +1,150 @@
+"""
+Tabulated Mattis-Bardeen conductivities.
+
+The Mattis-Bardeen ratios sigma_1 / sigma_n and sigma_2 / sigma_n depend only on the reduced temperature kT / Delta and
+the reduced frequency hf / Delta, so one table serves every resonator and every gap. The table is computed once from the
+numerical integrals in mbint, saved in the cache directory, and interpolated with bicubic splines. Points outside the
+table are integrated numerically.
+
+To make the tables smooth, sigma_1 is interpolated as log(sigma_1) on a grid that is uniform in Delta / kT, where it is
+dominated by exp(-Delta / kT), and sigma_2 is interpolated as (hf / Delta) sigma_2, which tends to pi at low temperature.
+"""
+from __future__ import division
+import os
+import hashlib
+import logging
+
+import numpy as np
+import scipy.interpolate
+
+from kid_readout.analysis.physics import mbint
+from kid_readout.settings import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# The default grid: Delta / kT from 1.6 to 50 (kT / Delta from 0.02 to 0.63) and hf / Delta from 1e-4 to 1.9.
+DEFAULT_DELTA_OVER_KBT = np.linspace(1.6, 50, 243)
+DEFAULT_HF_OVER_DELTA = np.logspace(-4, np.log10(1.9), 80)
+
+
+class MattisBardeenTable(object):
+    """
+    Interpolate sigma_1 / sigma_n and sigma_2 / sigma_n from a table of Mattis-Bardeen integrals.
+    """
+
+    def __init__(self, delta_over_kbt=DEFAULT_DELTA_OVER_KBT, hf_over_delta=DEFAULT_HF_OVER_DELTA,
+                 cache_dir=CACHE_DIR):
+        """
+        Parameters
+        ----------
+        delta_over_kbt : numpy.ndarray
+            The increasing grid of Delta / kT values.
+        hf_over_delta : numpy.ndarray
+            The increasing grid of hf / Delta values, all less than 2.
+        cache_dir : str or None
+            The directory in which the table is saved and from which it is loaded; if None, the table is always
+            computed and never saved.
+        """
+        self.delta_over_kbt = np.asarray(delta_over_kbt, dtype='float')
+        self.hf_over_delta = np.asarray(hf_over_delta, dtype='float')
+        if np.any(self.hf_over_delta >= 2):
+            raise ValueError("The hf / Delta grid must be below the pair-breaking threshold of 2.")
+        self.cache_dir = cache_dir
+        self.log_sigma1, self.scaled_sigma2 = self._load_or_compute()
+        log_hf = np.log(self.hf_over_delta)
+        self._log_sigma1_spline = scipy.interpolate.RectBivariateSpline(self.delta_over_kbt, log_hf, self.log_sigma1)
+        self._scaled_sigma2_spline = scipy.interpolate.RectBivariateSpline(self.delta_over_kbt, log_hf,
+                                                                           self.scaled_sigma2)
+
+    @property
+    def cache_filename(self):
+        """str: the name of the file containing this table, which depends on the grids."""
+        digest = hashlib.sha1(self.delta_over_kbt.tobytes() + self.hf_over_delta.tobytes()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'mattis_bardeen_{}.npz'.format(digest))
+
+    def _load_or_compute(self):
+        if self.cache_dir is not None and os.path.exists(self.cache_filename):
+            try:
+                with np.load(self.cache_filename) as npz:
+                    if (np.array_equal(npz['delta_over_kbt'], self.delta_over_kbt) and
+                            np.array_equal(npz['hf_over_delta'], self.hf_over_delta)):
+                        return npz['log_sigma1'], npz['scaled_sigma2']
+            except Exception as exception:
+                logger.warning("Could not load {}: {}".format(self.cache_filename, exception))
+        # The integration points depend only on the gap and frequency, so each column is integrated for all
+        # temperatures at once.
+        kbt = 1 / self.delta_over_kbt[:, None]
+        log_sigma1 = np.empty((self.delta_over_kbt.size, self.hf_over_delta.size))
+        scaled_sigma2 = np.empty_like(log_sigma1)
+        with np.errstate(over='ignore'):
+            for index, hf in enumerate(self.hf_over_delta):
+                log_sigma1[:, index] = np.log(mbint._mb1(1, kbt, hf))
+                scaled_sigma2[:, index] = hf * mbint._mb2(1, kbt, hf)
+        if self.cache_dir is not None:
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                np.savez(self.cache_filename, delta_over_kbt=self.delta_over_kbt, hf_over_delta=self.hf_over_delta,
+                         log_sigma1=log_sigma1, scaled_sigma2=scaled_sigma2)
+            except (IOError, OSError) as exception:
+                logger.warning("Could not save {}: {}".format(self.cache_filename, exception))
+        return log_sigma1, scaled_sigma2
+
+    def _evaluate(self, delta, kbt, hf, interpolate, integrate):
+        delta_over_kbt, hf_over_delta = np.broadcast_arrays(np.asarray(delta / kbt, dtype='float'),
+                                                            np.asarray(hf / delta, dtype='float'))
+        result = np.empty(delta_over_kbt.shape)
+        with np.errstate(invalid='ignore'):
+            inside = ((self.delta_over_kbt[0] <= delta_over_kbt) & (delta_over_kbt <= self.delta_over_kbt[-1]) &
+                      (self.hf_over_delta[0] <= hf_over_delta) & (hf_over_delta <= self.hf_over_delta[-1]))
+        result[inside] = interpolate(delta_over_kbt[inside], hf_over_delta[inside])
+        # Non-finite inputs, such as NaN padding, give NaN instead of being integrated.
+        outside = ~inside & np.isfinite(delta_over_kbt) & np.isfinite(hf_over_delta)
+        result[~inside & ~outside] = np.nan
+        if np.any(outside):
+            with np.errstate(over='ignore'):
+                result[outside] = integrate(1, 1 / delta_over_kbt[outside], hf_over_delta[outside])
+        if result.ndim == 0:
+            return result[()]
+        return result
+
+    def sigma1(self, delta, kbt, hf):
+        """
+        Return sigma_1 / sigma_n for the broadcast inputs, which must all have the same units.
+        """
+        return self._evaluate(delta, kbt, hf, lambda x, y: np.exp(self._log_sigma1_spline.ev(x, np.log(y))),
+                              mbint.sigma1)
+
+    def sigma2(self, delta, kbt, hf):
+        """
+        Return sigma_2 / sigma_n for the broadcast inputs, which must all have the same units.
+        """
+        return self._evaluate(delta, kbt, hf, lambda x, y: self._scaled_sigma2_spline.ev(x, np.log(y)) / y,
+                              mbint.sigma2)
+
+
+_default_table = None
+
+
+def default_table():
+    """
+    Return the table on the default grid, which is loaded or computed the first time this is called.
+    """
+    global _default_table
+    if _default_table is None:
+        _default_table = MattisBardeenTable()
+    return _default_table
+
+
+def sigma1(delta, kbt, hf):
+    """
+    Return sigma_1 / sigma_n from the default table; the broadcast inputs must all have the same units.
+    """
+    return default_table().sigma1(delta, kbt, hf)
+
+
+def sigma2(delta, kbt, hf):
+    """
+    Return sigma_2 / sigma_n from the default table; the broadcast inputs must all have the same units.
+    """
+    return default_table().sigma2(delta, kbt, hf)
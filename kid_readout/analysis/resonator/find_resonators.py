@@ -1,14 +1,19 @@
 __author__ = 'gjones'
 
 import numpy as np
+import scipy.signal
 from matplotlib import pyplot as plt
 import logging
+import multiprocessing
 
 from kid_readout.analysis import detect_peaks
 from kid_readout.analysis.resonator import lmfit_resonator
 
 logger = logging.getLogger(__name__)
 
+# Candidates whose reduced chi-squared exceeds this are refit as a pair of colliding resonators.
+COLLISION_REDCHI = 1000
+
 def find_resonators(frequency, s21, s21_error, frequency_span=1e6, detect_peaks_threshold=3, detect_peaks_kwargs=dict(),
                     make_plot=False,annotate=False):
     unique_mask = np.flatnonzero(np.diff(frequency)!=0)
@@ -18,29 +23,314 @@ def find_resonators(frequency, s21, s21_error, frequency_span=1e6, detect_peaks_
     mag_s21 = np.abs(s21)
     peak_indexes = detect_peaks.detect_peaks(-mag_s21,threshold=detect_peaks_threshold,**detect_peaks_kwargs)
     peak_indexes2 = detect_peaks.detect_peaks(-mag_s21[::2],threshold=detect_peaks_threshold,**detect_peaks_kwargs)
-    peak_indexes = np.sort(np.array(list(set(peak_indexes) | set(peak_indexes2*2))))
+    peak_indexes = np.union1d(peak_indexes, 2 * peak_indexes2)
     logger.debug("Found %d peaks",peak_indexes.shape[0])
     return fit_candidates(peak_indexes,frequency, s21, s21_error, frequency_span=frequency_span,
                     make_plot=make_plot,annotate=annotate)
 
 def fit_candidates(peak_indexes,frequency, s21, s21_error, frequency_span=1e6,
-                    make_plot=False,annotate=False):
-    resonators = []
-    for peak_index in peak_indexes:
-        peak_f = frequency[peak_index]
-        sub_mask = np.abs(peak_f-frequency) < frequency_span
-        res = lmfit_resonator.LinearResonatorWithCable(frequency[sub_mask], s21[sub_mask],s21_error[sub_mask])
-        if res.current_result.redchi > 1000:
-            res2 = lmfit_resonator.CollidingLinearResonatorsWithCable(frequency[sub_mask], s21[sub_mask],s21_error[sub_mask])
-            if res2.current_result.redchi < 1000:
-                logger.info("Found possible resonator collision at %.1f  %.1f" % (res2.bg_f_0,res2.fg_f_0))
-#
-#        else:
-        resonators.append(res)
+                    make_plot=False,annotate=False,processes=1):
+    """
+    Fit a LinearResonatorWithCable to the data within frequency_span of each candidate, and log possible collisions.
+
+    frequency_span may be a scalar or one value per candidate. If processes is not 1, the fits run in a pool of that
+    many worker processes (None means one per CPU). The resonator objects themselves cannot be pickled, so each worker
+    returns its best-fit parameters and the resonator is rebuilt here starting from them, which takes only a few
+    function evaluations.
+    """
+    jobs = [(frequency[mask], s21[mask], s21_error[mask])
+            for mask in _candidate_slices(peak_indexes, frequency, frequency_span)]
+    if processes == 1:
+        results = [_fit_candidate(job) for job in jobs]
+        resonators = [resonator for resonator, collision in results]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_fit_candidate_parameters, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        resonators = [lmfit_resonator.LinearResonatorWithCable(*job, **parameters)
+                      for job, (parameters, collision) in zip(jobs, results)]
+    for resonator, (_, collision) in zip(resonators, results):
+        if collision is not None:
+            logger.info("Found possible resonator collision at %.1f  %.1f" % collision)
     if make_plot:
-        plot_results(frequency,s21,resonators,peak_indexes,frequency_span,annotate=annotate)
+        plot_results(frequency,s21,resonators,peak_indexes,np.max(frequency_span),annotate=annotate)
     return resonators
 
+
+def _candidate_slices(peak_indexes, frequency, frequency_span):
+    frequency_span = np.broadcast_to(frequency_span, np.shape(peak_indexes))
+    peak_f = frequency[peak_indexes]
+    if np.all(np.diff(frequency) >= 0):
+        starts = np.searchsorted(frequency, peak_f - frequency_span, side='right')
+        stops = np.searchsorted(frequency, peak_f + frequency_span, side='left')
+        return [slice(start, stop) for start, stop in zip(starts, stops)]
+    return [np.abs(f - frequency) < span for f, span in zip(peak_f, frequency_span)]
+
+
+def _fit_candidate(job):
+    res = lmfit_resonator.LinearResonatorWithCable(*job)
+    collision = None
+    if res.current_result.redchi > COLLISION_REDCHI:
+        res2 = lmfit_resonator.CollidingLinearResonatorsWithCable(*job)
+        if res2.current_result.redchi < COLLISION_REDCHI:
+            collision = (res2.bg_f_0, res2.fg_f_0)
+    return res, collision
+
+
+def _fit_candidate_parameters(job):
+    res, collision = _fit_candidate(job)
+    return dict(res.current_params), collision
+
+
+def find_resonators_fast(frequency, s21, s21_error, Q_range=(5e3, 2e5), num_widths=6, threshold=6,
+                         background_width=None, minimum_separation=None, span_linewidths=10, processes=1,
+                         make_plot=False, annotate=False):
+    """
+    Find and fit the resonators in a wide scan, such as the data from a Scan.
+
+    This is designed for scans with many resonators over a few GHz. The steps are:
+    - divide out a fast estimate of the off-resonance transmission (see fast_background);
+    - detect dips with a bank of matched filters, one per linewidth, each run at a resolution matched to its
+    linewidth (see detect_candidates);
+    - merge candidates closer than minimum_separation in one sorted sweep, keeping the strongest (see unique_peaks);
+    - fit the remaining candidates, optionally in parallel (see fit_candidates).
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray
+        The frequencies of the scan, in Hz; the spacing should be roughly uniform.
+    s21, s21_error : numpy.ndarray(complex)
+        The scan data and its errors.
+    Q_range : tuple(float)
+        The range of loaded quality factors to search for; this sets the linewidths of the matched filters.
+    num_widths : int
+        The number of matched filters, spaced logarithmically in linewidth.
+    threshold : float
+        The minimum signal-to-noise ratio of a matched filter detection.
+    background_width : float or None
+        The width of the background estimation blocks, in Hz; the default is 20 times the widest linewidth.
+    minimum_separation : float or None
+        Candidates closer than this, in Hz, are considered duplicates; the default is the narrowest linewidth.
+    span_linewidths : float
+        Each candidate is fit using the data within this many of its best-matching linewidths.
+    processes : int or None
+        The number of worker processes used for fitting; the default fits serially, and None means one per CPU.
+    make_plot, annotate : bool
+        As in find_resonators().
+
+    Returns
+    -------
+    list(LinearResonatorWithCable)
+        One fit per candidate, in order of increasing frequency.
+    """
+    order = np.argsort(frequency, kind='mergesort')
+    frequency = frequency[order]
+    unique = np.concatenate(([True], np.diff(frequency) != 0))
+    frequency = frequency[unique]
+    s21 = s21[order][unique]
+    s21_error = s21_error[order][unique]
+    linewidths = np.median(frequency) / np.logspace(np.log10(Q_range[1]), np.log10(Q_range[0]), num_widths)
+    if background_width is None:
+        background_width = 20 * linewidths[-1]
+    if minimum_separation is None:
+        minimum_separation = linewidths[0]
+    depth = 1 - np.abs(s21) / fast_background(frequency, s21, background_width)
+    indices, snr, linewidth = detect_candidates(frequency, depth, linewidths, threshold=threshold)
+    keep = unique_peaks(frequency[indices], snr, minimum_separation)
+    indices = indices[keep]
+    logger.debug("Found %d candidates", indices.size)
+    return fit_candidates(indices, frequency, s21, s21_error, frequency_span=span_linewidths * linewidth[keep] / 2,
+                          make_plot=make_plot, annotate=annotate, processes=processes)
+
+
+def fast_background(frequency, s21, width, percentile=90):
+    """
+    Estimate the off-resonance magnitude of s21 in linear time.
+
+    The data are divided into blocks of the given width in frequency, and the given percentile of |s21| in each block,
+    which is insensitive to the resonance dips in it, is linearly interpolated between the block centers. The blocks
+    should be several times wider than the widest resonance.
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray
+        The increasing, roughly uniformly spaced frequencies.
+    s21 : numpy.ndarray
+        The data.
+    width : float
+        The block width, in the same units as frequency.
+    percentile : float
+        The percentile of |s21| in each block used as the background.
+
+    Returns
+    -------
+    numpy.ndarray
+        The background magnitude at each frequency.
+    """
+    magnitude = np.abs(s21)
+    block = min(max(int(round(width / np.median(np.diff(frequency)))), 1), magnitude.size)
+    num_blocks = -(-magnitude.size // block)
+    padded = np.nan * np.ones(num_blocks * block)
+    padded[:magnitude.size] = magnitude
+    level = np.nanpercentile(padded.reshape((num_blocks, block)), percentile, axis=1)
+    padded[:magnitude.size] = frequency
+    center = np.nanmean(padded.reshape((num_blocks, block)), axis=1)
+    return np.interp(frequency, center, level)
+
+
+def estimate_resonance(frequency, s21, num_iterations=3):
+    """
+    Estimate the resonance frequency and linewidth of one resonator from a few sweep points, without a nonlinear fit.
+
+    Near a linear resonator, s21 = A (1 - D / (1 + 2j (f - f_r) / w)) is a bilinear function of frequency,
+    s21 = (a f + b) / (c f + 1), so the complex coefficients follow from a linear least-squares fit to
+    s21 (c f + 1) = a f + b. The pole -1 / c lies at f_r + j w / 2. With more than three points the numerator gets a
+    quadratic term, which absorbs the cable delay over the span. The rows are reweighted by 1 / |c f + 1| from the
+    previous iteration so that the residuals approach errors in s21.
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray
+        The frequencies of at least three points.
+    s21 : numpy.ndarray(complex)
+        The data.
+    num_iterations : int
+        The number of reweighted fits.
+
+    Returns
+    -------
+    f_r, linewidth : float
+        The resonance frequency and full width at half maximum, in the units of frequency; both are nan if the data
+        do not determine a resonance.
+    """
+    frequency = np.asarray(frequency, dtype='float')
+    s21 = np.asarray(s21, dtype='complex')
+    if frequency.size < 3:
+        return np.nan, np.nan
+    # Work in units centered on the data and scaled to its span to keep the system well conditioned.
+    center = frequency.mean()
+    scale = np.ptp(frequency)
+    if scale == 0:
+        return np.nan, np.nan
+    x = (frequency - center) / scale
+    if frequency.size > 3:
+        design = np.column_stack((x ** 2, x, np.ones_like(x), -x * s21))
+    else:
+        design = np.column_stack((x, np.ones_like(x), -x * s21))
+    weight = np.ones_like(x)
+    try:
+        for iteration in range(num_iterations):
+            c = np.linalg.lstsq(design * weight[:, np.newaxis], s21 * weight, rcond=-1)[0][-1]
+            weight = 1 / np.maximum(np.abs(c * x + 1), 1e-12)
+    except np.linalg.LinAlgError:
+        return np.nan, np.nan
+    if c == 0:
+        return np.nan, np.nan
+    pole = -1 / c
+    f_r = center + scale * pole.real
+    linewidth = 2 * scale * pole.imag
+    if not (np.isfinite(f_r) and np.isfinite(linewidth) and linewidth > 0):
+        return np.nan, np.nan
+    return f_r, linewidth
+
+
+def lorentzian_kernel(linewidth_samples, half_width=4):
+    """
+    Return a zero-mean, unit-norm Lorentzian kernel with the given full width at half maximum, in samples, extending
+    half_width linewidths either side of the center. Because it has zero mean, a constant or slowly varying baseline
+    gives no response.
+    """
+    x = np.arange(-int(np.ceil(half_width * linewidth_samples)), int(np.ceil(half_width * linewidth_samples)) + 1)
+    kernel = 1 / (1 + (2 * x / linewidth_samples) ** 2)
+    kernel -= kernel.mean()
+    return kernel / np.sqrt(np.sum(kernel ** 2))
+
+
+def detect_candidates(frequency, depth, linewidths, threshold=6, samples_per_linewidth=4):
+    """
+    Detect resonance dips with a bank of Lorentzian matched filters.
+
+    For each linewidth, the data are first averaged down so that there are about samples_per_linewidth samples per
+    linewidth, so the wide filters cost no more than the narrow ones. Each filter output is divided by a robust
+    estimate of its noise, its local maxima above threshold are the detections, and each detection is located at the
+    deepest full-resolution sample within two coarse samples of the maximum. A dip is usually detected by several
+    filters; use unique_peaks() to merge them.
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray
+        The increasing, roughly uniformly spaced frequencies.
+    depth : numpy.ndarray
+        The fractional dip depth, for example 1 - |s21| / background, which is zero off resonance.
+    linewidths : iterable(float)
+        The linewidths of the filters, in the same units as frequency.
+    threshold : float
+        The minimum signal-to-noise ratio of a detection.
+    samples_per_linewidth : int
+        The resolution at which each filter is run.
+
+    Returns
+    -------
+    indices : numpy.ndarray(int)
+        The index of each detection.
+    snr : numpy.ndarray
+        The signal-to-noise ratio of each detection.
+    linewidth : numpy.ndarray
+        The linewidth of the filter that made each detection.
+    """
+    spacing = np.median(np.diff(frequency))
+    indices, snrs, widths = [], [], []
+    for linewidth in linewidths:
+        factor = max(int(linewidth / spacing / samples_per_linewidth), 1)
+        num_coarse = depth.size // factor
+        coarse = depth[:num_coarse * factor].reshape((num_coarse, factor)).mean(axis=1)
+        kernel = lorentzian_kernel(linewidth / (spacing * factor))
+        if kernel.size >= num_coarse:
+            continue
+        response = scipy.signal.fftconvolve(coarse, kernel, mode='same')
+        # Discard the edges, where the filter extends past the data.
+        edge = kernel.size // 2
+        valid = response[edge:num_coarse - edge]
+        noise = 1.4826 * np.median(np.abs(valid - np.median(valid)))
+        snr = valid / noise
+        maxima = np.flatnonzero((snr[1:-1] > snr[:-2]) & (snr[1:-1] >= snr[2:]) & (snr[1:-1] > threshold)) + 1
+        coarse_index = maxima + edge
+        window = ((coarse_index - 2) * factor)[:, None] + np.arange(5 * factor)
+        window = np.clip(window, 0, depth.size - 1)
+        indices.append(window[np.arange(window.shape[0]), np.argmax(depth[window], axis=1)])
+        snrs.append(snr[maxima])
+        widths.append(linewidth * np.ones(maxima.size))
+    if not indices:
+        return np.array([], dtype='int'), np.array([]), np.array([])
+    return np.concatenate(indices), np.concatenate(snrs), np.concatenate(widths)
+
+
+def unique_peaks(position, score, tolerance):
+    """
+    Merge peaks closer together than tolerance, keeping the one with the highest score in each group.
+
+    The positions are sorted once and split wherever the gap between neighbors is at least tolerance, so this takes
+    O(n log n) time. A chain of peaks that are each closer than tolerance to the next forms one group.
+
+    Returns
+    -------
+    numpy.ndarray(int)
+        The indices of the peaks that are kept, in order of increasing position.
+    """
+    position = np.asarray(position)
+    if position.size == 0:
+        return np.array([], dtype='int')
+    order = np.argsort(position, kind='mergesort')
+    group = np.concatenate(([0], np.cumsum(np.diff(position[order]) >= tolerance)))
+    # Sort by group and then by decreasing score; the first entry of each group is its best peak.
+    best = np.lexsort((-np.asarray(score)[order], group))
+    first = np.concatenate(([True], np.diff(group[best]) != 0))
+    return order[best[first]]
+
+
 def plot_results(frequency, s21, resonators, peak_indexes=[], frequency_span=250e3,annotate=True):
     plt.plot(frequency/1e6,20*np.log10(np.abs(s21)))
     for peak_index in peak_indexes:
@@ -65,23 +355,22 @@ def plot_results(frequency, s21, resonators, peak_indexes=[], frequency_span=250
             size=8,textcoords='offset points',xytext=(10,-10),color=color)
 
 def remove_duplicates(resonators,tolerance=50e3):
-    clean = []
-    f0s = []
-    for p in resonators:
-        f0 = p.f_0
-#        f0 = p['f_0'].value
-        if len(clean) == 0:
-            clean.append(p)
-            f0s.append(f0)
-            continue
-        distance = np.abs(f0-np.array(f0s))
-        if not np.any(distance < tolerance):
-            clean.append(p)
-            f0s.append(f0)
-        else:
-            print "found duplicate of ", f0, "distance", distance.min()
+    """
+    Return the resonators with duplicates removed, in their original order.
 
-    return clean
+    The resonators are taken in order of increasing f_0, and each one is kept only if its f_0 is at least tolerance
+    above that of the last one kept; of resonators with equal f_0, the earliest is kept. Unlike unique_peaks(), a chain
+    of closely spaced resonators is not merged into one: resonators at 0, 40 and 80 kHz with a tolerance of 50 kHz
+    keep the first and the last.
+    """
+    f0s = np.array([p.f_0 for p in resonators])
+    keep = []
+    for index in np.argsort(f0s, kind='mergesort'):
+        if not keep or f0s[index] - f0s[keep[-1]] >= tolerance:
+            keep.append(index)
+    if len(keep) < f0s.size:
+        logger.info("Removed %d duplicates", f0s.size - len(keep))
+    return [resonators[index] for index in sorted(keep)]
 
 def validate_resonator(res):
     print res.f_0,
@@ -0,0 +1,75 @@
+import numpy as np
+from kid_readout.analysis.resonator import find_resonators
+
+
+def make_scan(f_0, Q, Q_e, num_points=2 ** 16, noise=0.002):
+    np.random.seed(123)
+    frequency = np.linspace(1e9, 1.2e9, num_points)
+    s21 = np.ones(frequency.size, dtype='complex')
+    for f, q, q_e in zip(f_0, Q, Q_e):
+        s21 *= 1 - (q / q_e) / (1 + 2j * q * (frequency / f - 1))
+    s21 *= (1 + 0.1 * np.sin(frequency / 1e8)) * np.exp(-2j * np.pi * frequency * 30e-9)
+    s21 += noise * (np.random.randn(frequency.size) + 1j * np.random.randn(frequency.size))
+    return frequency, s21, noise * (1 + 1j) * np.ones(frequency.size)
+
+
+def test_unique_peaks():
+    position = np.array([5., 1., 1.5, 10., 5.2, 20.])
+    score = np.array([1., 2., 3., 1., 4., 0.])
+    assert np.all(find_resonators.unique_peaks(position, score, 1) == [2, 4, 3, 5])
+    assert find_resonators.unique_peaks([], [], 1).size == 0
+
+
+def test_remove_duplicates():
+
+    class Resonator(object):
+        def __init__(self, f_0):
+            self.f_0 = f_0
+
+    chain = [Resonator(f_0) for f_0 in [80e3, 0, 40e3, 0, 200e3]]
+    kept = find_resonators.remove_duplicates(chain, tolerance=50e3)
+    assert kept == [chain[0], chain[1], chain[4]]
+
+
+def test_detect_candidates():
+    f_0 = np.array([1.02e9, 1.05e9, 1.1e9, 1.101e9, 1.15e9])
+    Q = np.array([1e4, 3e4, 2e4, 5e4, 1e4])
+    frequency, s21, s21_error = make_scan(f_0, Q, 2 * Q)
+    linewidths = 1.1e9 / np.logspace(np.log10(1e5), np.log10(5e3), 5)
+    depth = 1 - np.abs(s21) / find_resonators.fast_background(frequency, s21, 20 * linewidths[-1])
+    indices, snr, linewidth = find_resonators.detect_candidates(frequency, depth, linewidths)
+    keep = find_resonators.unique_peaks(frequency[indices], snr, linewidths[0])
+    found = frequency[indices[keep]]
+    assert found.size == f_0.size
+    assert np.all(np.abs(found - f_0) < f_0 / Q)
+
+
+def test_find_resonators_fast():
+    f_0 = np.array([1.03e9, 1.12e9])
+    Q = np.array([2e4, 4e4])
+    frequency, s21, s21_error = make_scan(f_0, Q, 2 * Q, num_points=2 ** 15)
+    serial = find_resonators.find_resonators_fast(frequency, s21, s21_error, processes=1)
+    parallel = find_resonators.find_resonators_fast(frequency, s21, s21_error, processes=2)
+    assert len(serial) == len(parallel) == 2
+    for res, res_parallel, f, q in zip(serial, parallel, f_0, Q):
+        assert np.abs(res.f_0 - f) < 0.1 * f / q
+        assert np.abs(res.Q - q) < 0.1 * q
+        assert np.allclose(res.f_0, res_parallel.f_0, rtol=1e-9, atol=0)
+    assert len(find_resonators.remove_duplicates(serial + parallel)) == 2
+
+
+def test_estimate_resonance():
+    np.random.seed(123)
+    f_0 = 1e9
+    Q = 2e4
+    linewidth = f_0 / Q
+    for num_points, span_linewidths in [(6, 6), (8, 20), (16, 40)]:
+        offsets = np.linspace(-span_linewidths / 2, span_linewidths / 2, num_points)
+        frequency = f_0 + (0.1 + offsets) * linewidth
+        s21 = 1 - 0.6 * np.exp(0.3j) / (1 + 2j * Q * (frequency / f_0 - 1))
+        s21 *= 0.5 * np.exp(-2j * np.pi * frequency * 30e-9)
+        s21 += 0.002 * (np.random.randn(num_points) + 1j * np.random.randn(num_points))
+        f_r, estimated_linewidth = find_resonators.estimate_resonance(frequency, s21)
+        assert np.abs(f_r - f_0) < 0.1 * linewidth
+        assert np.abs(estimated_linewidth - linewidth) < 0.2 * linewidth
+    assert np.all(np.isnan(find_resonators.estimate_resonance(frequency[:2], s21[:2])))
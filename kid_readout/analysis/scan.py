@@ -0,0 +1,187 @@
+"""
+Combine the data from many sweeps that cover different, possibly overlapping, frequency ranges into one scan.
+"""
+from __future__ import division
+from collections import namedtuple
+
+import numpy as np
+
+from kid_readout.analysis.resonator import find_resonators
+
+Stitched = namedtuple('Stitched', field_names=['frequency', 's21', 's21_error', 'counts', 'background',
+                                               's21_foreground', 's21_error_foreground'])
+
+
+def stitch(frequencies, s21s, s21_errors=None, tolerance=None, background_width=None, percentile=90):
+    """
+    Merge any number of sweeps onto one global frequency grid and normalize the result by its smooth background.
+
+    All the points are sorted together, and points from any sweep that are closer than tolerance to their neighbor are
+    combined into one grid point by their inverse-variance weighted mean, so the sweeps may overlap by any amount and
+    need not share exact frequencies. The background is estimated with find_resonators.fast_background(), which takes
+    linear time and ignores resonance dips narrower than its blocks.
+
+    Parameters
+    ----------
+    frequencies : iterable(numpy.ndarray)
+        The frequencies of each sweep, in any order.
+    s21s : iterable(numpy.ndarray(complex))
+        The s21 values of each sweep.
+    s21_errors : iterable(numpy.ndarray(complex)) or None
+        The errors on the real and imaginary parts of each sweep. If any error is not positive and finite, all points
+        have equal weight; if None, the errors of the result are also NaN.
+    tolerance : float or None
+        Points closer together than this are merged; the default is one percent of the median point spacing within
+        the sweeps.
+    background_width : float or None
+        The block width used to estimate the background; the default is one tenth of the median sweep span.
+    percentile : float
+        The percentile of |s21| in each block that is taken as the background.
+
+    Returns
+    -------
+    Stitched
+        The merged frequency, s21, and s21_error arrays, the number of points merged into each, the background
+        magnitude, and s21 and s21_error divided by the background.
+    """
+    frequencies = [np.asarray(sweep_frequency, dtype='float') for sweep_frequency in frequencies]
+    frequency = np.concatenate(frequencies)
+    s21 = np.concatenate([np.asarray(s21) for s21 in s21s]).astype('complex')
+    if s21_errors is None:
+        s21_error = None
+    else:
+        s21_error = np.concatenate([np.asarray(error) for error in s21_errors]).astype('complex')
+    order = np.argsort(frequency, kind='mergesort')
+    frequency = frequency[order]
+    s21 = s21[order]
+    if tolerance is None:
+        # Use the spacing within the sweeps, since interleaved sweeps can be much closer to each other.
+        sweep_spacing = np.concatenate([np.diff(np.sort(sweep_frequency)) for sweep_frequency in frequencies])
+        sweep_spacing = sweep_spacing[sweep_spacing > 0]
+        tolerance = 0.01 * np.median(sweep_spacing) if sweep_spacing.size else 0
+    group = np.concatenate(([0], np.cumsum(np.diff(frequency) > tolerance)))
+    num_points = group[-1] + 1
+    counts = np.bincount(group, minlength=num_points)
+    if s21_error is None:
+        weight = np.ones(frequency.size)
+    else:
+        s21_error = s21_error[order]
+        variance = (s21_error.real ** 2 + s21_error.imag ** 2) / 2
+        if np.all(np.isfinite(variance) & (variance > 0)):
+            weight = 1 / variance
+        else:
+            weight = np.ones(frequency.size)
+    total_weight = np.bincount(group, weights=weight, minlength=num_points)
+    merged_frequency = np.bincount(group, weights=weight * frequency, minlength=num_points) / total_weight
+    merged_s21 = (np.bincount(group, weights=weight * s21.real, minlength=num_points) +
+                  1j * np.bincount(group, weights=weight * s21.imag, minlength=num_points)) / total_weight
+    if s21_error is None:
+        merged_error = np.nan * np.ones(num_points, dtype='complex')
+    else:
+        # The real and imaginary errors are combined separately, using the same weights as the mean.
+        real = np.sqrt(np.bincount(group, weights=(weight * s21_error.real) ** 2, minlength=num_points)) / total_weight
+        imag = np.sqrt(np.bincount(group, weights=(weight * s21_error.imag) ** 2, minlength=num_points)) / total_weight
+        merged_error = real + 1j * imag
+    if background_width is None:
+        background_width = 0.1 * np.median([sweep_frequency.ptp() for sweep_frequency in frequencies])
+    if num_points > 1 and background_width > 0:
+        background = find_resonators.fast_background(merged_frequency, merged_s21, background_width,
+                                                     percentile=percentile)
+    else:
+        background = np.abs(merged_s21)
+    return Stitched(frequency=merged_frequency, s21=merged_s21, s21_error=merged_error, counts=counts,
+                    background=background, s21_foreground=merged_s21 / background,
+                    s21_error_foreground=merged_error / background)
+
+
+class PolynomialBackground(object):
+    """
+    A smooth background of the form A(f) exp(i phi(f)), where the amplitude A and phase phi are polynomials in the
+    scaled frequency (f - center) / scale.
+
+    The coefficients are in np.polyval order, highest power first, along the last axis; any leading axes index
+    separate backgrounds, such as one per sweep, and indexing the object returns the background for those sweeps.
+    """
+
+    def __init__(self, amplitude_coefficients, phase_coefficients, center=0, scale=1):
+        self.amplitude_coefficients = np.asarray(amplitude_coefficients)
+        self.phase_coefficients = np.asarray(phase_coefficients)
+        self.center = center
+        self.scale = scale
+
+    def __getitem__(self, index):
+        return PolynomialBackground(self.amplitude_coefficients[index], self.phase_coefficients[index],
+                                    center=self.center, scale=self.scale)
+
+    def amplitude(self, frequency):
+        return _polyval(self.amplitude_coefficients, (np.asarray(frequency) - self.center) / self.scale)
+
+    def phase(self, frequency):
+        return _polyval(self.phase_coefficients, (np.asarray(frequency) - self.center) / self.scale)
+
+    def __call__(self, frequency):
+        """
+        Return the complex background at the given frequencies, which broadcast against the leading axes of the
+        coefficients with frequency as the last axis.
+        """
+        return self.amplitude(frequency) * np.exp(1j * self.phase(frequency))
+
+
+def _polyval(coefficients, x):
+    # Horner's method, with any leading axes of the coefficients broadcast against x.
+    result = np.zeros(np.broadcast(coefficients[..., 0, None], x).shape)
+    for coefficient in np.rollaxis(coefficients, -1):
+        result = result * x + np.asarray(coefficient)[..., None]
+    return result
+
+
+def fit_polynomial_background(frequency, s21, amp_degree=3, phi_degree=3, weights=None, mask=None):
+    """
+    Fit polynomials to the amplitude and unwrapped phase of one or many sweeps.
+
+    Each fit is the weighted least-squares fit that np.polyfit would give, but all the sweeps are fit together by
+    solving their normal equations in one batched call, so fitting every power step of a measurement costs about as
+    much as fitting one.
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray
+        The frequencies, with shape (num_points,) if shared by all sweeps or the same shape as s21.
+    s21 : numpy.ndarray(complex)
+        The data, with shape (num_points,) or (num_sweeps, num_points).
+    amp_degree, phi_degree : int
+        The degrees of the amplitude and phase polynomials.
+    weights : numpy.ndarray or None
+        The weights of the residuals, as in np.polyfit; the default is |s21|^2, which down-weights resonances.
+    mask : numpy.ndarray(bool) or None
+        If given, only points where this is True are used.
+
+    Returns
+    -------
+    PolynomialBackground
+        The fit background; it has the same leading axes as s21.
+    """
+    frequency = np.asarray(frequency, dtype='float')
+    s21 = np.asarray(s21)
+    if weights is None:
+        weights = np.abs(s21) ** 2
+    if mask is not None:
+        weights = weights * mask
+    center = (frequency.max() + frequency.min()) / 2
+    scale = max((frequency.max() - frequency.min()) / 2, np.finfo(float).tiny)
+    x = (frequency - center) / scale
+    weights_squared = np.broadcast_to(weights, s21.shape) ** 2
+    coefficients = []
+    for y, degree in ((np.abs(s21), amp_degree), (np.unwrap(np.angle(s21), axis=-1), phi_degree)):
+        vandermonde = x[..., None] ** np.arange(degree, -1, -1)
+        if x.ndim == 1:
+            # With shared frequencies, the normal equations of every sweep come from two matrix products.
+            outer = (vandermonde[:, :, None] * vandermonde[:, None, :]).reshape((x.size, -1))
+            normal = weights_squared.dot(outer).reshape(s21.shape[:-1] + (degree + 1, degree + 1))
+            projection = (weights_squared * y).dot(vandermonde)
+        else:
+            vandermonde = np.broadcast_to(vandermonde, s21.shape + (degree + 1,))
+            normal = np.einsum('...ni,...n,...nj->...ij', vandermonde, weights_squared, vandermonde)
+            projection = np.einsum('...ni,...n,...n->...i', vandermonde, weights_squared, y)
+        coefficients.append(np.linalg.solve(normal, projection[..., None])[..., 0])
+    return PolynomialBackground(coefficients[0], coefficients[1], center=center, scale=scale)
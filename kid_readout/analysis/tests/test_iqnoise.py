@@ -2,7 +2,8 @@ import numpy as np
 from matplotlib import mlab
 import warnings
 
-from kid_readout.analysis.timeseries.iqnoise import full_spectral_helper
+from kid_readout.analysis.timeseries.iqnoise import (full_spectral_helper, welch_auto_auto_cross, IncrementalWelch,
+                                                     calculate_pca_noise)
 
 __author__ = 'gjones'
 
@@ -18,4 +19,57 @@ def test_full_spectral_helper():
         fullPxx, fullPyy, fullPxy, freqs, t = full_spectral_helper(x, y, NFFT=2 ** 16, Fs=512e6 / 2 ** 14)
     assert (np.allclose(mlabPxx, fullPxx.mean(1)))
     assert (np.allclose(mlabPyy, fullPyy.mean(1)))
-    assert (np.allclose(mlabPxy, fullPxy.mean(1)))
\ No newline at end of file
+    assert (np.allclose(mlabPxy, fullPxy.mean(1)))
+
+
+def test_welch_auto_auto_cross():
+    x = np.random.randn(3, 2 ** 16)
+    y = np.random.randn(3, 2 ** 16) + x
+    f, S_xx, S_yy, S_xy = welch_auto_auto_cross(x, y, sample_rate=1e3, NFFT=2 ** 12, window=mlab.window_hanning,
+                                                detrend=mlab.detrend_mean)
+    for channel in range(x.shape[0]):
+        kwds = dict(NFFT=2 ** 12, Fs=1e3, window=mlab.window_hanning, detrend=mlab.detrend_mean, noverlap=2 ** 11)
+        mlabPxx, fr = mlab.psd(x[channel], **kwds)
+        mlabPyy, fr = mlab.psd(y[channel], **kwds)
+        mlabPxy, fr = mlab.csd(x[channel], y[channel], **kwds)
+        assert np.allclose(fr, f)
+        assert np.allclose(mlabPxx, S_xx[channel])
+        assert np.allclose(mlabPyy, S_yy[channel])
+        assert np.allclose(mlabPxy, S_xy[channel])
+
+
+def test_incremental_welch():
+    x = np.random.randn(2, 2 ** 16)
+    y = np.random.randn(2, 2 ** 16) + x
+    full = welch_auto_auto_cross(x, y, sample_rate=1e3, NFFT=2 ** 12, window=mlab.window_hanning)
+    incremental = IncrementalWelch(sample_rate=1e3, NFFT=2 ** 12, window=mlab.window_hanning)
+    boundaries = np.concatenate(([0], np.sort(np.random.randint(0, 2 ** 16, 20)), [2 ** 16]))
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        incremental.add(x[:, start:stop], y[:, start:stop])
+    assert incremental.num_segments == 2 ** 16 // 2 ** 11 - 1
+    f, S_xx, S_yy, S_xy = incremental.spectra()
+    assert np.allclose(full.f, f)
+    assert np.allclose(full.S_aa, S_xx)
+    assert np.allclose(full.S_bb, S_yy)
+    assert np.allclose(full.S_ab, S_xy)
+    assert incremental.variance.shape == (3,) + S_xx.shape
+    assert np.all(incremental.variance[:2, :, 1:-1] > 0)
+
+
+def test_calculate_pca_noise():
+    pii = np.random.rand(4, 100)
+    pqq = np.random.rand(4, 100)
+    piq = (np.random.rand(4, 100) - 0.5) * np.sqrt(pii * pqq) + 1j * np.random.rand(4, 100)
+    S, evals, evects, angles = calculate_pca_noise(pii, pqq, piq)
+    matrices = np.empty((4, 100, 2, 2))
+    matrices[..., 0, 0] = pii
+    matrices[..., 1, 1] = pqq
+    matrices[..., 0, 1] = matrices[..., 1, 0] = piq.real
+    w, v = np.linalg.eigh(matrices)
+    assert np.allclose(evals, np.rollaxis(w, -1))
+    for k in range(2):
+        # Eigenvectors are determined only up to sign, so compare the absolute value of the dot product.
+        assert np.allclose(np.abs(np.sum(v[..., k] * np.rollaxis(evects[:, k].real, 0, 3), axis=-1)), 1)
+        angle = np.mod(np.arctan2(v[..., 0, k], v[..., 1, k]), np.pi)
+        assert np.allclose(np.sin(angle - angles[k]), 0)
+    assert np.allclose(S.sum(axis=0), pii + pqq)
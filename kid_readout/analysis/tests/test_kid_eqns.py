@@ -0,0 +1,55 @@
+import numpy as np
+from kid_readout.analysis.physics import kid_eqns
+
+
+def test_array_model_matches_single_resonator_model():
+    T = np.linspace(0.1, 0.35, 20)
+    f0_nom = np.array([100e6, 150e6])
+    values = dict(delta_0=np.array([1e-5, 2e-6]), delta_loss=np.array([1e-6, 3e-6]), alpha=np.array([0.5, 0.7]),
+                  foffset=np.array([1e-7, -1e-7]))
+    array_model = kid_eqns.DarkKIDModelFractionalArray(2, f0_nom=f0_nom, **values)
+    fres = array_model.total_fres(T)
+    Qi = array_model.total_Qi(T)
+    assert fres.shape == Qi.shape == (2, T.size)
+    for index in range(2):
+        model = kid_eqns.DarkKIDModelFractional(f0_nom=f0_nom[index])
+        for name, value in values.items():
+            model.params[name].value = value[index]
+        assert np.allclose(fres[index], model.total_fres(T), rtol=1e-10, atol=0)
+        assert np.allclose(Qi[index], model.total_Qi(T), rtol=1e-10, atol=0)
+
+
+def test_array_fit_recovers_parameters():
+    np.random.seed(123)
+    num_resonators = 20
+    f0_nom = np.linspace(80e6, 160e6, num_resonators)
+    true = dict(delta_0=np.random.uniform(2e-6, 1e-5, num_resonators),
+                delta_loss=np.random.uniform(1e-6, 5e-6, num_resonators),
+                alpha=np.random.uniform(0.4, 0.8, num_resonators),
+                foffset=np.random.uniform(-1e-7, 1e-7, num_resonators))
+    T = np.tile(np.linspace(0.1, 0.35, 30), (num_resonators, 1))
+    T[::2, -5:] = np.nan  # Resonators with fewer points are padded.
+    truth = kid_eqns.DarkKIDModelFractionalArray(num_resonators, f0_nom=f0_nom, **true)
+    f0_err = 1e-8 * np.ones(T.shape)
+    Qi_err = 1e-3 * truth.total_Qi(np.where(np.isnan(T), 0.2, T))
+    f0 = truth.total_fres(T) + f0_err * np.random.randn(*T.shape)
+    Qi = truth.total_Qi(T) + Qi_err * np.random.randn(*T.shape)
+    model = kid_eqns.DarkKIDModelFractionalArray(num_resonators, f0_nom=f0_nom)
+    converged = model.fit(T, f0, Qi, f0_err=f0_err, Qi_err=Qi_err)
+    assert np.all(converged)
+    num_points = 2 * np.sum(np.isfinite(T), axis=1)
+    assert np.all(model.chi_squared < 2 * num_points)
+    for name, value in true.items():
+        assert np.all(np.abs(model.values[name] - value) < 5 * model.stderr[name])
+
+
+def test_array_fit_reports_failures():
+    T = np.linspace(0.1, 0.35, 30)
+    f0_nom = np.array([100e6, np.nan, 120e6])
+    truth = kid_eqns.DarkKIDModelFractionalArray(3, f0_nom=f0_nom, delta_0=5e-6, delta_loss=2e-6)
+    f0 = np.nan_to_num(truth.total_fres(T))
+    model = kid_eqns.DarkKIDModelFractionalArray(3, f0_nom=f0_nom)
+    # The model of the second resonator is NaN, so no step reduces its chi-squared.
+    with np.errstate(invalid='ignore'):
+        converged = model.fit(T, f0, f0_err=1e-8 * np.ones(f0.shape))
+    assert np.all(converged == [True, False, True])
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from kid_readout.analysis.physics import kid_eqns, mbint, mbtable
+
+
+def test_table_matches_integrals_and_caches():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        delta_over_kbt = np.linspace(2, 20, 37)
+        hf_over_delta = np.logspace(-3, -1, 9)
+        table = mbtable.MattisBardeenTable(delta_over_kbt, hf_over_delta, cache_dir=cache_dir)
+        assert os.path.exists(table.cache_filename)
+        cached = mbtable.MattisBardeenTable(delta_over_kbt, hf_over_delta, cache_dir=cache_dir)
+        assert np.all(cached.log_sigma1 == table.log_sigma1)
+        np.random.seed(123)
+        # Use a gap in other units to check that only the ratios matter.
+        delta = 2e-4
+        kbt = delta / np.random.uniform(2, 20, 10)
+        hf = delta * 10 ** np.random.uniform(-3, -1, 10)
+        assert np.allclose(table.sigma1(delta, kbt, hf), mbint.sigma1(delta, kbt, hf), rtol=1e-4)
+        assert np.allclose(table.sigma2(delta, kbt, hf), mbint.sigma2(delta, kbt, hf), rtol=1e-4)
+        # Points outside the grid are integrated.
+        assert table.sigma1(1, 0.5, 0.5) == mbint._mb1(1, 0.5, 0.5)
+        assert np.isscalar(table.sigma2(1, 0.1, 0.01))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_mattis_bardeen_kid_model():
+    model = kid_eqns.MattisBardeenKIDModel()
+    T = np.linspace(0.1, 0.3, 5)
+    Delta_over_kT = model.Delta / (kid_eqns.kBeV * T)
+    hf_over_Delta = kid_eqns.h * model.f0_nom / kid_eqns.qC / model.Delta
+    expected = model.params['sigman'].value * mbint.sigma2(1, 1 / Delta_over_kT, hf_over_Delta)
+    assert np.allclose(model.sigma2(T), expected, rtol=1e-4)
+    assert np.all(np.diff(model.Qi(T)) < 0)
@@ -0,0 +1,60 @@
+import numpy as np
+
+from kid_readout.analysis import fitter, kid_response, mcfit
+
+
+def scalar_line_model(params, x):
+    # A model that only works for scalar parameter values, to exercise the per-walker fallback.
+    return np.array([float(params['slope'].value) * xx + float(params['offset'].value) for xx in x])
+
+
+def make_response_fitter():
+    x = np.linspace(0.001, 0.01, 40)
+    y = kid_response.fractional_freq_to_power(x, 0.005, 1e-3) * (1 + 0.01 * np.random.randn(x.size))
+    return kid_response.MCMCKidResponseFitter(x, y, errors=y * 1e-2)
+
+
+def test_vectorized_posterior_matches_loglikelihood():
+    np.random.seed(123)
+    fit = make_response_fitter()
+    positions = fit.initial.copy()
+    positions[0, 0] = fit.posterior.parameter_maxs[0] + 1
+    logprob = fit.posterior.logprob(positions)
+    assert fit.posterior.vectorized
+    assert np.allclose(logprob, [fit.basic_logprob(position) for position in positions])
+    assert logprob[0] == -np.inf
+
+
+def test_vectorized_posterior_fallback():
+    np.random.seed(123)
+    x = np.linspace(-1, 1, 20)
+    y = (2 * x + 1) + 1j * (x - 1)
+    posterior = mcfit.VectorizedPosterior(fitter.line_model, x, y, None, ['slope', 'offset'], [-10, -10], [10, 10])
+    fallback = mcfit.VectorizedPosterior(scalar_line_model, x, y, None, ['slope', 'offset'], [-10, -10], [10, 10])
+    positions = np.random.uniform(-5, 5, size=(8, 2))
+    assert np.allclose(posterior.logprob(positions), fallback.logprob(positions))
+    assert posterior.vectorized and not fallback.vectorized
+    residual = y - (positions[0, 0] * x + positions[0, 1])
+    assert np.allclose(posterior(positions[0]), -0.5 * np.sum(np.abs(residual) ** 2))
+
+
+def test_vectorized_posterior_complex_errors():
+    # The residual is divided by the complex error, so errors of sigma * (1 + 1j) give abs(residual)**2 / (2 sigma**2).
+    np.random.seed(123)
+    x = np.linspace(-1, 1, 20)
+    y = (2 * x + 1) + 1j * (x - 1)
+    sigma = 0.1
+    posterior = mcfit.VectorizedPosterior(fitter.line_model, x, y, sigma * (1 + 1j) * np.ones(x.size),
+                                          ['slope', 'offset'], [-10, -10], [10, 10])
+    position = np.array([1.5, 0.5])
+    residual = y - (position[0] * x + position[1])
+    expected = -x.size * np.log(np.sqrt(2) * sigma) - np.sum(np.abs(residual) ** 2) / (4 * sigma ** 2)
+    assert np.allclose(posterior(position), expected)
+
+
+def test_run_parallel():
+    np.random.seed(123)
+    fits = [make_response_fitter() for k in range(2)]
+    mcfit.run_parallel(fits, length=200, burn_in=150, processes=2)
+    for fit in fits:
+        assert abs(fit.mcmc_params['scale'].value - 1e-3) < 5 * fit.mcmc_params['scale'].stderr
@@ -0,0 +1,55 @@
+import numpy as np
+from kid_readout.analysis import scan
+
+
+def test_stitch_irregular_overlaps():
+    np.random.seed(123)
+    background = lambda f: 2 + 0.5 * np.sin(f / 50.)
+    # Three sweeps with different spacings; the first two share some frequencies exactly and the last overlaps the
+    # second without sharing any.
+    frequencies = [np.arange(0, 100, 0.5), np.arange(80, 200, 0.5), np.arange(150.25, 300, 0.5)[::-1]]
+    s21s = [background(f) * np.exp(1j * f / 100.) for f in frequencies]
+    s21_errors = [0.01 * (1 + 1j) * np.ones(f.size) for f in frequencies]
+    s21_errors[1][:] *= 2
+    stitched = scan.stitch(frequencies, s21s, s21_errors, background_width=10)
+    assert np.all(np.diff(stitched.frequency) > 0)
+    expected_frequency = np.union1d(np.concatenate(frequencies[:2]), frequencies[2])
+    assert np.allclose(stitched.frequency, expected_frequency)
+    assert np.sum(stitched.counts == 2) == 40
+    assert np.sum(stitched.counts) == sum(f.size for f in frequencies)
+    assert np.allclose(stitched.s21, background(stitched.frequency) * np.exp(1j * stitched.frequency / 100.))
+    # Where the first two overlap, the weights are 4 and 1.
+    overlap = stitched.counts == 2
+    assert np.allclose(stitched.s21_error[overlap], (np.sqrt(16 + 4) / 5) * 0.01 * (1 + 1j))
+    assert np.allclose(stitched.s21_error[~overlap & (stitched.frequency < 80)], 0.01 * (1 + 1j))
+    assert np.allclose(np.abs(stitched.s21_foreground), 1, atol=0.05)
+
+
+def test_stitch_weighted_mean():
+    frequencies = [np.arange(10.), np.arange(10.) + 1e-9]
+    s21s = [np.ones(10, dtype='complex'), 2 * np.ones(10, dtype='complex')]
+    stitched = scan.stitch(frequencies, s21s, [np.ones(10) * (1 + 1j), np.ones(10) * (2 + 2j)])
+    assert stitched.frequency.size == 10
+    assert np.allclose(stitched.s21, (1 + 2 / 4.) / (1 + 1 / 4.))
+    stitched = scan.stitch(frequencies, s21s)
+    assert np.allclose(stitched.s21, 1.5)
+    assert np.all(np.isnan(stitched.s21_error))
+
+
+def test_fit_polynomial_background():
+    np.random.seed(123)
+    frequency = np.linspace(100e6, 200e6, 1000)
+    s21 = np.vstack([k * (1 + frequency / 1e9) * np.exp(-1j * frequency * 1e-7 * k) for k in range(1, 6)])
+    s21 += 0.01 * (np.random.randn(*s21.shape) + 1j * np.random.randn(*s21.shape))
+    background = scan.fit_polynomial_background(frequency, s21, amp_degree=2, phi_degree=3)
+    assert background(frequency).shape == s21.shape
+    per_sweep = scan.fit_polynomial_background(np.vstack([frequency] * 5), s21, amp_degree=2, phi_degree=3)
+    assert np.allclose(per_sweep(frequency), background(frequency))
+    for k in range(s21.shape[0]):
+        weights = np.abs(s21[k]) ** 2
+        expected = (np.polyval(np.polyfit(frequency, np.abs(s21[k]), 2, w=weights), frequency) *
+                    np.exp(1j * np.polyval(np.polyfit(frequency, np.unwrap(np.angle(s21[k])), 3, w=weights),
+                                           frequency)))
+        assert np.allclose(background[k](frequency), expected, rtol=1e-9, atol=0)
+        assert np.allclose(scan.fit_polynomial_background(frequency, s21[k], amp_degree=2)(frequency), expected,
+                           rtol=1e-9, atol=0)
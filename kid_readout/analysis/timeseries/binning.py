@@ -2,9 +2,15 @@
 This module contains functions for binning spectral densities.
 """
 from __future__ import division
+from collections import OrderedDict
 
 import numpy as np
 
+# The maximum number of LogBinPlans kept by log_bin_plan().
+PLAN_CACHE_SIZE = 32
+
+_plan_cache = OrderedDict()
+
 
 def log_bin_edges(frequency, bins_per_decade, ensure_none_empty):
     """
@@ -48,6 +54,92 @@ def log_bin_edges(frequency, bins_per_decade, ensure_none_empty):
         return log_bins
 
 
+class LogBinPlan(object):
+    """
+    This class holds everything needed to bin data on a given frequency grid, so that binning many arrays that share
+    the grid costs one np.add.reduceat call per array.
+
+    The bins are those used by log_bin(): each bin is a run of consecutive input frequencies, so an array is binned by
+    summing over runs that start at the indices in self.starts. The run that starts at self.starts[n] contains the
+    frequencies with np.digitize(frequency, self.edges) == self.bin_indices[n].
+    """
+
+    def __init__(self, frequency, bins_per_decade):
+        """
+        Parameters
+        ----------
+        frequency : ndarray(float)
+            The equally-spaced, non-negative, increasing frequencies corresponding to the data arrays.
+        bins_per_decade : int
+            The number of histogram bins per decade of frequency.
+        """
+        frequency = np.array(frequency)
+        if np.any(np.diff(frequency) < 0):
+            raise ValueError("Frequencies must be increasing.")
+        self.frequency = frequency
+        self.bins_per_decade = bins_per_decade
+        self.edges = log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
+        bin_indices = np.digitize(frequency, self.edges)
+        self.starts = np.concatenate(([0], np.flatnonzero(np.diff(bin_indices)) + 1))
+        self.counts = np.diff(np.append(self.starts, frequency.size))
+        self.bin_indices = bin_indices[self.starts]
+        self.mean_frequency = self.mean(frequency)
+        # Plans are shared through the cache, so protect the arrays that are handed to callers.
+        for array in (self.frequency, self.edges, self.starts, self.counts, self.bin_indices, self.mean_frequency):
+            array.flags.writeable = False
+
+    def matches(self, frequency, bins_per_decade):
+        return (bins_per_decade == self.bins_per_decade and frequency.shape == self.frequency.shape and
+                np.array_equal(frequency, self.frequency))
+
+    def _check_shape(self, data):
+        if np.shape(data)[-1] != self.frequency.size:
+            raise ValueError("The last axis of the data has {} points but there are {} frequencies.".format(
+                np.shape(data)[-1], self.frequency.size))
+
+    def mean(self, data):
+        """
+        Return the mean of the data in each bin, along the last axis.
+        """
+        self._check_shape(data)
+        return np.add.reduceat(data, self.starts, axis=-1) / self.counts
+
+    def variance_of_mean(self, variance):
+        """
+        Return the variance of the mean in each bin, along the last axis, assuming that the variance of the N samples
+        in a bin is the mean of their variances divided by N.
+        """
+        self._check_shape(variance)
+        return np.add.reduceat(variance, self.starts, axis=-1) / self.counts ** 2
+
+
+def log_bin_plan(frequency, bins_per_decade):
+    """
+    Return a LogBinPlan for the given frequencies, reusing a cached plan if one exists for the same frequency grid and
+    number of bins per decade.
+
+    Parameters
+    ----------
+    frequency : ndarray(float)
+        The equally-spaced, non-negative, increasing frequencies corresponding to the data arrays.
+    bins_per_decade : int
+        The number of histogram bins per decade of frequency.
+
+    Returns
+    -------
+    LogBinPlan
+    """
+    frequency = np.asarray(frequency)
+    key = (bins_per_decade, frequency.size, hash(frequency.tobytes()))
+    plan = _plan_cache.pop(key, None)
+    if plan is None or not plan.matches(frequency, bins_per_decade):
+        plan = LogBinPlan(frequency, bins_per_decade)
+    _plan_cache[key] = plan  # Most recently used plans are at the end.
+    while len(_plan_cache) > PLAN_CACHE_SIZE:
+        _plan_cache.popitem(last=False)
+    return plan
+
+
 def log_bin(frequency, bins_per_decade, *data):
     """
     Return the results of binning the given data arrays in frequency bins with widths that increase approximately
@@ -69,7 +161,8 @@ def log_bin(frequency, bins_per_decade, *data):
     bins_per_decade : int
         The number of histogram bins per decade of frequency.
     data : ndarrays
-        The data arrays.
+        The data arrays; the last axis corresponds to frequency, so a 2-D array with one row per channel is binned in
+        a single call.
 
     Returns
     -------
@@ -90,13 +183,8 @@ def log_bin(frequency, bins_per_decade, *data):
     Unpacking multiple data arrays:
     edges, counts, f_mean, [binned_data1, binned_data2] = log_bin(f, 10, data1, data2)
     """
-    edges = log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
-    bin_indices = np.digitize(frequency, edges)
-    indices_used = np.unique(bin_indices)
-    counts = np.array([np.sum([bin_indices == n]) for n in indices_used])
-    mean_frequency = np.array([np.mean(frequency[bin_indices == n]) for n in indices_used])
-    binned_data = [np.array([np.mean(d[bin_indices == n]) for n in indices_used]) for d in data]
-    return edges, counts, mean_frequency, binned_data
+    plan = log_bin_plan(frequency, bins_per_decade)
+    return plan.edges, plan.counts, plan.mean_frequency, [plan.mean(d) for d in data]
 
 
 def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance):
@@ -114,7 +202,8 @@ def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance):
     bins_per_decade : int
         The number of histogram bins per decade of frequency.
     data_and_variance : (ndarray, ndarray)
-        Tuples containing arrays of the data and corresponding variance.
+        Tuples containing arrays of the data and corresponding variance; as in log_bin(), the last axis corresponds to
+        frequency.
 
     Returns
     -------
@@ -135,16 +224,9 @@ def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance):
     Unpacking multiple pairs:
     edges, counts, f_mean, [(bd1, bv1), (bd2, bv2)] = log_bin_with_variance(f, 10, (d1, v1), (d2, v2))
     """
-    edges = log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
-    bin_indices = np.digitize(frequency, edges)
-    indices_used = np.unique(bin_indices)
-    counts = np.array([np.sum([bin_indices == n]) for n in indices_used])
-    mean_frequency = np.array([np.mean(frequency[bin_indices == n]) for n in indices_used])
-    binned_dv = []
-    for d, v in data_and_variance:
-        binned_dv.append((np.array([np.mean(d[bin_indices == n]) for n in indices_used]),
-                          np.array([np.mean(v[bin_indices == n]) / c for n, c in zip(indices_used, counts)])))
-    return edges, counts, mean_frequency, binned_dv
+    plan = log_bin_plan(frequency, bins_per_decade)
+    binned_dv = [(plan.mean(d), plan.variance_of_mean(v)) for d, v in data_and_variance]
+    return plan.edges, plan.counts, plan.mean_frequency, binned_dv
 
 
 # These are the left bin edges: they stop before the highest frequency.
@@ -192,15 +274,24 @@ def make_freq_bins(fr):
 
 
 def log_bin_old(freqs, data):
-    # Need to work out
-    freq_bins = make_freq_bins(freqs)
-    bin_idxs = np.digitize(freqs, freq_bins)
+    """
+    Legacy binning used by iqnoise.pca_noise: the bins are those of log_bin() except that the zero-frequency bin and the
+    highest-frequency bin are dropped. The data arrays may have a leading channel axis.
+    """
+    plan = log_bin_plan(freqs, bins_per_decade=30)
+    num_bins = plan.edges.size - 2  # Bin indices 1 through edges.size - 2 are kept.
+    used = (plan.bin_indices >= 1) & (plan.bin_indices <= num_bins)
+    positions = plan.bin_indices[used] - 1
+
+    def bin_(d):
+        # Bins that contain no frequencies are NaN.
+        binned = np.full(np.shape(d)[:-1] + (num_bins,), np.nan, dtype=np.result_type(d, np.float))
+        binned[..., positions] = plan.mean(d)[..., used]
+        return binned
+
     if type(data) is list:
-        binned_data = []
-        for dunit in data:
-            binned_data.append(np.array([dunit[bin_idxs == k].mean() for k in range(1, len(freq_bins))]))
+        binned_data = [bin_(dunit) for dunit in data]
     else:
-        binned_data = np.array([data[bin_idxs == k].mean() for k in
-                                range(1, len(freq_bins))])  # skip the zeroth bin since it has nothing in it
-    binned_freqs = np.array([freqs[bin_idxs == k].mean() for k in range(1, len(freq_bins))])
+        binned_data = bin_(data)
+    binned_freqs = bin_(freqs)
     return binned_freqs, binned_data
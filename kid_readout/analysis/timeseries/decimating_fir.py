@@ -93,4 +93,160 @@ class MultistageHalfBandDecimationFilter(object):
     def polyphase(self,data):
         for filter_ in self.filters:
             data = filter_.polyphase(data)
-        return data
\ No newline at end of file
+        return data
+
+
+class PolyphaseDecimator(object):
+    """
+    Filter and downsample time-ordered data with an FIR filter, computing only the retained outputs.
+
+    The filter is split into downsample_factor polyphase branches, each of which runs at the output rate, so the cost
+    per output sample is the number of taps. Output sample m is the full-rate filter output at input index
+    m * downsample_factor + downsample_factor - 1, which is the same as
+        scipy.signal.lfilter(coefficients, 1, data)[..., downsample_factor - 1::downsample_factor]
+    for the concatenation of all the data processed since the last reset. The filter state, including input samples
+    that do not yet fill a complete output period, is carried between calls, so data can be processed in chunks of any
+    length.
+
+    Time is the last axis, so a (channels, time) block is processed in one call.
+    """
+
+    def __init__(self, coefficients, downsample_factor):
+        """
+        Parameters
+        ----------
+        coefficients : numpy.ndarray
+            The FIR filter taps.
+        downsample_factor : int
+            The ratio of the input sample rate to the output sample rate.
+        """
+        self.coefficients = np.asarray(coefficients)
+        self.downsample_factor = int(downsample_factor)
+        self.num_taps = self.coefficients.size
+        num_branch_taps = -(-self.num_taps // self.downsample_factor)
+        padded = np.zeros(num_branch_taps * self.downsample_factor, dtype=self.coefficients.dtype)
+        padded[:self.num_taps] = self.coefficients
+        # Branch p filters the input samples at offset downsample_factor - 1 - p within each output period.
+        self.branches = [padded[p::self.downsample_factor] for p in range(self.downsample_factor)]
+        self.reset()
+
+    @property
+    def group_delay(self):
+        """float: the delay of the filter in input samples, for symmetric coefficients."""
+        return (self.num_taps - 1) / 2.
+
+    def reset(self):
+        """
+        Discard the filter state and any buffered input.
+        """
+        self._pending = None
+        self._zi = None
+
+    def process(self, data):
+        """
+        Filter and downsample the next chunk of data.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The next chunk of data, with time along the last axis. The leading axes must be the same for every chunk
+            processed between resets.
+
+        Returns
+        -------
+        numpy.ndarray
+            The output samples completed by this chunk; the last axis has length equal to the number of complete
+            output periods, which may be zero.
+        """
+        data = np.asarray(data)
+        if self._pending is not None:
+            data = np.concatenate((self._pending, data), axis=-1)
+        num_outputs = data.shape[-1] // self.downsample_factor
+        self._pending = data[..., num_outputs * self.downsample_factor:].copy()
+        dtype = np.result_type(data, self.coefficients)
+        if self._zi is None:
+            self._zi = [np.zeros(data.shape[:-1] + (branch.size - 1,), dtype=dtype) for branch in self.branches]
+        elif self._zi[0].dtype != dtype:
+            self._zi = [zi.astype(dtype) for zi in self._zi]
+        periods = data[..., :num_outputs * self.downsample_factor].reshape(
+            data.shape[:-1] + (num_outputs, self.downsample_factor))
+        result = np.zeros(data.shape[:-1] + (num_outputs,), dtype=dtype)
+        if not num_outputs:
+            return result
+        for p, branch in enumerate(self.branches):
+            branch_output, self._zi[p] = scipy.signal.lfilter(branch, 1, periods[..., self.downsample_factor - 1 - p],
+                                                              axis=-1, zi=self._zi[p])
+            result += branch_output
+        return result
+
+
+class MultistageDecimator(object):
+    """
+    Decimate time-ordered data through a chain of PolyphaseDecimator stages.
+
+    Decimating in several stages with small downsample factors needs far fewer taps in total than a single filter with
+    the same overall factor, and each stage runs at the output rate of the one before it. Like the individual stages,
+    this is stateful and processes (channels, time) blocks in one call.
+    """
+
+    def __init__(self, downsample_factors, num_taps=64, window='hamming', coeff_dtype=np.float64):
+        """
+        Parameters
+        ----------
+        downsample_factors : iterable(int)
+            The downsample factor of each stage, in order.
+        num_taps : int or iterable(int)
+            The number of taps of each stage's low-pass filter, either the same for all stages or one per stage.
+        window : str or tuple
+            The window used by scipy.signal.firwin to design the filters.
+        coeff_dtype : dtype
+            The data type of the filter coefficients; float32 halves the memory traffic for single-precision data.
+        """
+        downsample_factors = [int(factor) for factor in downsample_factors]
+        if np.isscalar(num_taps):
+            num_taps = [num_taps] * len(downsample_factors)
+        if len(num_taps) != len(downsample_factors):
+            raise ValueError("There must be one value of num_taps per stage.")
+        self.stages = [PolyphaseDecimator(scipy.signal.firwin(taps, 1. / factor, window=window).astype(coeff_dtype),
+                                          factor)
+                       for factor, taps in zip(downsample_factors, num_taps)]
+
+    @property
+    def downsample_factor(self):
+        """int: the overall ratio of the input sample rate to the output sample rate."""
+        return int(np.prod([stage.downsample_factor for stage in self.stages]))
+
+    @property
+    def group_delay(self):
+        """float: the overall delay of the filter chain in input samples, for symmetric coefficients."""
+        delay = 0.
+        rate = 1
+        for stage in self.stages:
+            delay += rate * stage.group_delay
+            rate *= stage.downsample_factor
+        return delay
+
+    def reset(self):
+        """
+        Discard the state of every stage.
+        """
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, data):
+        """
+        Filter and downsample the next chunk of data through every stage.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The next chunk of data, with time along the last axis.
+
+        Returns
+        -------
+        numpy.ndarray
+            The output samples completed by this chunk.
+        """
+        for stage in self.stages:
+            data = stage.process(data)
+        return data
@@ -3,11 +3,11 @@ import numpy as np
 from matplotlib import pyplot as plt
 from scipy.ndimage import filters
 import scipy.signal
-from kid_readout.analysis.timeseries.fftfilt import fftfilt
+from kid_readout.analysis.timeseries.fftfilt import fft_filter
 
 
 def lpf256(ts):
-    return fftfilt(scipy.signal.firwin(256,1/256.),ts)
+    return fft_filter(scipy.signal.firwin(256,1/256.)).filter(ts)
 
 
 def medmadmask(ts,thresh=8,axis=0):
@@ -19,7 +19,7 @@ def medmadmask(ts,thresh=8,axis=0):
 
 
 def deglitch_block(ts,thresh=5):
-    tsl = np.roll(np.abs(fftfilt(scipy.signal.firwin(16,1/16.),ts)),-8)
+    tsl = np.roll(np.abs(fft_filter(scipy.signal.firwin(16,1/16.)).filter(ts)),-8)
     mask = medmadmask(tsl,thresh=thresh)
     mask[:-50] = mask[:-50] | mask[50:]
     mask[50:] = mask[50:] | mask[:-50]
@@ -112,22 +112,93 @@ def deglitch_mask_mad(ts,thresh=5,mask_extend=50,window_length=2**8):
     full_mask[start*step:start*step+len(mask)] |= mask
     return full_mask
 
-def mask_glitches(ts_list,mask,window_length):
+def mask_glitches(ts_list, mask, window_length, method='random', in_place=False):
+    """
+    Replace the masked samples of every time series in ts_list.
+
+    All series are filled in one vectorized pass and share the same replacement plan, so a glitch is replaced by the
+    same good sample (or the same interpolation weights) in x, q, and s21. Time is the last axis. The mask may be 1-D,
+    in which case it applies to every channel of a multichannel series, or it may have the same shape as the series.
+
+    Parameters
+    ----------
+    ts_list : numpy.ndarray or list of numpy.ndarray
+        The time series to clean; all must have the same shape.
+    mask : numpy.ndarray(bool)
+        True for samples that should be replaced.
+    window_length : int
+        With method='random', replacement values are drawn from the good samples within about half this many samples
+        of each masked sample, using the same overlapping windows as deglitch_mask_mad.
+    method : str
+        'random' replaces each masked sample with a randomly chosen good sample from the same window; 'interpolate'
+        linearly interpolates between the nearest good samples on either side.
+    in_place : bool
+        If True, overwrite the given arrays instead of copying them first.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        The cleaned time series, in the same order as ts_list.
+
+    Raises
+    ------
+    ValueError
+        If a window (method='random') or a channel (method='interpolate') contains no good samples.
+    """
     if type(ts_list) is np.ndarray:
         ts_list = [ts_list]
-    step = window_length//2
-    nstep = ts_list[0].shape[0]//step
-    clean_ts = [ts.copy() for ts in ts_list]
-    for k in xrange(nstep):
-        start = k-1
-        if start < 0:
-            start = 0
-        local_mask = mask[start*step:(k+1)*step]
-        for clean in clean_ts:
-            chunk = clean[start*step:(k+1)*step]
-            nmask = local_mask.sum()
-            if nmask:
-                chunk[local_mask] = np.random.choice(chunk[~local_mask],nmask)
+    if in_place:
+        clean_ts = list(ts_list)
+    else:
+        clean_ts = [ts.copy() for ts in ts_list]
+    mask = np.asarray(mask, dtype='bool')
+    num_samples = mask.shape[-1]
+    bad = np.flatnonzero(mask)
+    if not bad.size:
+        return clean_ts
+    good = np.flatnonzero(~mask)
+    # Indices are into the flattened mask, so only good samples from the same channel (row) may be used.
+    row = bad // num_samples
+    if method == 'random':
+        step = max(window_length // 2, 1)
+        nstep = max(num_samples // step, 1)
+        # The windows [(k - 1) * step, (k + 1) * step) overlap by half; like the original loop over windows, each masked
+        # sample is filled from the last window that covers it. Samples past the last full step join the last window.
+        k = np.minimum(bad % num_samples // step + 1, nstep - 1)
+        window_start = row * num_samples + np.maximum(k - 1, 0) * step
+        window_stop = np.where(k == nstep - 1, (row + 1) * num_samples, row * num_samples + (k + 1) * step)
+        left = np.searchsorted(good, window_start, side='left')
+        num_good = np.searchsorted(good, window_stop, side='left') - left
+        if np.any(num_good == 0):
+            raise ValueError("A window contains no unmasked samples to draw from.")
+        source = good[left + (np.random.random(bad.size) * num_good).astype(int)]
+        weight = None
+    elif method == 'interpolate':
+        row_start = np.searchsorted(good, row * num_samples, side='left')
+        row_stop = np.searchsorted(good, (row + 1) * num_samples, side='left')
+        if np.any(row_stop == row_start):
+            raise ValueError("A channel contains no unmasked samples to interpolate from.")
+        after = np.searchsorted(good, bad, side='left')
+        has_before = after > row_start
+        has_after = after < row_stop
+        before_index = good[np.where(has_before, after - 1, after)]
+        after_index = good[np.where(has_after, after, after - 1)]
+        span = (after_index - before_index).astype(float)
+        span[span == 0] = 1
+        source = before_index
+        weight = (bad - before_index) / span
+        weight[~(has_before & has_after)] = 0
+    else:
+        raise ValueError("Unknown method: {}".format(method))
+    if mask.ndim == 1:
+        index = lambda flat: (Ellipsis, flat)
+    else:
+        index = lambda flat: np.unravel_index(flat, mask.shape)
+    for clean in clean_ts:
+        if weight is None:
+            clean[index(bad)] = clean[index(source)]
+        else:
+            clean[index(bad)] = (1 - weight) * clean[index(source)] + weight * clean[index(after_index)]
     return clean_ts
 
 def deglitch_new(ts,thresh=6,mask_extend=50,window_length=2**16):
@@ -9,6 +9,13 @@ Filter data with an FIR filter using the overlap-add method.
 from numpy import abs, min, log2, ceil, floor, argmin, \
      zeros, arange, shape, float, zeros_like, atleast_2d
 from numpy.fft import fft, ifft
+from collections import OrderedDict
+
+import numpy as np
+
+FILTER_CACHE_SIZE = 32
+
+_filter_cache = OrderedDict()
 
 def nextpow2(x):
     """Return the first integer N such that 2**N >= abs(x)"""
@@ -144,3 +151,154 @@ def fftfilt_nd(b, x, *n):
         y[i:k,:] = y[i:k,:] + yt[:k-i,:]            # and add
         i += L
     return y
+
+
+def optimal_fft_length(num_taps, max_fft_length=2**20):
+    """
+    Return the power-of-two FFT length that minimizes the cost per output sample of overlap-save filtering with a
+    filter of length num_taps. The cost of one block of length N is N*(1+log2(N)) and each block produces N-num_taps+1
+    output samples.
+    """
+    N = 2**arange(max(nextpow2(num_taps), 1), max(nextpow2(max_fft_length), nextpow2(num_taps)) + 1)
+    cost = N*(log2(N)+1)/(N-num_taps+1)
+    return int(N[argmin(cost)])
+
+
+class FFTFilter(object):
+    """
+    Filter data with an FIR filter using the overlap-save method, reusing the FFT length and filter spectrum.
+
+    The output is the same as scipy.signal.lfilter(coefficients, 1, data, axis=-1). Time is the last axis, and all the
+    leading axes (for example, channels) are filtered together in each batch of blocks. Real data filtered with real
+    coefficients uses real FFTs. The process() method carries the last num_taps-1 input samples between calls, so a
+    stream can be filtered in chunks of any length; filter() is stateless.
+    """
+
+    def __init__(self, coefficients, n_fft=None, max_block_size=2**22):
+        """
+        Parameters
+        ----------
+        coefficients : numpy.ndarray
+            The FIR filter taps.
+        n_fft : int
+            The FFT length, rounded up to a power of two that is at least the filter length; the default minimizes the
+            cost per output sample.
+        max_block_size : int
+            The approximate maximum number of FFT points transformed at once, which limits the memory used.
+        """
+        self.coefficients = np.asarray(coefficients)
+        if self.coefficients.ndim != 1 or not self.coefficients.size:
+            raise ValueError("coefficients must be a nonempty 1-D array.")
+        self.num_taps = self.coefficients.size
+        if n_fft is None:
+            self.n_fft = optimal_fft_length(self.num_taps)
+        else:
+            if n_fft != int(n_fft) or n_fft <= 0:
+                raise ValueError('n_fft must be a positive integer')
+            self.n_fft = int(2**nextpow2(max(n_fft, self.num_taps)))
+        self.block_length = self.n_fft - self.num_taps + 1
+        self.max_block_size = max_block_size
+        self._spectra = {}
+        self.reset()
+
+    def spectrum(self, real):
+        """
+        Return the cached transform of the filter, from rfft if real is True and from fft otherwise.
+        """
+        if real not in self._spectra:
+            if real:
+                self._spectra[real] = np.fft.rfft(self.coefficients, self.n_fft)
+            else:
+                self._spectra[real] = np.fft.fft(self.coefficients, self.n_fft)
+        return self._spectra[real]
+
+    def reset(self):
+        """
+        Discard the input history used by process().
+        """
+        self._history = None
+
+    def filter(self, data):
+        """
+        Filter data as if it were preceded by zeros, without using or changing the streaming state.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The data to filter, with time along the last axis.
+
+        Returns
+        -------
+        numpy.ndarray
+            The filtered data, with the same shape as data.
+        """
+        data = np.asarray(data)
+        history = np.zeros(data.shape[:-1] + (self.num_taps - 1,), dtype=data.dtype)
+        return self._overlap_save(history, data)[0]
+
+    def process(self, data):
+        """
+        Filter the next chunk of a stream, continuing from the previous chunk.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The next chunk of data, with time along the last axis. The leading axes must be the same for every chunk
+            processed between resets.
+
+        Returns
+        -------
+        numpy.ndarray
+            The filtered chunk, with the same shape as data.
+        """
+        data = np.asarray(data)
+        if self._history is None:
+            self._history = np.zeros(data.shape[:-1] + (self.num_taps - 1,), dtype=data.dtype)
+        result, self._history = self._overlap_save(self._history, data)
+        return result
+
+    def _overlap_save(self, history, data):
+        num_samples = data.shape[-1]
+        num_blocks = -(-num_samples // self.block_length)
+        leading_shape = data.shape[:-1]
+        buffer = np.concatenate((history, data), axis=-1)
+        new_history = buffer[..., buffer.shape[-1] - (self.num_taps - 1):].copy()
+        padded = np.zeros(leading_shape + (self.num_taps - 1 + num_blocks * self.block_length,),
+                          dtype=buffer.dtype)
+        padded[..., :buffer.shape[-1]] = buffer
+        padded = np.ascontiguousarray(padded)
+        segments = np.lib.stride_tricks.as_strided(
+            padded, shape=leading_shape + (num_blocks, self.n_fft),
+            strides=padded.strides[:-1] + (self.block_length * padded.strides[-1], padded.strides[-1]))
+        real = np.isrealobj(data) and np.isrealobj(self.coefficients)
+        H = self.spectrum(real)
+        result = np.empty(leading_shape + (num_blocks, self.block_length),
+                          dtype=np.result_type(data.dtype, self.coefficients.dtype, np.float32))
+        blocks_per_batch = max(1, self.max_block_size // (self.n_fft * max(1, int(np.prod(leading_shape)))))
+        for start in range(0, num_blocks, blocks_per_batch):
+            stop = start + blocks_per_batch
+            if real:
+                filtered = np.fft.irfft(np.fft.rfft(segments[..., start:stop, :], axis=-1) * H, self.n_fft, axis=-1)
+            else:
+                filtered = np.fft.ifft(np.fft.fft(segments[..., start:stop, :], axis=-1) * H, axis=-1)
+            result[..., start:stop, :] = filtered[..., self.num_taps - 1:]
+        result = result.reshape(leading_shape + (num_blocks * self.block_length,))[..., :num_samples]
+        return result, new_history
+
+
+def fft_filter(coefficients):
+    """
+    Return a new FFTFilter for the given coefficients, sharing the FFT length and filter spectrum of a cached filter if
+    one exists with the same coefficients. Each call returns a filter with its own process() history.
+    """
+    coefficients = np.asarray(coefficients)
+    key = (coefficients.dtype.str, coefficients.size, hash(coefficients.tobytes()))
+    cached = _filter_cache.pop(key, None)
+    if cached is None or not np.array_equal(cached.coefficients, coefficients):
+        cached = FFTFilter(coefficients.copy())
+    _filter_cache[key] = cached  # Most recently used filters are at the end.
+    while len(_filter_cache) > FILTER_CACHE_SIZE:
+        _filter_cache.popitem(last=False)
+    filter_ = FFTFilter(cached.coefficients, n_fft=cached.n_fft, max_block_size=cached.max_block_size)
+    filter_._spectra = cached._spectra
+    return filter_
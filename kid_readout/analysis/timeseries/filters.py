@@ -1,12 +1,12 @@
 import scipy.signal
 
-from kid_readout.analysis.timeseries.fftfilt import fftfilt
+from kid_readout.analysis.timeseries.fftfilt import fft_filter
 
 
 def low_pass_fir(data, num_taps=256, cutoff=1/256.,nyquist_freq=1.0,decimate_by=1):
     taps = scipy.signal.firwin(num_taps,cutoff/nyquist_freq)
-    result = fftfilt(taps,data)[num_taps:]
-    result = result[::decimate_by].copy()  # add .copy to ensure we separate this from the full sized original data
+    result = fft_filter(taps).filter(data)[..., num_taps:]  # time is the last axis
+    result = result[..., ::decimate_by].copy()  # add .copy to ensure we separate this from the full sized original data
     return result
 
 lpf = low_pass_fir
@@ -5,6 +5,7 @@ from collections import namedtuple
 import numpy as np
 from matplotlib import mlab
 from matplotlib.mlab import cbook
+from numpy.lib.stride_tricks import as_strided
 
 from kid_readout.analysis.timeseries import binning
 
@@ -70,6 +71,272 @@ def auto_auto_cross(a, b, sample_rate, NFFT=None, detrend=mlab.detrend_none, win
     return AutoAutoCross(f, S_aa, S_bb, S_ab)
 
 
+def _window_values(window, NFFT, dtype):
+    if np.iterable(window):
+        window_values = np.asarray(window)
+        if window_values.size != NFFT:
+            raise ValueError("The window must have length NFFT.")
+        return window_values
+    else:
+        return window(np.ones(NFFT, dtype=dtype))
+
+
+def _transform_segments(segments, window_values, detrend):
+    """
+    Return the real FFT of each detrended and windowed segment; the segments are along the last axis.
+    """
+    if detrend is mlab.detrend_mean:
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+    elif detrend is not mlab.detrend_none:
+        try:
+            segments = detrend(segments, axis=-1)
+        except TypeError:
+            segments = np.apply_along_axis(detrend, -1, segments)
+    return np.fft.rfft(window_values * segments, n=window_values.size, axis=-1)
+
+
+def _density_scale(window_values, sample_rate):
+    """
+    Return the factors that convert the squared magnitude of a segment's real FFT to a single-sided spectral density:
+    compensate for the window, double everything except the DC and Nyquist bins, and divide by the sample rate so that
+    the density has units of 1 / Hz. This matches the default scaling of mlab.psd().
+    """
+    NFFT = window_values.size
+    scale = np.full(NFFT // 2 + 1, 2 / (np.sum(np.abs(window_values) ** 2) * sample_rate))
+    scale[0] /= 2
+    if not NFFT % 2:
+        scale[-1] /= 2
+    return scale
+
+
+def welch_auto_auto_cross(a, b, sample_rate, NFFT, detrend=mlab.detrend_none, window=mlab.window_none,
+                          noverlap=None, max_block_size=2 ** 22):
+    """
+    Return Welch estimates of the single-sided auto-spectral densities of the real time series a and b and of their
+    cross-spectral density, for any number of channels at once.
+
+    Time is the last axis, so a and b can have shape (num_channels, num_samples). Each segment of every channel is
+    transformed exactly once with a real FFT, and the same transforms are used for S_aa, S_bb, and S_ab. The results
+    have the same normalization as mlab.psd() and mlab.csd() with their default scaling.
+
+    Parameters
+    ----------
+    a : ndarray(real)
+        A real time series, or an array of time series with time along the last axis.
+    b : ndarray(real)
+        A real time series with the same shape as a.
+    sample_rate : float
+        The sample rate of both time series.
+    NFFT : int
+        The number of samples to use for each FFT segment.
+    detrend : callable
+        A function applied to each segment, such as mlab.detrend_none or mlab.detrend_mean.
+    window : callable or ndarray
+        A function that returns a windowed copy of its argument, or an array of window values of length NFFT.
+    noverlap : int or None
+        The number of samples to overlap in each segment; if None, a value equal to half the NFFT value is used.
+    max_block_size : int
+        Segments are transformed in blocks containing at most about this many samples in order to limit memory use.
+
+    Returns
+    -------
+    AutoAutoCross
+        The frequencies, S_aa, S_bb, and S_ab; the spectra have the shape of the inputs with the last axis replaced by
+        frequency.
+    """
+    a = np.asarray(a)
+    b = np.asarray(b)
+    if a.shape != b.shape:
+        raise ValueError("The time series a and b must have the same shape.")
+    if noverlap is None:
+        noverlap = NFFT // 2
+    if a.shape[-1] < NFFT:  # Zero-pad short time series, like mlab.psd does.
+        padding = [(0, 0)] * (a.ndim - 1) + [(0, NFFT - a.shape[-1])]
+        a = np.pad(a, padding, mode='constant')
+        b = np.pad(b, padding, mode='constant')
+    window_values = _window_values(window, NFFT, a.dtype)
+    step = NFFT - noverlap
+    num_segments = (a.shape[-1] - NFFT) // step + 1
+    channel_shape = a.shape[:-1]
+    # View both time series as a single stack of overlapping segments without copying them.
+    ab = np.concatenate((a.reshape((-1, a.shape[-1])), b.reshape((-1, b.shape[-1]))))
+    segments = as_strided(ab, shape=(ab.shape[0], num_segments, NFFT),
+                          strides=(ab.strides[0], step * ab.strides[1], ab.strides[1]))
+    num_channels = ab.shape[0] // 2
+    num_frequencies = NFFT // 2 + 1
+    S_aa = np.zeros((num_channels, num_frequencies))
+    S_bb = np.zeros((num_channels, num_frequencies))
+    S_ab = np.zeros((num_channels, num_frequencies), dtype=np.complex)
+    segments_per_block = max(1, max_block_size // (ab.shape[0] * NFFT))
+    for start in range(0, num_segments, segments_per_block):
+        transformed = _transform_segments(segments[:, start:start + segments_per_block, :], window_values, detrend)
+        fa = transformed[:num_channels]
+        fb = transformed[num_channels:]
+        S_aa += np.sum(fa.real ** 2 + fa.imag ** 2, axis=1)
+        S_bb += np.sum(fb.real ** 2 + fb.imag ** 2, axis=1)
+        S_ab += np.sum(np.conj(fa) * fb, axis=1)
+    scale = _density_scale(window_values, sample_rate) / num_segments
+    f = np.fft.rfftfreq(NFFT, 1 / sample_rate)
+    spectra_shape = channel_shape + (num_frequencies,)
+    return AutoAutoCross(f, (scale * S_aa).reshape(spectra_shape), (scale * S_bb).reshape(spectra_shape),
+                         (scale * S_ab).reshape(spectra_shape))
+
+
+class IncrementalWelch(object):
+    """
+    This class estimates auto- and cross-spectral densities of two real time series from data that arrive in chunks.
+
+    Only the samples needed to complete the next overlapping segment are kept between chunks, so the memory used does
+    not grow with the length of the stream. Each segment's periodograms are accumulated into running means and
+    variances, and the current estimates are available at any time through the properties. After all the data of a
+    time series has been added, the estimates are the same as those from welch_auto_auto_cross().
+
+    Time is the last axis of the chunks, and the leading axes, typically one per channel, must be the same for every
+    chunk. For complex I/Q data, pass the real and imaginary parts as a and b.
+    """
+
+    def __init__(self, sample_rate, NFFT, detrend=mlab.detrend_none, window=mlab.window_none, noverlap=None):
+        """
+        Parameters
+        ----------
+        sample_rate : float
+            The sample rate of the time series.
+        NFFT : int
+            The number of samples to use for each FFT segment.
+        detrend : callable
+            A function applied to each segment, such as mlab.detrend_none or mlab.detrend_mean.
+        window : callable or ndarray
+            A function that returns a windowed copy of its argument, or an array of window values of length NFFT.
+        noverlap : int or None
+            The number of samples to overlap in each segment; if None, a value equal to half the NFFT value is used.
+        """
+        if noverlap is None:
+            noverlap = NFFT // 2
+        if not 0 <= noverlap < NFFT:
+            raise ValueError("noverlap must be non-negative and less than NFFT.")
+        self.sample_rate = sample_rate
+        self.NFFT = NFFT
+        self.noverlap = noverlap
+        self.detrend = detrend
+        self.window_values = _window_values(window, NFFT, np.float)
+        self.frequency = np.fft.rfftfreq(NFFT, 1 / sample_rate)
+        self._scale = _density_scale(self.window_values, sample_rate)
+        self.reset()
+
+    def reset(self):
+        """
+        Discard all accumulated data.
+        """
+        self.num_segments = 0
+        self.num_samples = 0
+        self._buffer = None
+        self._mean = None
+        self._m2 = None
+
+    def add(self, a, b):
+        """
+        Add a chunk of data to the estimates.
+
+        Parameters
+        ----------
+        a : ndarray(real)
+            The next chunk of the first time series, with time along the last axis.
+        b : ndarray(real)
+            The next chunk of the second time series, with the same shape as a.
+
+        Returns
+        -------
+        int
+            The number of segments completed by this chunk.
+        """
+        a = np.asarray(a, dtype=np.float)
+        b = np.asarray(b, dtype=np.float)
+        if a.shape != b.shape:
+            raise ValueError("The time series a and b must have the same shape.")
+        chunk = np.stack((a, b))
+        if self._buffer is not None:
+            if self._buffer.shape[:-1] != chunk.shape[:-1]:
+                raise ValueError("The chunk shape {} does not match earlier chunks.".format(a.shape))
+            chunk = np.concatenate((self._buffer, chunk), axis=-1)
+        self.num_samples += a.shape[-1]
+        step = self.NFFT - self.noverlap
+        num_segments = max(0, (chunk.shape[-1] - self.NFFT) // step + 1)
+        if num_segments:
+            segments = as_strided(chunk, shape=chunk.shape[:-1] + (num_segments, self.NFFT),
+                                  strides=chunk.strides[:-1] + (step * chunk.strides[-1], chunk.strides[-1]))
+            transformed = _transform_segments(segments, self.window_values, self.detrend)
+            fa = transformed[0]
+            fb = transformed[1]
+            # The periodograms have shape (3,) + channel shape + (num_segments, num_frequencies).
+            periodograms = self._scale * np.stack((fa.real ** 2 + fa.imag ** 2, fb.real ** 2 + fb.imag ** 2,
+                                                   np.conj(fa) * fb))
+            self._accumulate(periodograms)
+        # Keep only the samples that belong to segments that are not yet complete.
+        self._buffer = chunk[..., num_segments * step:].copy()
+        return num_segments
+
+    def _accumulate(self, periodograms):
+        # Combine the running mean and sum of squared deviations with those of the new segments; see Chan, Golub, and
+        # LeVeque (1979), "Updating formulae and a pairwise algorithm for computing sample variances."
+        new_count = periodograms.shape[-2]
+        new_mean = periodograms.mean(axis=-2)
+        new_m2 = np.sum(np.abs(periodograms - new_mean[..., np.newaxis, :]) ** 2, axis=-2)
+        if self._mean is None:
+            self._mean = new_mean
+            self._m2 = new_m2
+        else:
+            total = self.num_segments + new_count
+            delta = new_mean - self._mean
+            self._mean = self._mean + delta * new_count / total
+            self._m2 = self._m2 + new_m2 + np.abs(delta) ** 2 * self.num_segments * new_count / total
+        self.num_segments += new_count
+
+    def _check_segments(self):
+        if not self.num_segments:
+            raise ValueError("No complete segments have been added yet.")
+
+    @property
+    def S_aa(self):
+        """ndarray(float): The current estimate of the spectral density of a."""
+        self._check_segments()
+        return self._mean[0].real
+
+    @property
+    def S_bb(self):
+        """ndarray(float): The current estimate of the spectral density of b."""
+        self._check_segments()
+        return self._mean[1].real
+
+    @property
+    def S_ab(self):
+        """ndarray(complex): The current estimate of the cross-spectral density of a and b."""
+        self._check_segments()
+        return self._mean[2]
+
+    @property
+    def variance(self):
+        """
+        ndarray(float): The variance of the S_aa, S_bb, and S_ab estimates, stacked along the first axis, calculated
+        from the scatter of the segment periodograms; for S_ab this is the variance of the complex value. Overlapping
+        segments are not independent, so this underestimates the variance when noverlap is nonzero.
+        """
+        self._check_segments()
+        if self.num_segments < 2:
+            return np.full(self._m2.shape, np.nan)
+        return self._m2 / (self.num_segments - 1) / self.num_segments
+
+    def spectra(self):
+        """
+        Return the current estimates.
+
+        Returns
+        -------
+        AutoAutoCross
+            The frequencies, S_aa, S_bb, and S_ab.
+        """
+        return AutoAutoCross(self.frequency, self.S_aa, self.S_bb, self.S_ab)
+
+
 def pca_noise_with_errors(d, NFFT, Fs, window=mlab.window_hanning, detrend=mlab.detrend_mean,
                           use_log_bins=True):
     # Assume the rotation is small so that the variance can be approximated using the values in the pre-PCA spectra.
@@ -92,15 +359,42 @@ def pca_noise_with_errors(d, NFFT, Fs, window=mlab.window_hanning, detrend=mlab.
 
 def pca_noise(d, NFFT=None, Fs=256e6/2.**11, window=mlab.window_hanning, detrend=mlab.detrend_mean,
               use_log_bins=True, use_full_spectral_helper=True):
+    """
+    Return the spectral densities of the complex time series d along the directions in the complex plane of minimal
+    and maximal fluctuation at each frequency; see calculate_pca_noise().
+
+    Time is the last axis of d, so an array with shape (num_channels, num_samples) is processed in one pass; the
+    outputs then have a channel axis after their leading component axes.
+
+    Parameters
+    ----------
+    d : ndarray(complex)
+        The time series.
+    NFFT : int or None
+        The number of samples to use for each FFT chunk; if None, a default that averages about eight spectra is used.
+    Fs : float
+        The sample rate.
+    window : callable
+        A function that takes a time series as argument and returns a windowed time series.
+    detrend : callable
+        A function that takes a time series as argument and returns a detrended time series.
+    use_log_bins : bool
+        If True, bin the spectral densities using binning.log_bin_old() before the decomposition.
+    use_full_spectral_helper : bool
+        If True, calculate the I, Q, and cross spectral densities from a single set of FFTs using
+        welch_auto_auto_cross(), with no overlap; if False, use mlab.psd() and mlab.csd(), which works only for 1-D d.
+
+    Returns
+    -------
+    fr, S, evals, evects, angles, piq
+        See calculate_pca_noise(); fr is the frequency and piq is the I-Q cross-spectral density.
+    """
     if NFFT is None:
-        NFFT = int(2 ** (np.floor(np.log2(d.shape[0])) - 3))
+        NFFT = int(2 ** (np.floor(np.log2(d.shape[-1])) - 3))
         #print "using NFFT: 2**", np.log2(NFFT)
     if use_full_spectral_helper:
-        pii, pqq, piq, fr_orig, t = full_spectral_helper(d.real, d.imag, NFFT=NFFT, Fs=Fs, window=window,
-                                                         detrend=detrend)
-        pii = pii.mean(1)
-        pqq = pqq.mean(1)
-        piq = piq.mean(1)
+        fr_orig, pii, pqq, piq = welch_auto_auto_cross(d.real, d.imag, sample_rate=Fs, NFFT=NFFT, detrend=detrend,
+                                                       window=window, noverlap=0)
     else:
         pii, fr_orig = mlab.psd(d.real, NFFT=NFFT, Fs=Fs, window=window, detrend=detrend)
         pqq, fr = mlab.psd(d.imag, NFFT=NFFT, Fs=Fs, window=window, detrend=detrend)
@@ -114,27 +408,56 @@ def pca_noise(d, NFFT=None, Fs=256e6/2.**11, window=mlab.window_hanning, detrend
 
 
 def calculate_pca_noise(pii, pqq, piq):
-    nf = pii.shape[0]
-    evals = np.zeros((2, nf))  # since the matrix is hermetian, eigvals are real
-    evects = np.zeros((2, 2, nf), dtype='complex')
-    for k in range(nf):
-        m = np.array([[pii[k], np.real(piq[k])],
-                      [np.conj(np.real(piq[k])), pqq[k]]])
-        w, v = np.linalg.eigh(m)
-        evals[:, k] = w
-        evects[:, :, k] = v
-    angles = np.zeros((2, nf))
-    angles[0, :] = np.mod(np.arctan2(evects[0, 0, :].real, evects[1, 0, :].real), np.pi)
-    angles[1, :] = np.mod(np.arctan2(evects[0, 1, :].real, evects[1, 1, :].real), np.pi)
-    S = np.zeros((2, nf))
-    v = evects[:, :, 0]
-    invv = np.linalg.inv(v)
-    for k in range(nf):
-        m = np.array([[pii[k], piq[k]],
-                      [np.conj(piq[k]), pqq[k]]])
-        ss = np.dot(np.dot(invv, m), v)
-        S[0, k] = ss[0, 0]
-        S[1, k] = ss[1, 1]
+    """
+    Diagonalize the 2x2 I-Q spectral density matrix at every frequency.
+
+    The matrix [[pii, Re(piq)], [Re(piq), pqq]] is real and symmetric, so its eigenvalues and eigenvectors are
+    calculated in closed form for all frequencies and channels at once. Frequency is the last axis of the inputs, and
+    any leading axes, such as a channel axis, are preserved in the outputs.
+
+    Parameters
+    ----------
+    pii : ndarray(float)
+        The spectral density of I.
+    pqq : ndarray(float)
+        The spectral density of Q.
+    piq : ndarray(complex)
+        The cross-spectral density of I and Q.
+
+    Returns
+    -------
+    S : ndarray(float)
+        Shape (2,) + pii.shape: the spectral densities along the two eigenvector directions at the first frequency
+        of each channel.
+    evals : ndarray(float)
+        Shape (2,) + pii.shape: the eigenvalues in ascending order, so evals[0] is the minimal spectral density.
+    evects : ndarray(complex)
+        Shape (2, 2) + pii.shape: evects[:, k] is the eigenvector corresponding to evals[k]. Each is a unit vector,
+        determined up to sign.
+    angles : ndarray(float)
+        Shape (2,) + pii.shape: the angles in [0, pi) of the eigenvectors, calculated as arctan2(I, Q).
+    """
+    pii = np.asarray(pii)
+    pqq = np.asarray(pqq)
+    piq_real = np.real(piq)
+    mean = (pii + pqq) / 2
+    half_difference = (pii - pqq) / 2
+    radius = np.hypot(half_difference, piq_real)
+    evals = np.array([mean - radius, mean + radius])
+    # theta is the angle of the major axis from the I axis; the minor axis is perpendicular to it.
+    theta = np.arctan2(piq_real, half_difference) / 2
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+    evects = np.array([[-sin, cos],
+                       [cos, sin]], dtype='complex')
+    angles = np.array([np.mod(-theta, np.pi), np.mod(np.pi / 2 - theta, np.pi)])
+    # Rotate the full (Hermitian) matrix at every frequency into the eigenvector basis of the first frequency; this
+    # basis is its own inverse, and only the real parts of the diagonal elements are kept.
+    cos_0 = cos[..., :1]
+    sin_0 = sin[..., :1]
+    cross = 2 * sin_0 * cos_0 * piq_real
+    S = np.array([sin_0 ** 2 * pii + cos_0 ** 2 * pqq - cross,
+                  cos_0 ** 2 * pii + sin_0 ** 2 * pqq + cross])
     return S, evals, evects, angles
 
 
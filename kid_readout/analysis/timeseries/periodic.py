@@ -2,9 +2,13 @@
 This module contains functions to analyze periodic data.
 """
 from __future__ import division, print_function
+from collections import namedtuple
 
 import numpy as np
 
+Demodulation = namedtuple('Demodulation', ['folded', 'counts', 'offset', 'in_phase', 'quadrature', 'in_phase_error',
+                                           'quadrature_error'])
+
 def folded_shape(array, period_samples):
     if period_samples == 0:
         raise ValueError("Cannot fold unmodulated data or with period=0")
@@ -33,3 +37,113 @@ def peak_to_peak(folded, skip=0.1):
     left = folded[left_mask]
     right = folded[right_mask]
     return np.mean(left) - np.mean(right), np.sqrt(np.var(left) / left.size + np.var(right) / right.size)
+
+
+def demodulate(array, period_samples, num_bins=None, harmonic=1):
+    """
+    Fold and lock-in demodulate periodically modulated data for all channels at once.
+
+    The period may be any positive number of samples: each sample is assigned a phase (n / period_samples) % 1, where n
+    is its index along the last axis, so phase zero is at the first sample. Non-finite samples, such as NaN-filled
+    packet gaps, are ignored. For each channel the data are fit by linear least squares to
+        offset + in_phase * cos(2 pi harmonic phase) + quadrature * sin(2 pi harmonic phase),
+    which is a lock-in measurement that is not biased by gaps or by a fractional number of periods. For a square wave
+    that switches between offset + a and offset - a, the amplitude at harmonic 1 is 4 a / pi. A channel whose finite
+    samples do not determine all three coefficients, such as a dead channel that is entirely NaN, gets NaN coefficients
+    and errors; the other channels are unaffected.
+
+    The uncertainties assume that the noise is white on the timescale of a period: the noise variance is estimated from
+    the scatter of the samples about the folded average.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        The data, real or complex, with time along the last axis; all leading axes (for example, channels) are
+        demodulated independently.
+    period_samples : float
+        The modulation period in samples, for example from kid_readout.roach.calculate.modulation_period_samples().
+    num_bins : int
+        The number of phase bins used for the folded average; the default is the period rounded down to an integer,
+        which for an integer period folds exactly like fold().
+    harmonic : int
+        The harmonic of the modulation frequency used as the reference.
+
+    Returns
+    -------
+    Demodulation
+        A namedtuple with fields
+        folded : the mean in each phase bin, with shape array.shape[:-1] + (num_bins,); empty bins are NaN.
+        counts : the number of finite samples in each phase bin, with the same shape as folded.
+        offset, in_phase, quadrature : the fit coefficients, with shape array.shape[:-1].
+        in_phase_error, quadrature_error : the standard errors of in_phase and quadrature; for complex data the real
+        and imaginary parts are the errors of the real and imaginary parts.
+    """
+    if period_samples <= 0:
+        raise ValueError("Cannot demodulate unmodulated data or with period <= 0")
+    array = np.asarray(array)
+    if num_bins is None:
+        num_bins = int(np.floor(period_samples))
+    if not 1 <= num_bins <= period_samples:
+        raise ValueError("num_bins must be at least 1 and at most the period.")
+    leading_shape = array.shape[:-1]
+    num_samples = array.shape[-1]
+    data = array.reshape((-1, num_samples))
+    valid = np.isfinite(data)
+    all_valid = valid.all()
+    if not all_valid:
+        data = np.where(valid, data, 0)
+
+    # Fold: sort the samples by phase bin once, then sum each bin for all channels with reduceat.
+    phase = (np.arange(num_samples) / period_samples) % 1
+    bins = np.minimum((phase * num_bins).astype(int), num_bins - 1)
+    order = np.argsort(bins, kind='mergesort')
+    occupied, starts = np.unique(bins[order], return_index=True)
+    folded_sum = np.zeros((data.shape[0], num_bins), dtype=np.result_type(data.dtype, float))
+    counts = np.zeros((data.shape[0], num_bins))
+    folded_sum[:, occupied] = np.add.reduceat(np.take(data, order, axis=1), starts, axis=1)
+    if all_valid:
+        counts[:] = np.bincount(bins, minlength=num_bins)
+    else:
+        counts[:, occupied] = np.add.reduceat(np.take(valid, order, axis=1), starts, axis=1, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        folded = folded_sum / counts
+    folded[counts == 0] = np.nan
+
+    # Linear least squares for each channel using its own normal matrix, since the gaps differ between channels.
+    basis = np.vstack((np.ones(num_samples), np.cos(2 * np.pi * harmonic * phase),
+                       np.sin(2 * np.pi * harmonic * phase))).T
+    products = (basis[:, :, None] * basis[:, None, :]).reshape((num_samples, 9))
+    if all_valid:
+        normal = np.tile(products.sum(axis=0).reshape((1, 3, 3)), (data.shape[0], 1, 1))
+    else:
+        normal = np.dot(valid.astype(float), products).reshape((-1, 3, 3))
+    # A singular normal matrix would make solve() and inv() fail for every channel, so only the others are solved.
+    projections = np.dot(data, basis)
+    solvable = np.linalg.matrix_rank(normal) == 3
+    coefficients = np.empty(projections.shape, dtype=projections.dtype)
+    coefficients.fill(np.nan)
+    covariance_diagonal = np.empty((data.shape[0], 2))
+    covariance_diagonal.fill(np.nan)
+    if np.any(solvable):
+        coefficients[solvable] = np.linalg.solve(normal[solvable], projections[solvable][..., None])[..., 0]
+        covariance_diagonal[solvable] = np.linalg.inv(normal[solvable])[:, [1, 2], [1, 2]]
+
+    # The residual sum of squares about the folded average is sum |x|^2 - sum counts |folded|^2, for real and
+    # imaginary parts separately.
+    num_occupied = np.sum(counts > 0, axis=1)
+    dof = np.maximum(counts.sum(axis=1) - num_occupied, 1)
+    folded_zeroed = np.where(counts > 0, folded, 0)
+    variance_real = (np.einsum('ij,ij->i', data.real, data.real)
+                     - np.sum(counts * folded_zeroed.real ** 2, axis=1)) / dof
+    errors = np.sqrt(np.maximum(variance_real, 0)[:, None] * covariance_diagonal)
+    if np.iscomplexobj(data):
+        variance_imag = (np.einsum('ij,ij->i', data.imag, data.imag)
+                         - np.sum(counts * folded_zeroed.imag ** 2, axis=1)) / dof
+        errors = errors + 1j * np.sqrt(np.maximum(variance_imag, 0)[:, None] * covariance_diagonal)
+    return Demodulation(folded=folded.reshape(leading_shape + (num_bins,)),
+                        counts=counts.reshape(leading_shape + (num_bins,)),
+                        offset=coefficients[:, 0].reshape(leading_shape),
+                        in_phase=coefficients[:, 1].reshape(leading_shape),
+                        quadrature=coefficients[:, 2].reshape(leading_shape),
+                        in_phase_error=errors[:, 0].reshape(leading_shape),
+                        quadrature_error=errors[:, 1].reshape(leading_shape))
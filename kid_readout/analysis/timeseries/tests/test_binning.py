@@ -0,0 +1,38 @@
+import numpy as np
+from kid_readout.analysis.timeseries import binning
+
+
+def test_log_bin_matches_masked_means():
+    np.random.seed(123)
+    frequency = np.linspace(0, 1000, 2 ** 12 + 1)
+    data = np.random.randn(frequency.size) + 1j * np.random.randn(frequency.size)
+    variance = np.abs(data) ** 2
+    edges, counts, mean_frequency, [(binned_data, binned_variance)] = binning.log_bin_with_variance(
+        frequency, 30, (data, variance))
+    bin_indices = np.digitize(frequency, edges)
+    indices_used = np.unique(bin_indices)
+    assert np.all(counts == [np.sum(bin_indices == n) for n in indices_used])
+    assert np.allclose(mean_frequency, [frequency[bin_indices == n].mean() for n in indices_used])
+    assert np.allclose(binned_data, [data[bin_indices == n].mean() for n in indices_used])
+    assert np.allclose(binned_variance, [variance[bin_indices == n].mean() / np.sum(bin_indices == n)
+                                         for n in indices_used])
+    # Zero frequency lands in its own bin.
+    assert mean_frequency[0] == 0 and binned_data[0] == data[0]
+
+
+def test_log_bin_multichannel():
+    np.random.seed(123)
+    frequency = np.linspace(1, 1000, 2 ** 12)
+    data = np.random.randn(8, frequency.size)
+    edges, counts, mean_frequency, [binned] = binning.log_bin(frequency, 20, data)
+    assert binned.shape == (8, counts.size)
+    for channel in range(data.shape[0]):
+        assert np.allclose(binned[channel], binning.log_bin(frequency, 20, data[channel])[3][0])
+
+
+def test_log_bin_plan_cache():
+    frequency = np.linspace(1, 1000, 2 ** 10)
+    plan = binning.log_bin_plan(frequency, 30)
+    assert binning.log_bin_plan(frequency.copy(), 30) is plan
+    assert binning.log_bin_plan(frequency, 10) is not plan
+    assert binning.log_bin_plan(2 * frequency, 30) is not plan
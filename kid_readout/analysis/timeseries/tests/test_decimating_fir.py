@@ -1,5 +1,6 @@
 from kid_readout.analysis.timeseries import fftfilt, decimating_fir
 import numpy as np
+import scipy.signal
 
 def test_decimating_fir():
     np.random.seed(123)
@@ -36,4 +37,36 @@ def test_fir1d_nstream():
     stream1 = fir2.apply(data[0,:])
     stream1 = fir2.apply(data[0,:])
 
-    assert  np.allclose(stream1,full[0,:])
\ No newline at end of file
+    assert  np.allclose(stream1,full[0,:])
+
+def test_polyphase_decimator_chunked_multichannel():
+    np.random.seed(123)
+    downsample_factor = 4
+    coeff = scipy.signal.firwin(61, 1. / downsample_factor)
+    x = np.random.randn(3, 10001) + 1j * np.random.randn(3, 10001)
+    gold = scipy.signal.lfilter(coeff, 1, x, axis=-1)[:, downsample_factor - 1::downsample_factor]
+    decimator = decimating_fir.PolyphaseDecimator(coeff, downsample_factor)
+    assert np.allclose(decimator.process(x), gold)
+    decimator.reset()
+    boundaries = np.concatenate(([0], np.sort(np.random.randint(0, x.shape[1], 30)), [x.shape[1]]))
+    result = np.concatenate([decimator.process(x[:, start:stop])
+                             for start, stop in zip(boundaries[:-1], boundaries[1:])], axis=-1)
+    assert np.allclose(result, gold)
+
+
+def test_multistage_decimator():
+    np.random.seed(123)
+    x = np.random.randn(2, 2 ** 12)
+    decimator = decimating_fir.MultistageDecimator([2, 4], num_taps=[16, 64])
+    assert decimator.downsample_factor == 8
+    gold = x
+    for stage in decimator.stages:
+        gold = scipy.signal.lfilter(stage.coefficients, 1, gold, axis=-1)[:, stage.downsample_factor - 1::
+                                                                              stage.downsample_factor]
+    result = np.concatenate([decimator.process(chunk) for chunk in np.array_split(x, 7, axis=-1)], axis=-1)
+    assert np.allclose(result, gold)
+    # A 1 Hz tone at an input rate of 64 Hz passes through with unit gain.
+    t = np.arange(2 ** 12) / 64.
+    decimator.reset()
+    result = decimator.process(np.exp(2j * np.pi * t))
+    assert np.allclose(np.abs(result[20:]), 1, atol=1e-2)
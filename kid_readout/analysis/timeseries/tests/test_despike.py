@@ -0,0 +1,59 @@
+import numpy as np
+from kid_readout.analysis.timeseries import despike
+
+
+def test_mask_glitches_random_draws_from_window():
+    np.random.seed(123)
+    window_length = 64
+    step = window_length // 2
+    x = np.arange(1024, dtype='float')
+    q = -x
+    mask = np.zeros(x.shape, dtype='bool')
+    mask[100:110] = True
+    mask[1000:1010] = True
+    clean_x, clean_q = despike.mask_glitches([x, q], mask, window_length=window_length)
+    assert np.all(clean_x[~mask] == x[~mask])
+    # The replacements are good samples from the same window, and the same sample is used for every series.
+    assert not np.any(mask[clean_x[mask].astype(int)])
+    assert np.all(clean_q[mask] == -clean_x[mask])
+    assert np.all(np.abs(clean_x[100:110] - 100) < 2 * step)
+    # Samples past the last full step are filled too.
+    assert np.all(clean_x[1000:1010] >= 1024 - 2 * step)
+
+
+def test_mask_glitches_in_place():
+    np.random.seed(123)
+    x = np.random.randn(2 ** 12)
+    s21 = x + 1j * x
+    mask = np.zeros(x.shape, dtype='bool')
+    mask[::17] = True
+    clean_x, clean_s21 = despike.mask_glitches([x, s21], mask, window_length=256, in_place=True)
+    assert clean_x is x
+    assert clean_s21 is s21
+    assert np.all(s21.real == x)
+
+
+def test_mask_glitches_interpolate():
+    x = np.linspace(0, 1, 100) + 1j * np.linspace(1, 2, 100)
+    mask = np.zeros(x.shape, dtype='bool')
+    mask[10:20] = True
+    mask[-5:] = True
+    clean, = despike.mask_glitches(x, mask, window_length=16, method='interpolate')
+    assert np.allclose(clean[:-5], x[:-5])
+    assert np.all(clean[-5:] == x[-6])
+
+
+def test_mask_glitches_multichannel():
+    np.random.seed(123)
+    data = np.random.randn(4, 2 ** 10)
+    mask = np.zeros(data.shape, dtype='bool')
+    mask[1, 50:60] = True
+    mask[3, 500:510] = True
+    clean, = despike.mask_glitches(data, mask, window_length=128)
+    assert np.all(clean[~mask] == data[~mask])
+    for channel in (1, 3):
+        assert np.all(np.in1d(clean[channel, mask[channel]], data[channel, ~mask[channel]]))
+    shared_mask = mask.any(axis=0)
+    clean, = despike.mask_glitches(data, shared_mask, window_length=128)
+    assert np.all(clean[:, ~shared_mask] == data[:, ~shared_mask])
+    assert np.all(np.in1d(clean[0, shared_mask], data[0, ~shared_mask]))
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.signal
 from kid_readout.analysis.timeseries import fftfilt
 
 def test_fftfilt_nd():
@@ -14,4 +15,33 @@ def test_fftfilt_nd():
     for k in range(16):
         oned[:,k] = fftfilt.fftfilt(b,x[:,k])
     nd = fftfilt.fftfilt_nd(b,x)
-    assert np.allclose(oned,nd)
\ No newline at end of file
+    assert np.allclose(oned,nd)
+
+def test_fft_filter_matches_lfilter():
+    np.random.seed(123)
+    b = np.random.randn(100)
+    for x in [np.random.randn(3, 10001), np.random.randn(3, 10001) + 1j * np.random.randn(3, 10001),
+              np.random.randn(50)]:
+        gold = scipy.signal.lfilter(b, 1, x, axis=-1)
+        fft_filter = fftfilt.FFTFilter(b, n_fft=512)
+        assert np.allclose(fft_filter.filter(x), gold)
+        boundaries = np.concatenate(([0], np.sort(np.random.randint(0, x.shape[-1], 20)), [x.shape[-1]]))
+        streamed = np.concatenate([fft_filter.process(x[..., start:stop])
+                                   for start, stop in zip(boundaries[:-1], boundaries[1:])], axis=-1)
+        assert np.allclose(streamed, gold)
+    # Real data filtered with real coefficients stays real.
+    assert np.isrealobj(fftfilt.FFTFilter(b).filter(np.random.randn(1000)))
+
+
+def test_fft_filter_cache():
+    b = np.random.randn(16)
+    fft_filter = fftfilt.fft_filter(b)
+    x = np.random.randn(100)
+    fft_filter.process(x)
+    # A second caller shares the spectrum but not the process() history.
+    other = fftfilt.fft_filter(b.copy())
+    assert other is not fft_filter
+    assert other.spectrum(True) is fft_filter.spectrum(True)
+    assert np.allclose(other.process(x), fft_filter.filter(x))
+    assert fftfilt.fft_filter(2 * b).spectrum(True) is not fft_filter.spectrum(True)
+    assert fft_filter.n_fft == fftfilt.optimal_fft_length(16)
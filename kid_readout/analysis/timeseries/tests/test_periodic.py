@@ -0,0 +1,50 @@
+import numpy as np
+from kid_readout.analysis.timeseries import periodic
+
+
+def test_demodulate_square_wave_with_gaps():
+    np.random.seed(123)
+    period = 100.5
+    phase = (np.arange(2 ** 14) / period) % 1
+    square_wave = np.where(phase < 0.5, 1., -1.)
+    amplitude = np.random.rand(8) + 0.5
+    noise = 0.01 * (np.random.randn(8, phase.size) + 1j * np.random.randn(8, phase.size))
+    data = amplitude[:, None] * (square_wave + 1j * square_wave) + noise + 2 + 2j
+    data[3, 1000:1500] = np.nan
+    result = periodic.demodulate(data, period)
+    assert result.folded.shape == result.counts.shape == (8, 100)
+    assert np.allclose(result.offset, 2 + 2j, atol=2e-2)
+    # The fundamental of a square wave with half-amplitude a has amplitude 4 a / pi.
+    assert np.allclose(np.hypot(result.in_phase.real, result.quadrature.real), 4 * amplitude / np.pi, rtol=1e-3)
+    assert result.counts[3].sum() == phase.size - 500
+    assert np.all(result.in_phase_error.imag > 0) and np.all(result.in_phase_error.imag < 1e-3)
+
+
+def test_demodulate_matches_fold_and_errors():
+    np.random.seed(123)
+    data = np.random.randn(3, 1280)
+    result = periodic.demodulate(data, 128)
+    assert np.allclose(result.folded, periodic.fold(data, 128, reduce=np.mean))
+    in_phase = []
+    errors = []
+    for trial in range(100):
+        data = 0.2 * np.cos(2 * np.pi * np.arange(5000) / 37.3) + np.random.randn(5000)
+        result = periodic.demodulate(data, 37.3)
+        in_phase.append(result.in_phase)
+        errors.append(result.in_phase_error)
+    assert abs(np.mean(in_phase) - 0.2) < 3 * np.mean(errors) / np.sqrt(len(in_phase))
+    assert 0.7 < np.std(in_phase) / np.mean(errors) < 1.3
+
+
+def test_demodulate_dead_channel():
+    np.random.seed(123)
+    data = np.cos(2 * np.pi * np.arange(1000) / 10.)[None, :] + 0.01 * np.random.randn(3, 1000)
+    data[1] = np.nan
+    # Valid samples at only two phases cannot determine three coefficients.
+    data[2, :] = np.nan
+    data[2, ::5] = 1
+    result = periodic.demodulate(data, 10)
+    assert np.allclose(result.in_phase[0], 1, atol=1e-2) and np.isfinite(result.in_phase_error[0])
+    for channel in (1, 2):
+        assert np.isnan(result.offset[channel]) and np.isnan(result.in_phase[channel])
+        assert np.isnan(result.in_phase_error[channel]) and np.isnan(result.quadrature_error[channel])
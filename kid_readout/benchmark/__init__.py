@@ -0,0 +1,13 @@
+"""
+Throughput and memory benchmarks for the stages of the readout chain.
+
+The suite times packet decoding, demodulation, measurement IO and the analysis of streams on pinned synthetic datasets
+that are built from the packet formats and models in roach.tests.simulated_roach, so the numbers are comparable from
+one run to the next and one machine to the next. The stages that have to keep up with the hardware also report their
+real-time factor: the ratio of their throughput to the sample rate of the configuration that they process. A factor
+below one means that the stage would fall behind.
+
+Run the suite from the command line with
+python -m kid_readout.benchmark
+and use --save-baseline and --baseline to store the results and to compare a later run against them.
+"""
@@ -0,0 +1,48 @@
+"""
+Run the benchmark suite from the command line; see kid_readout.benchmark.
+"""
+import sys
+import logging
+import argparse
+
+from kid_readout.benchmark import core, suite
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m kid_readout.benchmark',
+                                     description="Measure the throughput and memory use of the readout chain.")
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help="the benchmarks to run; the default is all of them: %s" % ', '.join(core.names()))
+    parser.add_argument('--scale', type=int, default=1, help="the size of each dataset relative to the default")
+    parser.add_argument('--repeat', type=int, default=3, help="the number of timed runs; the fastest is reported")
+    parser.add_argument('--baseline', help="a JSON file of results to compare against")
+    parser.add_argument('--save-baseline', help="write the results to this JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="the fractional loss of throughput or gain in peak memory, relative to the baseline, that "
+                             "counts as a regression")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    unknown = set(args.names) - set(core.names())
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+    results = core.run(args.names or None, scale=args.scale, repeat=args.repeat)
+    baseline = None
+    if args.baseline:
+        baseline = core.load_baseline(args.baseline, scale=args.scale)
+    print core.format_results(results, baseline)
+    if args.save_baseline:
+        core.save_baseline(args.save_baseline, results, scale=args.scale)
+    if baseline is not None:
+        regressions = core.compare(results, baseline, tolerance=args.tolerance)
+        for name, regressed in regressions.items():
+            if 'samples_per_second' in regressed:
+                print "%s is slower than the baseline: %.2f of its throughput" % (name, regressed['samples_per_second'])
+            if 'peak_memory_mb' in regressed:
+                print "%s uses more memory than the baseline: %.2f times its peak" % (name, regressed['peak_memory_mb'])
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Run benchmarks, measure their throughput and memory use, and compare the results with a stored baseline.
+
+A benchmark is a function registered with the benchmark decorator. It takes a scale factor, builds its dataset, and
+returns a Task; only the Task's run() is timed. The peak memory reported for a benchmark is the largest increase of the
+resident set size of the process during the timed runs, above its size before them, so it does not include the
+dataset. On Linux the peak is reset before each benchmark through /proc/self/clear_refs; elsewhere only increases
+above the peak of the whole process so far are seen.
+"""
+from __future__ import division
+import gc
+import re
+import sys
+import json
+import socket
+import timeit
+import logging
+import platform
+import resource
+import traceback
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# This maps benchmark name to the function that sets it up, in the order of registration.
+_benchmarks = OrderedDict()
+
+
+class Unavailable(Exception):
+    """
+    Raised by a benchmark when it cannot run here, for example because an optional compiled module is not built.
+    """
+    pass
+
+
+class Task(object):
+    """
+    The work timed by a benchmark.
+    """
+
+    def __init__(self, run, num_samples, realtime_samples_per_second=None, cleanup=None):
+        """
+        Parameters
+        ----------
+        run : callable
+            A function with no arguments that does the work; it is called once per repetition.
+        num_samples : int
+            The number of complex samples processed by each call to run.
+        realtime_samples_per_second : float or None
+            The rate at which the hardware produces the samples processed by this task, if it must keep up with them.
+        cleanup : callable or None
+            A function with no arguments that releases any resources, such as temporary files, after the runs.
+        """
+        self.run = run
+        self.num_samples = num_samples
+        self.realtime_samples_per_second = realtime_samples_per_second
+        self.cleanup = cleanup
+
+
+def benchmark(function):
+    """
+    Register the given function, which takes a scale factor and returns a Task, as a benchmark with its own name.
+    """
+    _benchmarks[function.__name__] = function
+    return function
+
+
+def names():
+    """
+    Return a list of the names of the registered benchmarks.
+    """
+    return list(_benchmarks.keys())
+
+
+def run(benchmark_names=None, scale=1, repeat=3):
+    """
+    Run the named benchmarks, or all of them, and return their results.
+
+    Parameters
+    ----------
+    benchmark_names : iterable of str or None
+        The benchmarks to run; if None, run every registered benchmark.
+    scale : int
+        The size of each dataset relative to the default.
+    repeat : int
+        The number of timed runs of each benchmark; the fastest is reported.
+
+    Returns
+    -------
+    OrderedDict
+        Maps benchmark name to a dict of results; see run_one().
+    """
+    if benchmark_names is None:
+        benchmark_names = names()
+    results = OrderedDict()
+    for name in benchmark_names:
+        logger.info("Running benchmark %s" % name)
+        results[name] = run_one(name, scale=scale, repeat=repeat)
+    return results
+
+
+def run_one(name, scale=1, repeat=3):
+    """
+    Set up and run one benchmark, and return its results as a dict.
+
+    The dict has the key 'unavailable' or 'error' with a message if the benchmark could not run. Otherwise it has
+    seconds, the time of the fastest run; num_samples; samples_per_second; peak_memory_mb; and realtime_factor, which
+    is None for a benchmark that does not have to keep up with the hardware.
+    """
+    try:
+        task = _benchmarks[name](scale)
+    except Unavailable as e:
+        return {'unavailable': str(e)}
+    except Exception:
+        logger.exception("Benchmark %s failed during setup" % name)
+        return {'error': traceback.format_exc()}
+    try:
+        gc.collect()
+        reset = _reset_peak_memory()
+        initial_memory = _current_memory_bytes() if reset else _peak_memory_bytes()
+        times = []
+        for repetition in range(repeat):
+            start = timeit.default_timer()
+            task.run()
+            times.append(timeit.default_timer() - start)
+        peak_memory = _peak_memory_bytes()
+    except Exception:
+        logger.exception("Benchmark %s failed" % name)
+        return {'error': traceback.format_exc()}
+    finally:
+        if task.cleanup is not None:
+            task.cleanup()
+    seconds = min(times)
+    samples_per_second = task.num_samples / seconds
+    if task.realtime_samples_per_second:
+        realtime_factor = samples_per_second / task.realtime_samples_per_second
+    else:
+        realtime_factor = None
+    return {'seconds': seconds,
+            'num_samples': task.num_samples,
+            'samples_per_second': samples_per_second,
+            'peak_memory_mb': max(0, peak_memory - initial_memory) / 2 ** 20,
+            'realtime_factor': realtime_factor}
+
+
+def compare(results, baseline, tolerance=0.2, memory_slack_mb=1.0):
+    """
+    Return an OrderedDict that maps the name of each benchmark that regressed relative to the baseline to a dict of
+    the regressed metrics. The key 'samples_per_second' is present if the throughput fell by more than the given
+    fraction, and its value is the ratio of the current and baseline throughput. The key 'peak_memory_mb' is present if
+    the peak memory rose by more than the given fraction and by more than memory_slack_mb, which keeps allocator noise
+    in small peaks from counting, and its value is the ratio of the current and baseline peak memory. Benchmarks
+    missing from either are ignored.
+    """
+    regressions = OrderedDict()
+    for name, result in results.items():
+        reference = baseline.get(name, {})
+        regressed = {}
+        if 'samples_per_second' in result and 'samples_per_second' in reference:
+            ratio = result['samples_per_second'] / reference['samples_per_second']
+            if ratio < 1 - tolerance:
+                regressed['samples_per_second'] = ratio
+        if 'peak_memory_mb' in result and 'peak_memory_mb' in reference:
+            current = result['peak_memory_mb']
+            previous = reference['peak_memory_mb']
+            if current > previous * (1 + tolerance) and current - previous > memory_slack_mb:
+                regressed['peak_memory_mb'] = current / previous if previous else float('inf')
+        if regressed:
+            regressions[name] = regressed
+    return regressions
+
+
+def save_baseline(filename, results, scale):
+    """
+    Write the given results to a JSON file, with the scale and a description of the machine.
+    """
+    contents = {'scale': scale,
+                'hostname': socket.gethostname(),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'results': results}
+    with open(filename, 'w') as f:
+        json.dump(contents, f, indent=2, sort_keys=True)
+
+
+def load_baseline(filename, scale=None):
+    """
+    Return the results stored in a JSON file by save_baseline(). If a scale is given and differs from the scale of the
+    baseline, raise a ValueError, because the throughput depends on the size of the dataset.
+    """
+    with open(filename) as f:
+        contents = json.load(f)
+    if scale is not None and contents['scale'] != scale:
+        raise ValueError("Baseline %s has scale %s, not %s" % (filename, contents['scale'], scale))
+    if contents['hostname'] != socket.gethostname():
+        logger.warning("Baseline %s is from %s, not this machine" % (filename, contents['hostname']))
+    return contents['results']
+
+
+def format_results(results, baseline=None):
+    """
+    Return a table of the given results as a string, with the ratio to the baseline throughput if one is given.
+    """
+    lines = ['%-36s %12s %14s %10s %10s %10s' % ('benchmark', 'seconds', 'samples/s', 'realtime', 'peak MB',
+                                                  'baseline')]
+    for name, result in results.items():
+        if 'samples_per_second' not in result:
+            message = result.get('unavailable', 'error; see the log')
+            lines.append('%-36s %s' % (name, message.strip().splitlines()[-1]))
+            continue
+        if result['realtime_factor'] is None:
+            realtime = '-'
+        else:
+            realtime = '%.2f' % result['realtime_factor']
+        reference = (baseline or {}).get(name, {})
+        if 'samples_per_second' in reference:
+            ratio = '%.2f' % (result['samples_per_second'] / reference['samples_per_second'])
+        else:
+            ratio = '-'
+        lines.append('%-36s %12.4g %14.4g %10s %10.1f %10s' % (name, result['seconds'], result['samples_per_second'],
+                                                               realtime, result['peak_memory_mb'], ratio))
+    return '\n'.join(lines)
+
+
+def _read_proc_status(key):
+    # Return a memory size in bytes from /proc/self/status, or None if it is not available.
+    try:
+        with open('/proc/self/status') as f:
+            match = re.search(r'^%s:\s+(\d+) kB' % key, f.read(), re.MULTILINE)
+    except IOError:
+        return None
+    if match is None:
+        return None
+    return 1024 * int(match.group(1))
+
+
+def _reset_peak_memory():
+    # Return True if the peak resident set size of the process was reset to its current size.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return False
+    return _read_proc_status('VmHWM') is not None
+
+
+def _current_memory_bytes():
+    return _read_proc_status('VmRSS')
+
+
+def _peak_memory_bytes():
+    peak = _read_proc_status('VmHWM')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':  # Linux reports kilobytes and OS X reports bytes.
+            peak *= 1024
+    return peak
@@ -0,0 +1,343 @@
+"""
+The benchmarks of the readout chain, on pinned synthetic datasets.
+
+The packets are encoded from a SimulatedSystem by the packet classes of roach.tests.simulated_roach for interfaces
+with fixed configurations, and every random number comes from a fixed seed, so a dataset is the same on every run at a
+given scale. The default scale makes each benchmark take a fraction of a second.
+"""
+from __future__ import division
+import shutil
+import itertools
+import tempfile
+
+import numpy as np
+
+from kid_readout.analysis.resonator import lmfit_resonator
+from kid_readout.benchmark.core import benchmark, Task, Unavailable
+from kid_readout.measurement import basic
+from kid_readout.measurement.io import nc, npy
+from kid_readout.measurement.test import utilities
+from kid_readout.roach import calculate, udp_catcher, r2_udp_catcher
+from kid_readout.roach.heterodyne import RoachHeterodyne
+from kid_readout.roach.r2heterodyne import Roach2Heterodyne
+from kid_readout.roach.tests.mock_roach import MockRoach
+from kid_readout.roach.tests.mock_valon import MockValon
+from kid_readout.roach.tests.simulated_roach import (SimulatedRoach, SimulatedSystem, SimulatedResonator,
+                                                     SimulatedChannels, Roach1Packets, Roach2Packets)
+
+NUM_CHANNELS = 16
+NUM_TONE_SAMPLES = 2 ** 16
+LO_FREQUENCY = 1000.
+# The tones are spread over +/- 100 MHz around the LO, in MHz.
+TONE_OFFSETS = np.linspace(-100, 100, NUM_CHANNELS) + 0.0123
+# The number of packets decoded at scale 1, which is about 4 MB of data.
+NUM_PACKETS = 1024
+# The number of samples per channel of the streams used by the IO and analysis benchmarks at scale 1.
+NUM_STREAM_SAMPLES = 2 ** 17
+STREAMID = 1
+
+
+def _system():
+    resonators = [SimulatedResonator(1e6 * (LO_FREQUENCY + offset) + 20e3, 2e4, 4e4) for offset in TONE_OFFSETS]
+    return SimulatedSystem(resonators=resonators, noise=10, glitch_rate=10, seed=0)
+
+
+def _interface(cls, roach=None, **kwargs):
+    if roach is None:
+        roach = MockRoach('roach')
+    ri = cls(roach=roach, initialize=False, adc_valon=MockValon(), **kwargs)
+    ri.lo_frequency = LO_FREQUENCY
+    ri.set_tone_freqs(LO_FREQUENCY + TONE_OFFSETS, nsamp=NUM_TONE_SAMPLES)
+    ri.select_fft_bins(np.arange(NUM_CHANNELS))
+    return ri
+
+
+def _roach2_interface():
+    return _interface(Roach2Heterodyne, lo_valon=MockValon())
+
+
+def _realtime_rate(ri):
+    # The rate of complex samples from all of the channels together.
+    return calculate.stream_sample_rate(ri.get_state()) * NUM_CHANNELS
+
+
+def _encode(ri, packets, num_packets):
+    channels = SimulatedChannels(ri, _system())
+    encoded = []
+    first_sample = 0
+    while len(encoded) < num_packets:
+        encoded.extend(packets.encode(channels.raw(first_sample, packets.samples_per_group), first_sample,
+                                      initial_counter=0))
+        first_sample += packets.samples_per_group
+    return encoded[:num_packets]
+
+
+def roach1_packets(num_packets):
+    """
+    Return the RoachHeterodyne used to encode them and a list of ROACH1 packets.
+    """
+    ri = _interface(RoachHeterodyne)
+    return ri, _encode(ri, Roach1Packets(ri, streamid=STREAMID), num_packets)
+
+
+def roach2_packets(num_packets):
+    """
+    Return the Roach2Heterodyne used to encode them and a list of ROACH2 packets.
+    """
+    ri = _roach2_interface()
+    return ri, _encode(ri, Roach2Packets(ri), num_packets)
+
+
+def sweep_stream(num_stream_samples):
+    """
+    Return a SingleSweepStream with a resonance in the sweep and glitches in the stream.
+    """
+    np.random.seed(0)
+    frequency = 100.
+    resonator = SimulatedResonator(1e6 * frequency + 10e3, 5e3, 1e4)
+    system = SimulatedSystem(resonators=[resonator], glitch_rate=10, glitch_fraction=1e-4, seed=0)
+    sweep_array = utilities.fake_sweep_array(num_tones=1, num_waveforms=64, length_seconds=0.001)
+    for stream_array in sweep_array.stream_arrays:
+        s21 = system.s21(stream_array.frequency, 0)
+        stream_array.s21_raw[:] = s21.T + 1e-3 * system.amplifier_noise(stream_array.s21_raw.shape)
+    stream_array = utilities.fake_stream_array(num_tones=1, length_seconds=0.01)
+    sample_rate = stream_array.stream_sample_rate
+    stream_array.s21_raw = (system.s21(stream_array.frequency, np.arange(num_stream_samples) / sample_rate).T
+                            + 1e-3 * system.amplifier_noise((1, num_stream_samples))).astype('complex64')
+    return basic.SingleSweepStream(sweep=sweep_array[0], stream=stream_array[0])
+
+
+@benchmark
+def roach1_decode(scale):
+    """
+    Decode ROACH1 packets with udp_catcher.decode_packets().
+    """
+    ri, packets = roach1_packets(NUM_PACKETS * scale)
+    channel_ids = (ri.fpga_fft_readout_indexes // 2 + 1) % (ri.nfft // 2)
+
+    def run():
+        udp_catcher.decode_packets(packets, STREAMID, channel_ids, ri.nfft // 2)
+
+    return Task(run, num_samples=len(packets) * Roach1Packets.samples_per_packet,
+                realtime_samples_per_second=_realtime_rate(ri))
+
+
+@benchmark
+def roach2_decode(scale):
+    """
+    Decode ROACH2 packets with r2_udp_catcher.decode_packets().
+    """
+    ri, packets = roach2_packets(NUM_PACKETS * scale)
+
+    def run():
+        r2_udp_catcher.decode_packets(packets, NUM_CHANNELS, ri.fpga_cycles_per_filterbank_frame)
+
+    # The first packet is discarded.
+    return Task(run, num_samples=(len(packets) - 1) * Roach2Packets.samples_per_packet,
+                realtime_samples_per_second=_realtime_rate(ri))
+
+
+@benchmark
+def roach2_decode_fast(scale):
+    """
+    Decode ROACH2 packets with the compiled decode.decode_packets_fast().
+    """
+    if not r2_udp_catcher.have_decode:
+        raise Unavailable("decode.pyx is not compiled; run python setup.py build_ext --inplace")
+    ri, packets = roach2_packets(NUM_PACKETS * scale)
+
+    def run():
+        r2_udp_catcher.decode.decode_packets_fast(packets, NUM_CHANNELS)
+
+    return Task(run, num_samples=(len(packets) - 1) * Roach2Packets.samples_per_packet,
+                realtime_samples_per_second=_realtime_rate(ri))
+
+
+@benchmark
+def roach2_demodulate(scale):
+    """
+    Demodulate decoded ROACH2 data one channel at a time with a Demodulator.
+    """
+    ri, packets = roach2_packets(NUM_PACKETS * scale)
+    data, seq_nos, num_bad, num_dropped = r2_udp_catcher.decode_packets(packets, NUM_CHANNELS,
+                                                                         ri.fpga_cycles_per_filterbank_frame)
+    ri.phase0 = seq_nos[0]
+
+    def run():
+        ri._demodulate_raw_data(data, seq_nos)
+
+    return Task(run, num_samples=data.size, realtime_samples_per_second=_realtime_rate(ri))
+
+
+@benchmark
+def roach2_demodulate_stream(scale):
+    """
+    Demodulate decoded ROACH2 data, all channels at once, with a StreamDemodulator.
+    """
+    ri, packets = roach2_packets(NUM_PACKETS * scale)
+    data, seq_nos, num_bad, num_dropped = r2_udp_catcher.decode_packets(packets, NUM_CHANNELS,
+                                                                         ri.fpga_cycles_per_filterbank_frame)
+    stream_demodulator = ri.get_stream_demodulator()
+
+    def run():
+        stream_demodulator.demodulate_stream(data, seq_nos)
+
+    return Task(run, num_samples=data.size, realtime_samples_per_second=_realtime_rate(ri))
+
+
+@benchmark
+def roach2_decode_and_demodulate_stream(scale):
+    """
+    Decode and demodulate ROACH2 packets in one pass with StreamDemodulator.decode_and_demodulate_packets().
+    """
+    ri, packets = roach2_packets(NUM_PACKETS * scale)
+    stream_demodulator = ri.get_stream_demodulator()
+
+    def run():
+        stream_demodulator.decode_and_demodulate_packets(packets)
+
+    return Task(run, num_samples=len(packets) * Roach2Packets.samples_per_packet,
+                realtime_samples_per_second=_realtime_rate(ri))
+
+
+def stream_array(num_samples):
+    """
+    Return a StreamArray of noise with the given total number of samples in NUM_CHANNELS channels.
+    """
+    np.random.seed(0)
+    stream_array = utilities.fake_stream_array(num_tones=NUM_CHANNELS, length_seconds=0.01)
+    num_samples_per_channel = num_samples // NUM_CHANNELS
+    num_copies = -(-num_samples_per_channel // stream_array.s21_raw.shape[1])
+    stream_array.s21_raw = np.tile(stream_array.s21_raw, num_copies)[:, :num_samples_per_channel]
+    return stream_array
+
+
+def _io_write(io_class, extension, scale):
+    data = stream_array(NUM_STREAM_SAMPLES * NUM_CHANNELS * scale)
+    directory = tempfile.mkdtemp()
+    filenames = ('%s/%d%s' % (directory, number, extension) for number in itertools.count())
+
+    def run():
+        io = io_class(next(filenames))
+        io.write(data, 'stream_array')
+        io.close()
+
+    return Task(run, num_samples=data.s21_raw.size, cleanup=lambda: shutil.rmtree(directory))
+
+
+def _io_read(io_class, extension, scale):
+    data = stream_array(NUM_STREAM_SAMPLES * NUM_CHANNELS * scale)
+    directory = tempfile.mkdtemp()
+    filename = '%s/0%s' % (directory, extension)
+    io = io_class(filename)
+    io.write(data, 'stream_array')
+    io.close()
+
+    def run():
+        io = io_class(filename)
+        np.asarray(io.read('stream_array').s21_raw[:])
+        io.close()
+
+    return Task(run, num_samples=data.s21_raw.size, cleanup=lambda: shutil.rmtree(directory))
+
+
+@benchmark
+def nc_write(scale):
+    """
+    Write a StreamArray to a new NCFile.
+    """
+    return _io_write(nc.NCFile, '.nc', scale)
+
+
+@benchmark
+def nc_read(scale):
+    """
+    Read a StreamArray, including all of its data, from an NCFile.
+    """
+    return _io_read(nc.NCFile, '.nc', scale)
+
+
+@benchmark
+def npy_write(scale):
+    """
+    Write a StreamArray to a new NumpyDirectory.
+    """
+    return _io_write(npy.NumpyDirectory, '', scale)
+
+
+@benchmark
+def npy_read(scale):
+    """
+    Read a StreamArray, including all of its data, from a NumpyDirectory.
+    """
+    return _io_read(npy.NumpyDirectory, '', scale)
+
+
+@benchmark
+def resonator_fit(scale):
+    """
+    Fit LinearResonatorWithCable models to NUM_CHANNELS * scale sweeps, cycling through the resonators of the system.
+    """
+    system = _system()
+    sweeps = []
+    for resonator in itertools.islice(itertools.cycle(system.resonators), NUM_CHANNELS * scale):
+        frequency = resonator.f_0 * (1 + np.linspace(-5, 5, 101) / resonator.Q)
+        s21 = system.s21(frequency, 0)[0] + 1e-3 * system.amplifier_noise(frequency.size) / system.noise
+        sweeps.append((frequency, s21))
+    errors = 1e-3 * (1 + 1j) * np.ones(sweeps[0][0].size)
+
+    def run():
+        for frequency, s21 in sweeps:
+            lmfit_resonator.LinearResonatorWithCable(frequency=frequency, s21=s21, errors=errors)
+
+    return Task(run, num_samples=sum([frequency.size for frequency, s21 in sweeps]))
+
+
+@benchmark
+def deglitch(scale):
+    """
+    Find and replace the glitches in a stream with SingleSweepStream.deglitch().
+    """
+    sss = sweep_stream(NUM_STREAM_SAMPLES * scale)
+    # Fit the resonator and calculate x_raw and q_raw outside of the timed run.
+    sss.deglitch()
+    if not sss.number_of_masked_samples:
+        raise RuntimeError("The glitches were not found, so deglitching did not run.")
+
+    def run():
+        sss.deglitch()
+
+    return Task(run, num_samples=sss.stream.s21_raw.size)
+
+
+@benchmark
+def set_S(scale):
+    """
+    Calculate the spectral densities of a stream with SingleSweepStream.set_S().
+    """
+    sss = sweep_stream(NUM_STREAM_SAMPLES * scale)
+    sss.deglitch()
+
+    def run():
+        sss.set_S()
+
+    return Task(run, num_samples=sss.stream.s21_raw.size)
+
+
+@benchmark
+def simulated_capture(scale):
+    """
+    Capture, decode and demodulate a stream from a SimulatedRoach, through RoachHeterodyne.get_measurement(). The
+    simulator sends packets at the hardware rate, so the real-time factor is at most one; the shortfall is the time
+    spent starting and ending the capture, and any gaps in the data mean that the capture did not keep up.
+    """
+    sim = SimulatedRoach('roach', system=_system(), seed=0)
+    ri = _interface(RoachHeterodyne, roach=sim, host_ip='127.0.0.1')
+    sim.attach(ri)
+    num_seconds = 0.1 * scale
+    num_samples = ri.get_measurement(num_seconds).s21_raw.size
+
+    def run():
+        ri.get_measurement(num_seconds)
+
+    return Task(run, num_samples=num_samples, realtime_samples_per_second=_realtime_rate(ri), cleanup=sim.close)
@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+
+from kid_readout.benchmark import core, suite  # Importing the suite registers its benchmarks.
+
+
+def test_suite():
+    results = core.run(scale=1, repeat=1)
+    assert core.names() == list(results.keys())
+    for name, result in results.items():
+        assert 'error' not in result, name
+        if 'unavailable' not in result:
+            assert result['samples_per_second'] > 0
+            assert result['peak_memory_mb'] >= 0
+    assert results['roach1_decode']['realtime_factor'] > 0
+    assert results['nc_write']['realtime_factor'] is None
+    assert 'nc_read' in core.format_results(results, baseline=results)
+
+
+def test_baseline():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'baseline.json')
+        results = core.run(['roach2_decode', 'roach2_decode_fast'], scale=1, repeat=1)
+        core.save_baseline(filename, results, scale=1)
+        baseline = core.load_baseline(filename, scale=1)
+        assert not core.compare(results, baseline)
+        baseline['roach2_decode']['samples_per_second'] *= 2
+        regressions = core.compare(results, baseline, tolerance=0.2)
+        assert list(regressions.keys()) == ['roach2_decode']
+        assert list(regressions['roach2_decode'].keys()) == ['samples_per_second']
+        baseline['roach2_decode']['samples_per_second'] /= 2
+        results['roach2_decode']['peak_memory_mb'] = baseline['roach2_decode']['peak_memory_mb'] * 2 + 10
+        regressions = core.compare(results, baseline, tolerance=0.2)
+        assert list(regressions['roach2_decode'].keys()) == ['peak_memory_mb']
+        assert not core.compare(results, baseline, memory_slack_mb=100)
+        try:
+            core.load_baseline(filename, scale=2)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_failures():
+    def broken(scale):
+        return core.Task(lambda: 1 / 0, num_samples=1)
+
+    core.benchmark(broken)
+    try:
+        assert 'ZeroDivisionError' in core.run_one('broken', repeat=1)['error']
+    finally:
+        del core._benchmarks['broken']
+
+
+def test_resonator_fit_scale():
+    assert suite.resonator_fit(2).num_samples == 2 * suite.resonator_fit(1).num_samples
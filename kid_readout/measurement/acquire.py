@@ -30,13 +30,15 @@ import time
 import inspect
 import subprocess
 import logging
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
 from kid_readout import settings
-from kid_readout.utils import log
+from kid_readout.utils import log, timing
 from kid_readout.measurement import core, basic
 from kid_readout.measurement.io import nc, npy
+from kid_readout.analysis.resonator.find_resonators import estimate_resonance
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +52,7 @@ def load_heterodyne_sweep_tones(ri, tone_banks, num_tone_samples):
     return ri.set_tone_freqs(freqs=np.vstack(tone_banks), nsamp=num_tone_samples)
 
 
+@timing.recorded
 def run_sweep(ri, tone_banks, num_tone_samples, length_seconds=0, state=None, description='', verbose=False,
               wait_for_sync=0.1, **kwargs):
     """
@@ -90,16 +93,208 @@ def run_sweep(ri, tone_banks, num_tone_samples, length_seconds=0, state=None, de
             sys.stdout.flush()
         ri.set_tone_freqs(tone_bank, nsamp=num_tone_samples)
         ri.select_fft_bins(np.arange(tone_bank.size))
-        # we wait a bit here to let the roach2 sync catch up.  figuring this out still.
-        time.sleep(wait_for_sync)
+        # we wait a bit here to let the roach2 sync catch up.
+        with timing.span('sync_wait'):
+            time.sleep(wait_for_sync)
         stream_arrays.append(ri.get_measurement(num_seconds=length_seconds, **kwargs))
     return basic.SweepArray(stream_arrays, state=state, description=description)
 
 
+@timing.recorded
+def run_pipelined_sweep(ri, tone_banks, num_tone_samples, length_seconds=0, state=None, description='', verbose=False,
+                        wait_for_sync=0.1, poll_sync=False, **kwargs):
+    """
+    Return a SweepArray acquired using the given tone banks, like run_sweep(), but faster.
+
+    Banks of equal size are loaded together, as many at a time as fit in the ROACH memory, so that moving to the next
+    bank only requires selecting it. The data from each bank is demodulated in a background thread while the next bank
+    is selected and captured. The tones in each group of banks share one waveform normalization, as they do in
+    run_loaded_sweep().
+
+    Parameters
+    ----------
+    ri : RoachInterface
+        An instance of a subclass.
+    tone_banks : iterable of ndarray (float)
+        An iterable of arrays (or a 2-D array) of frequencies to use for the sweep.
+    num_tone_samples : int
+        The number of samples in the playback buffer; must be a power of two.
+    length_seconds : float
+        The duration of each data stream; the default of 0 means the minimum unit of data that can be read out in the
+        current configuration.
+    state : dict
+        The non-roach state to pass to the SweepArray.
+    description : str
+        A human-readable description of the measurement.
+    verbose : bool
+        If true, print progress messages.
+    wait_for_sync : float
+        Sleep for this time in seconds to let the ROACH sync finish, or wait at most this time if poll_sync is True.
+    poll_sync : bool
+        If True, poll the ROACH until its output buffer has switched twice instead of sleeping for wait_for_sync; see
+        RoachInterface.wait_for_sync(). This has not yet been validated on hardware.
+    kwargs
+        Keyword arguments passed to ri.get_measurement().
+
+    Returns
+    -------
+    SweepArray
+    """
+    tone_banks = [np.asarray(tone_bank) for tone_bank in tone_banks]
+    if len(set([tone_bank.size for tone_bank in tone_banks])) == 1:
+        banks_per_load = max(1, ri.max_num_waveforms(num_tone_samples))
+    else:
+        banks_per_load = 1
+
+    def select_banks():
+        for start in range(0, len(tone_banks), banks_per_load):
+            group = tone_banks[start:start + banks_per_load]
+            ri.set_tone_freqs(np.vstack(group), nsamp=num_tone_samples)
+            for index, tone_bank in enumerate(group):
+                ri.select_bank(index)
+                ri.select_fft_bins(np.arange(tone_bank.size))
+                yield start + index
+
+    if verbose:
+        print("Measuring bank")
+    stream_arrays = _measure_banks(ri, select_banks(), length_seconds=length_seconds, wait_for_sync=wait_for_sync,
+                                   poll_sync=poll_sync, verbose=verbose, **kwargs)
+    return basic.SweepArray(stream_arrays, state=state, description=description)
+
+
+@timing.recorded
+def run_adaptive_sweep(ri, center_frequencies, span, num_tone_samples, num_coarse_banks=8, num_fine_banks=16,
+                       span_linewidths=4, length_seconds=0, state=None, description='', verbose=False,
+                       wait_for_sync=0.1, poll_sync=False, **kwargs):
+    """
+    Return a SweepArray whose points are concentrated near the resonances.
+
+    A coarse sweep of num_coarse_banks evenly spaced banks covers the given span around each center frequency. The
+    resonance frequency and linewidth of each channel are estimated from it (see estimate_resonance), and the fine
+    banks are placed around the estimates by adaptive_tone_banks(). A channel whose estimate fails, or falls outside
+    the coarse span, gets fine banks spread evenly across the coarse span instead. Both passes use
+    run_pipelined_sweep(), and the returned SweepArray contains the coarse streams followed by the fine streams.
+
+    Parameters
+    ----------
+    ri : RoachInterface
+        An instance of a subclass.
+    center_frequencies : numpy.ndarray (float)
+        The center frequency of each channel, in MHz.
+    span : float
+        The width of the coarse sweep, in MHz.
+    num_tone_samples : int
+        The number of samples in the playback buffer; must be a power of two.
+    num_coarse_banks, num_fine_banks : int
+        The number of tone banks in each pass.
+    span_linewidths : float
+        The fine banks cover this many estimated linewidths around each resonance.
+    length_seconds, state, description, verbose, wait_for_sync, poll_sync, kwargs
+        As in run_pipelined_sweep().
+
+    Returns
+    -------
+    SweepArray
+    """
+    center_frequencies = np.asarray(center_frequencies, dtype='float')
+    offsets = np.linspace(-span / 2, span / 2, num_coarse_banks)
+    coarse = run_pipelined_sweep(ri, [center_frequencies + offset for offset in offsets], num_tone_samples,
+                                 length_seconds=length_seconds, state=state, description=description,
+                                 verbose=verbose, wait_for_sync=wait_for_sync, poll_sync=poll_sync,
+                                 **kwargs)
+    f_r = center_frequencies.copy()
+    linewidth = (span / span_linewidths) * np.ones_like(center_frequencies)
+    for number in range(coarse.num_channels):
+        single_sweep = coarse.sweep(number)
+        frequency = single_sweep.frequency_MHz
+        estimated_f_r, estimated_linewidth = estimate_resonance(frequency, single_sweep.s21_point)
+        if frequency.min() <= estimated_f_r <= frequency.max() and estimated_linewidth < span:
+            f_r[number] = estimated_f_r
+            linewidth[number] = estimated_linewidth
+        else:
+            logger.debug("Channel %d has no resonance estimate; sweeping the coarse span" % number)
+    # The points nearest resonance can't be closer than the tone frequency resolution.
+    minimum_linewidth = ((num_fine_banks - 1) / np.arctan(span_linewidths)) * ri.fs / num_tone_samples
+    tone_banks = adaptive_tone_banks(f_r, np.maximum(linewidth, minimum_linewidth), num_fine_banks,
+                                     span_linewidths=span_linewidths)
+    fine = run_pipelined_sweep(ri, tone_banks, num_tone_samples, length_seconds=length_seconds, state=state,
+                               description=description, verbose=verbose, wait_for_sync=wait_for_sync,
+                               poll_sync=poll_sync, **kwargs)
+    return basic.SweepArray(core.MeasurementList(list(coarse.stream_arrays) + list(fine.stream_arrays)), state=state,
+                            description=description)
+
+
+def adaptive_tone_banks(f_r, linewidth, num_tone_banks, span_linewidths=4):
+    """
+    Return tone banks that sample each resonance at evenly spaced angles around its resonance circle.
+
+    The points for each channel are f_r + (linewidth / 2) tan(theta), with theta evenly spaced between
+    -arctan(span_linewidths) and arctan(span_linewidths). More than half of the points fall between the half-maximum
+    frequencies, where the data constrain the fit most, and the rest cover span_linewidths linewidths in all.
+
+    Parameters
+    ----------
+    f_r : numpy.ndarray (float)
+        The resonance frequency of each channel.
+    linewidth : numpy.ndarray (float)
+        The full width at half maximum of each channel, in the same units as f_r.
+    num_tone_banks : int
+        The number of banks.
+    span_linewidths : float
+        The total width of each channel's points, in linewidths.
+
+    Returns
+    -------
+    list of numpy.ndarray (float)
+        The banks, each with one frequency per channel.
+    """
+    theta_max = np.arctan(span_linewidths)
+    offsets = np.tan(np.linspace(-theta_max, theta_max, num_tone_banks)) / 2
+    return [np.asarray(f_r) + offset * np.asarray(linewidth) for offset in offsets]
+
+
+def _measure_banks(ri, selected_banks, length_seconds, wait_for_sync, poll_sync, verbose, **kwargs):
+    """
+    Return a MeasurementList containing one StreamArray for each bank selected by iterating over selected_banks, which
+    yields a number for each bank after selecting it. The data from each bank is demodulated in a worker thread while
+    the next bank is captured. After each bank is selected, this sleeps for wait_for_sync seconds, or if poll_sync is
+    True polls the ROACH for at most that time.
+    """
+    power_of_two = kwargs.pop('power_of_two', True)
+    demod = kwargs.pop('demod', True)
+    stream_arrays = core.MeasurementList()
+    pool = ThreadPool(1)
+    try:
+        pending = None
+        for bank_number in selected_banks:
+            if verbose:
+                print bank_number,
+                sys.stdout.flush()
+            if wait_for_sync:
+                if poll_sync:
+                    ri.wait_for_sync(wait_for_sync)
+                else:
+                    with timing.span('sync_wait'):
+                        time.sleep(wait_for_sync)
+            capture = ri.capture_measurement(num_seconds=length_seconds, power_of_two=power_of_two, demod=demod)
+            # Collecting the previous bank before submitting this one keeps at most two captures in memory.
+            if pending is not None:
+                stream_arrays.append(pending.get())
+            pending = pool.apply_async(capture.finish, kwds=kwargs)
+        if pending is not None:
+            stream_arrays.append(pending.get())
+    finally:
+        pool.close()
+        pool.join()
+    return stream_arrays
+
+
+@timing.recorded
 def run_loaded_sweep(ri, length_seconds=0, state=None, description='', tone_bank_indices=None, bin_indices=None,
-                     verbose=False, **kwargs):
+                     verbose=False, wait_for_sync=0, poll_sync=False, **kwargs):
     """
-    Return a SweepArray acquired using previously-loaded tones.
+    Return a SweepArray acquired using previously-loaded tones. The data from each bank is demodulated while the next
+    bank is captured.
 
     Parameters
     ----------
@@ -118,6 +313,11 @@ def run_loaded_sweep(ri, length_seconds=0, state=None, description='', tone_bank
         The indices of the filterbank bins to read out; the default is to read out all bins.
     verbose : bool
         If true, print progress messages.
+    wait_for_sync : float
+        Sleep for this time in seconds after selecting each bank to let the ROACH sync finish; the default of 0 means
+        no wait.
+    poll_sync : bool
+        As in run_pipelined_sweep().
     kwargs
         Keyword arguments passed to ri.get_measurement().
 
@@ -129,19 +329,21 @@ def run_loaded_sweep(ri, length_seconds=0, state=None, description='', tone_bank
         tone_bank_indices = np.arange(ri.tone_bins.shape[0])
     if bin_indices is None:
         bin_indices = np.arange(ri.tone_bins.shape[1])
-    stream_arrays = core.MeasurementList()
+
+    def select_banks():
+        for tone_bank_index in tone_bank_indices:
+            ri.select_bank(tone_bank_index)
+            ri.select_fft_bins(bin_indices)
+            yield tone_bank_index
+
     if verbose:
         print "Measuring bank:",
-    for tone_bank_index in tone_bank_indices:
-        if verbose:
-            print tone_bank_index,
-            sys.stdout.flush()
-        ri.select_bank(tone_bank_index)
-        ri.select_fft_bins(bin_indices)
-        stream_arrays.append(ri.get_measurement(num_seconds=length_seconds, **kwargs))
+    stream_arrays = _measure_banks(ri, select_banks(), length_seconds=length_seconds, wait_for_sync=wait_for_sync,
+                                   poll_sync=poll_sync, verbose=verbose, **kwargs)
     return basic.SweepArray(stream_arrays, state=state, description=description)
 
 
+@timing.recorded
 def run_multipart_sweep(ri, length_seconds=0, state=None, description='', num_tones_read_at_once=32, verbose=False,
                         **kwargs):
     num_tones = ri.tone_bins.shape[1]
@@ -3,7 +3,7 @@ This module contains basic measurement classes for data acquired with the ROACH.
 """
 from __future__ import division
 import time
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import logging
 
 import numpy as np
@@ -13,13 +13,48 @@ from scipy import signal
 from memoized_property import memoized_property
 
 from kid_readout.measurement import core
-from kid_readout.analysis.resonator import lmfit_resonator
+from kid_readout.analysis import scan
+from kid_readout.analysis.resonator import lmfit_resonator, find_resonators
 from kid_readout.analysis.timeseries import binning, despike, iqnoise, periodic
 from kid_readout.roach import calculate
 
 logger = logging.getLogger(__name__)
 
 
+SpectralDensities = namedtuple('SpectralDensities', field_names=['frequency', 'edges', 'counts', 'S_xx', 'S_qq', 'S_xq',
+                                                                 'S_xx_variance', 'S_qq_variance', 'S_xq_variance'])
+
+
+def _drop_dc_and_bin(f, S_xx, S_qq, S_xq, ndof, binned, bins_per_decade):
+    """
+    Drop the DC and Nyquist bins from the given spectral densities, estimate their variances, and log-bin them if
+    requested. Frequency is the last axis of the spectra, so all channels of an array are binned together.
+    """
+    # Drop the DC and Nyquist bins since they're not helpful and make plots look messy.
+    f = f[1:-1]
+    S_xx = S_xx[..., 1:-1]
+    S_qq = S_qq[..., 1:-1]
+    S_xq = S_xq[..., 1:-1]
+    # The value in each bin is chi-squared distributed with degrees of freedom equal to two times the number of
+    # spectra that are averaged. Assume that the variance of the value in a bin is equal to the square of the value
+    # in that bin divided by the number of degrees of freedom. Using nonzero overlap will complicate this, but let's
+    # ignore that. It's also not clear that this is correct for the cross-spectrum.
+    if binned:
+        edges, counts, f_mean, d_and_v = binning.log_bin_with_variance(f, bins_per_decade,
+                                                                       (S_xx, S_xx**2 / ndof),
+                                                                       (S_qq, S_qq**2 / ndof),
+                                                                       (S_xq, S_xq**2 / ndof))
+        (S_xx, V_xx), (S_qq, V_qq), (S_xq, V_xq) = d_and_v
+    else:
+        edges = None
+        counts = np.ones(f.size, dtype=int)
+        f_mean = f
+        V_xx = S_xx**2 / ndof
+        V_qq = S_qq**2 / ndof
+        V_xq = S_xq**2 / ndof
+    return SpectralDensities(f_mean, edges, counts, S_xx, S_qq, S_xq, V_xx, V_qq, V_xq)
+
+
 class RoachMeasurement(core.Measurement):
     """
     An abstract base class for measurements taken with the ROACH.
@@ -211,6 +246,16 @@ class RoachStream(RoachMeasurement):
             period_samples = calculate.modulation_period_samples(self.roach_state)
         return periodic.fold(array, period_samples, reduce=reduce)
 
+    def demodulate(self, array, period_samples=None, num_bins=None, harmonic=1):
+        """
+        Fold and lock-in demodulate the given array, which has time along the last axis, for all channels at once.
+
+        See kid_readout.analysis.timeseries.periodic.demodulate() for details.
+        """
+        if period_samples is None:
+            period_samples = calculate.modulation_period_samples(self.roach_state)
+        return periodic.demodulate(array, period_samples, num_bins=num_bins, harmonic=harmonic)
+
     def epochs(self, start=-np.inf, stop=np.inf):
         """
         Return a StreamArray containing only the data between the given start and stop epochs.
@@ -306,16 +351,28 @@ class StreamArray(RoachStream):
         See stream().
         """
         number = int(number)  # Avoid weird indexing bugs
+        # The single-channel view shares the state dictionaries of this array instead of copying and validating them
+        # again, and the array shapes are correct by construction.
         ss = SingleStream(tone_bin=self.tone_bin, tone_amplitude=self.tone_amplitude, tone_phase=self.tone_phase,
                           tone_index=self.tone_index[number], filterbank_bin=self.filterbank_bin[number],
                           epoch=self.epoch, sequence_start_number=self.sequence_start_number,
                           s21_raw=self.s21_raw[number, :], data_demodulated=self.data_demodulated,
-                          roach_state=self.roach_state, number=number, state=self.state,
-                          description=self.description)
+                          roach_state={}, number=number, state=None, description=self.description, validate=False)
+        ss.roach_state = self.roach_state
+        ss.state = self.state
+        # Per-channel values that this array has already calculated for all channels are copied to the view's caches.
+        for name in self._channel_caches:
+            if hasattr(self, '_' + name):
+                setattr(ss, '_' + name, getattr(self, '_' + name)[number])
+        if hasattr(self, '_sample_time'):
+            ss._sample_time = self._sample_time
         ss._io = self._io
         ss._io_node_path = self._io_node_path
         return ss
 
+    # These memoized properties have channel as the first axis.
+    _channel_caches = ('frequency', 'baseband_frequency')
+
     def stream(self, number):
         """
         Return a SingleStream object containing the data from the channel corresponding to the given integer.
@@ -339,10 +396,30 @@ class StreamArray(RoachStream):
         return offset
 
     def to_dataframe(self, add_origin = False):
-        dataframes = []
-        for number in range(self.tone_bin.shape[0]):
-            dataframes.append(self.stream(number).to_dataframe(add_origin=add_origin))
-        return pd.concat(dataframes, ignore_index=True)
+        """
+        Return a dataframe with one row per channel, containing the same values as the SingleStream.to_dataframe()
+        rows for each channel. The state is flattened once and shared by all rows.
+        """
+        num_channels = self.tone_index.size
+        data = {'analysis_epoch': time.time(), 'start_epoch': self.start_epoch()}
+        try:
+            for key, value in self.roach_state.items():
+                data['roach_{}'.format(key)] = value
+        except KeyError:
+            pass
+        data.update(self.state.flatten(wrap_lists=True))
+        for key, value in data.items():
+            if isinstance(value, list):  # flatten() wraps lists so that each row contains the entire list.
+                data[key] = value * num_channels
+        data['number'] = np.arange(num_channels)
+        data['s21_point'] = self.s21_point
+        data['s21_point_error'] = self.s21_point_error
+        data['frequency'] = self.frequency
+        data['frequency_MHz'] = self.frequency_MHz
+        dataframe = pd.DataFrame(data, index=np.arange(num_channels))
+        if add_origin:
+            self.add_origin(dataframe)
+        return dataframe
 
 class StreamArray0(RoachStream0):
     """
@@ -489,8 +566,16 @@ class SweepArray(RoachMeasurement):
         See sweep().
         """
         number = int(number)  # Avoid weird indexing bugs
-        ss = SingleSweep(streams=core.MeasurementList(sa.stream(number) for sa in self.stream_arrays),
-                           number=number, state=self.state, description=self.description)
+        # The s21 points are calculated for all channels of each stream array at once and cached there, so walking all
+        # the channels does this only once.
+        streams = core.MeasurementList()
+        for sa in self.stream_arrays:
+            stream = sa.stream(number)
+            stream._s21_raw_mean = sa.s21_raw_mean[number]
+            stream._s21_raw_mean_error = sa.s21_raw_mean_error[number]
+            streams.append(stream)
+        ss = SingleSweep(streams=streams, number=number, state=None, description=self.description)
+        ss.state = self.state
         ss._io = self._io
         ss._io_node_path = self._io_node_path
         return ss
@@ -550,32 +635,52 @@ class SweepArray(RoachMeasurement):
         """numpy.ndarray[complex]: The raw s21 streams of all data points, in ascending frequency order."""
         return np.vstack([stream_array.s21_raw for stream_array in self.stream_arrays])[self.ascending_order, :]
 
-    @property
+    @memoized_property
     def s21_point_foreground(self):
+        """numpy.ndarray[complex]: The s21_point values divided by the background, in ascending frequency order."""
         return self.s21_point / self.background
 
-    @property
+    @memoized_property
     def s21_point_error_foreground(self):
+        """numpy.ndarray[complex]: The s21_point_error values divided by the background."""
         return self.s21_point_error / self.background
 
-    @property
+    @memoized_property
+    def background_model(self):
+        """
+        kid_readout.analysis.scan.PolynomialBackground: The background fit to all the data by fit_background_model()
+        with its default parameters, unless set by fit_backgrounds().
+        """
+        return self.fit_background_model()
+
+    @memoized_property
     def background(self):
-        return self.fit_background(frequency=self.frequency, s21=self.s21_point)
+        """numpy.ndarray[complex]: The background model evaluated at each frequency."""
+        return self.background_model(self.frequency)
 
-    # ToDo: swap this out for a lmfit model
-    def fit_background(self, frequency=None, s21=None, amp_degree=3, phi_degree=3, weights=None, mask=None):
+    def fit_background_model(self, frequency=None, s21=None, amp_degree=3, phi_degree=3, weights=None, mask=None):
+        """
+        Fit polynomials to the amplitude and phase of the data; see kid_readout.analysis.scan.fit_polynomial_background.
+
+        Returns
+        -------
+        kid_readout.analysis.scan.PolynomialBackground
+        """
         if frequency is None:
             frequency = self.frequency
         if s21 is None:
             s21 = self.s21_point
-        if weights is None:  # Attempt to down-weight resonances
-            weights = np.abs(s21) ** 2
-        if mask is None:
-            mask = np.ones(frequency.size, dtype=np.bool)
-        weights *= mask
-        amp_poly = np.polyfit(frequency, np.abs(s21), deg=amp_degree, w=weights)
-        phi_poly = np.polyfit(frequency, np.unwrap(np.angle(s21)), deg=phi_degree, w=weights)
-        return np.polyval(amp_poly, frequency) * np.exp(1j * np.polyval(phi_poly, frequency))
+        return scan.fit_polynomial_background(frequency=frequency, s21=s21, amp_degree=amp_degree,
+                                              phi_degree=phi_degree, weights=weights, mask=mask)
+
+    def fit_background(self, frequency=None, s21=None, amp_degree=3, phi_degree=3, weights=None, mask=None):
+        """
+        Return the background fit by fit_background_model() evaluated at the given frequencies.
+        """
+        if frequency is None:
+            frequency = self.frequency
+        return self.fit_background_model(frequency=frequency, s21=s21, amp_degree=amp_degree, phi_degree=phi_degree,
+                                         weights=weights, mask=mask)(frequency)
 
     # ToDo: this could be much smarter about identifying large peaks
     def find_peaks(self, expected_Q=30000, num_widths=100, threshold=1, minimum_linewidth_separation=1,
@@ -588,6 +693,17 @@ class SweepArray(RoachMeasurement):
         mask = (width < peaks) & (peaks < data.size - width) & (data[peaks] > threshold * np.std(data))
         return peaks[mask]
 
+    def find_resonators(self, **kwargs):
+        """
+        Find and fit the resonators in this sweep using find_resonators.find_resonators_fast(), to which the keyword
+        arguments are passed.
+
+        Returns
+        -------
+        list(LinearResonatorWithCable)
+        """
+        return find_resonators.find_resonators_fast(self.frequency, self.s21_point, self.s21_point_error, **kwargs)
+
     def resonator(self, frequency, width, model=lmfit_resonator.LinearLossResonatorWithCable):
         mask = (frequency - width / 2 <= self.frequency) & (self.frequency <= frequency + width / 2)
         return model(frequency=self.frequency[mask], s21=self.s21_point_foreground[mask],
@@ -636,6 +752,39 @@ class SweepArray(RoachMeasurement):
         return pd.concat(dataframes, ignore_index=True)
 
 
+def fit_backgrounds(sweep_arrays, amp_degree=3, phi_degree=3):
+    """
+    Fit the backgrounds of several SweepArrays with the same number of points, such as one per power step, in one
+    batched solve, and store each one as the background_model of its SweepArray.
+
+    Parameters
+    ----------
+    sweep_arrays : iterable(SweepArray)
+        The sweeps; their frequencies may differ.
+    amp_degree, phi_degree : int
+        The degrees of the amplitude and phase polynomials.
+
+    Returns
+    -------
+    list(kid_readout.analysis.scan.PolynomialBackground)
+        The background of each SweepArray.
+    """
+    sweep_arrays = list(sweep_arrays)
+    frequency = np.vstack([sa.frequency for sa in sweep_arrays])
+    if np.all(frequency == frequency[0]):
+        frequency = frequency[0]
+    backgrounds = scan.fit_polynomial_background(frequency=frequency,
+                                                 s21=np.vstack([sa.s21_point for sa in sweep_arrays]),
+                                                 amp_degree=amp_degree, phi_degree=phi_degree)
+    models = [backgrounds[index] for index in range(len(sweep_arrays))]
+    for sa, model in zip(sweep_arrays, models):
+        for attr in ('background', 's21_point_foreground', 's21_point_error_foreground'):
+            if hasattr(sa, '_' + attr):
+                delattr(sa, '_' + attr)
+        sa._background_model = model  # This is the memoized_property cache.
+    return models
+
+
 class SingleSweep(RoachMeasurement):
     """
     This class contains a list of SingleStreams with different frequencies.
@@ -802,7 +951,8 @@ class SweepStreamArray(RoachMeasurement):
         """
         number = int(number)  # Avoid weird indexing bugs
         sss = SingleSweepStream(sweep=self.sweep_array.sweep(number), stream=self.stream_array.stream(number),
-                                number=number, state=self.state, description=self.description)
+                                number=number, state=None, description=self.description)
+        sss.state = self.state
         sss._io = self._io
         sss._io_node_path = self._io_node_path
         return sss
@@ -822,6 +972,116 @@ class SweepStreamArray(RoachMeasurement):
         """
         return self[number]
 
+    def x_and_q(self):
+        """
+        Return the deglitched x and q time series of all channels, each calculated by the corresponding
+        SingleSweepStream using the resonator fit for that channel.
+
+        Returns
+        -------
+        x : numpy.ndarray(float)
+            The fractional frequency shift, with shape (num_channels, num_samples).
+        q : numpy.ndarray(float)
+            The inverse internal quality factor, with shape (num_channels, num_samples).
+        """
+        x = np.empty((self.num_channels, self.stream_array.s21_raw.shape[-1]))
+        q = np.empty_like(x)
+        for number in range(self.num_channels):
+            sweep_stream = self.sweep_stream(number)
+            x[number] = sweep_stream.x
+            q[number] = sweep_stream.q
+        return x, q
+
+    def compute_spectra(self, NFFT=None, window=mlab.window_none, detrend=mlab.detrend_none, noverlap=None,
+                        binned=True, bins_per_decade=30, masking_function=None):
+        """
+        Calculate the spectral densities of x and q for all channels at once.
+
+        The time-ordered x and q data for each channel come from the corresponding SingleSweepStream, which uses that
+        channel's resonator fit and deglitching. The spectral estimation, including the cross-spectral density, is
+        done in one batched pass over all channels, and every channel is binned with the same bins, so the results
+        are the same as calling set_S() on each SingleSweepStream.
+
+        Parameters
+        ----------
+        NFFT : int or None
+            The number of samples to use for each FFT chunk; should be a power of two for speed; if None, a reasonable
+            default is calculated that averages about eight spectra.
+        window  : callable
+            A function that takes a time series as argument and returns a windowed time series.
+        detrend : callable
+            A function that takes a time series as argument and returns a detrended time series.
+        noverlap : int or None
+            The number of samples to overlap in each chunk; if None, a value equal to half the NFFT value is used.
+        binned : bool
+            If True, the result is binned using bin sizes that increase with frequency.
+        bins_per_decade : int
+            If binned is True, this is the number of frequency bins per decade that will be used.
+        masking_function : callable
+            A function that takes the frequency and all spectral densities as inputs and produces a boolean mask used
+            to remove frequencies from them; the mask must depend only on frequency, since it is applied to every
+            channel.
+
+        Returns
+        -------
+        SpectralDensities
+            A namedtuple of the frequencies, bin edges and counts, and spectral densities and their variances; the
+            spectral densities have shape (num_channels, num_frequencies).
+        """
+        x, q = self.x_and_q()
+        if NFFT is None:
+            NFFT = int(2**(np.floor(np.log2(x.shape[-1])) - 3))
+        f, S_xx, S_qq, S_xq = iqnoise.welch_auto_auto_cross(x, q, self.stream_array.stream_sample_rate, NFFT=NFFT,
+                                                            window=window, detrend=detrend, noverlap=noverlap)
+        if masking_function is not None:
+            mask = masking_function(f, S_xx, S_qq, S_xq)
+            if mask.shape != f.shape:
+                raise ValueError("The masking function must return a mask with the same shape as the frequencies.")
+            f = f[mask]
+            S_xx = S_xx[:, mask]
+            S_qq = S_qq[:, mask]
+            S_xq = S_xq[:, mask]
+            logger.debug("Masked %d frequencies from raw power spectra" % (~mask).sum())
+        return _drop_dc_and_bin(f, S_xx, S_qq, S_xq, ndof=2 * x.shape[-1] // NFFT, binned=binned,
+                                bins_per_decade=bins_per_decade)
+
+    def compute_pca(self, NFFT=None, window=mlab.window_none, detrend=mlab.detrend_none, binned=True):
+        """
+        Calculate, for all channels at once, the spectral densities of x + 1j * y in the directions of minimal and
+        maximal fluctuation. The results for each channel are the same as those of SingleSweepStream.set_pca(); see
+        that method for details.
+
+        Parameters
+        ----------
+        NFFT : int
+            The number of samples to use for each FFT chunk; should be a power of two for speed.
+        window  : callable
+            A function that takes a time series as argument and returns a windowed time series.
+        detrend : callable
+            A function that takes a time series as argument and returns a detrended time series.
+        binned : bool
+            If True, the PSDs are binned using bin sizes that increase with frequency before PCA is performed.
+
+        Returns
+        -------
+        frequency : numpy.ndarray(float)
+            The frequencies of the spectral densities.
+        S_00 : numpy.ndarray(float)
+            The minimal spectral densities, with shape (num_channels, num_frequencies).
+        S_11 : numpy.ndarray(float)
+            The maximal spectral densities, with shape (num_channels, num_frequencies).
+        angles : numpy.ndarray(float)
+            The angles of the eigenvectors, with shape (2, num_channels, num_frequencies).
+        """
+        x, q = self.x_and_q()
+        if NFFT is None:
+            NFFT = int(2**(np.floor(np.log2(x.shape[-1])) - 3))
+        fr, S, evals, evects, angles, piq = iqnoise.pca_noise(x + 0.5j * q, NFFT=NFFT,
+                                                              Fs=self.stream_array.stream_sample_rate, window=window,
+                                                              detrend=detrend, use_log_bins=binned,
+                                                              use_full_spectral_helper=True)
+        return fr, evals[0], evals[1], angles
+
     def to_dataframe(self):
         dataframes = []
         for number in range(self.num_channels):
@@ -884,7 +1144,28 @@ class SingleSweepStream(RoachMeasurement):
             self.deglitch()
         return self._number_of_masked_samples
 
-    def deglitch(self, threshold=8, window_in_seconds=1, mask_extend_samples=50):
+    def deglitch(self, threshold=8, window_in_seconds=1, mask_extend_samples=50, method='random', in_place=False):
+        """
+        Find glitches in x_raw and set x, q, and stream_s21_normalized_deglitched with the glitches replaced.
+
+        Parameters
+        ----------
+        threshold : float
+            Samples that deviate from the median by more than this many median absolute deviations are masked.
+        window_in_seconds : float
+            The length of the window used to calculate the median and MAD.
+        mask_extend_samples : int
+            The number of samples on each side of a glitch that are also masked.
+        method : str
+            How masked samples are replaced; see despike.mask_glitches().
+        in_place : bool
+            If True, replace the glitches in x_raw, q_raw, and stream_s21_normalized instead of in copies; this saves
+            memory for long streams, but afterward the raw properties contain the deglitched data.
+
+        Returns
+        -------
+        None
+        """
         window_samples = int(2 ** np.ceil(np.log2(window_in_seconds * self.stream.stream_sample_rate)))
         logger.debug("deglitching with threshold %f, window %.f seconds, %d samples, extending mask by %d samples"
                      % (threshold, window_in_seconds,window_samples, mask_extend_samples))
@@ -895,7 +1176,9 @@ class SingleSweepStream(RoachMeasurement):
             self._x, self._q, self._stream_s21_normalized_deglitched = despike.mask_glitches([self.x_raw, self.q_raw,
                                                                                               self.stream_s21_normalized],
                                                                                              mask=self._glitch_mask,
-                                                                                             window_length=window_samples)
+                                                                                             window_length=window_samples,
+                                                                                             method=method,
+                                                                                             in_place=in_place)
         except:
             self._glitch_mask = np.zeros(self.x_raw.shape, dtype='bool')
             self._number_of_masked_samples = self._glitch_mask.sum()
@@ -1166,7 +1449,8 @@ class SingleSweepStream(RoachMeasurement):
             A function that takes the frequency and all spectral densities as inputs and produces a boolean mask used
             to remove points from them.
         psd_kwds : dict
-            Additional keywords to pass to mlab.psd and mlab.csd.
+            Additional keywords to pass to mlab.psd and mlab.csd; if none are given, the spectra are calculated by
+            iqnoise.welch_auto_auto_cross, which transforms x and q only once.
 
         Returns
         -------
@@ -1176,12 +1460,17 @@ class SingleSweepStream(RoachMeasurement):
             NFFT = int(2**(np.floor(np.log2(self.stream.s21_raw.size)) - 3))
         if noverlap is None:
             noverlap = NFFT // 2
-        S_qq, f = mlab.psd(self.q, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
-                           noverlap=noverlap, **psd_kwds)
-        S_xx, f = mlab.psd(self.x, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
-                           noverlap=noverlap, **psd_kwds)
-        S_xq, f = mlab.csd(self.x, self.q, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
-                           noverlap=noverlap, **psd_kwds)
+        if psd_kwds:
+            S_qq, f = mlab.psd(self.q, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
+                               noverlap=noverlap, **psd_kwds)
+            S_xx, f = mlab.psd(self.x, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
+                               noverlap=noverlap, **psd_kwds)
+            S_xq, f = mlab.csd(self.x, self.q, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window,
+                               detrend=detrend, noverlap=noverlap, **psd_kwds)
+        else:
+            f, S_xx, S_qq, S_xq = iqnoise.welch_auto_auto_cross(self.x, self.q, self.stream.stream_sample_rate,
+                                                                NFFT=NFFT, window=window, detrend=detrend,
+                                                                noverlap=noverlap)
         if masking_function is not None:
             mask = masking_function(f, S_xx, S_qq, S_xq)
             f = f[mask]
@@ -1190,42 +1479,21 @@ class SingleSweepStream(RoachMeasurement):
             S_xq = S_xq[mask]
             self._S_mask = mask
             logger.debug("Masked %d frequencies from raw power spectra" % (~mask).sum())
-        # Drop the DC and Nyquist bins since they're not helpful and make plots look messy.
-        f = f[1:-1]
-        S_xx = S_xx[1:-1]
-        S_qq = S_qq[1:-1]
-        S_xq = S_xq[1:-1]
-        # The value in each bin is chi-squared distributed with degrees of freedom equal to two times the number of
-        # spectra that are averaged. Assume that the variance of the value in a bin is equal to the square of the value
-        # in that bin divided by the number of degrees of freedom. Using nonzero overlap will complicate this, but let's
-        # ignore that. It's also not clear that this is correct for the cross-spectrum.
-        ndof = 2 * self.x.size // NFFT
-        if binned:
-            edges, counts, f_mean, d_and_v = binning.log_bin_with_variance(f, bins_per_decade,
-                                                                           (S_xx, S_xx**2 / ndof),
-                                                                           (S_qq, S_qq**2 / ndof),
-                                                                           (S_xq, S_xq**2 / ndof))
-            (S_xx, V_xx), (S_qq, V_qq), (S_xq, V_xq) = d_and_v
-        else:
-            edges = None
-            counts = np.ones(f.size, dtype=int)
-            f_mean = f
-            V_xx = S_xx**2 / ndof
-            V_qq = S_qq**2 / ndof
-            V_xq = S_xq**2 / ndof
-        self._S_edges = edges
-        self._S_counts = counts
-        self._S_frequency = f_mean
-        self._S_qq = S_qq
-        self._S_xx = S_xx
-        self._S_xq = S_xq
-        self._S_xx_variance = V_xx
-        self._S_qq_variance = V_qq
-        self._S_xq_variance = V_xq
+        spectra = _drop_dc_and_bin(f, S_xx, S_qq, S_xq, ndof=2 * self.x.size // NFFT, binned=binned,
+                                   bins_per_decade=bins_per_decade)
+        self._S_edges = spectra.edges
+        self._S_counts = spectra.counts
+        self._S_frequency = spectra.frequency
+        self._S_qq = spectra.S_qq
+        self._S_xx = spectra.S_xx
+        self._S_xq = spectra.S_xq
+        self._S_xx_variance = spectra.S_xx_variance
+        self._S_qq_variance = spectra.S_qq_variance
+        self._S_xq_variance = spectra.S_xq_variance
 
     @property
     def pca_S_frequency(self):
-        if not hasattr(self, '_pca_frequency'):
+        if not hasattr(self, '_pca_S_frequency'):
             self.set_pca()
         return self._pca_S_frequency
 
@@ -1346,6 +1614,14 @@ class SingleSweepStream(RoachMeasurement):
             period_samples = calculate.modulation_period_samples(self.stream.roach_state)
         return periodic.fold(array, period_samples, reduce=reduce)
 
+    def demodulate(self, array, period_samples=None, num_bins=None, harmonic=1):
+        """
+        Fold and lock-in demodulate the given array; see kid_readout.analysis.timeseries.periodic.demodulate().
+        """
+        if period_samples is None:
+            period_samples = calculate.modulation_period_samples(self.stream.roach_state)
+        return periodic.demodulate(array, period_samples, num_bins=num_bins, harmonic=harmonic)
+
 
 class SweepStreamList(RoachMeasurement):
 
@@ -1467,31 +1743,32 @@ class Scan(RoachMeasurement):
     def s21_point_foreground(self):
         return np.concatenate([sa.s21_point_foreground for sa in self.sweep_arrays])
 
-    # ToDo: test and finish
-    def stitch(self, kernel=None):
-        n = self.sweep_arrays[0].frequency.size
-        duplicates = np.where(self.sweep_arrays[0].frequency == self.sweep_arrays[1].frequency[0])[0]
-        if duplicates.size == 0:
-            overlap = 0
-        else:
-            overlap = self.sweep_arrays[0].frequency.size - int(duplicates)  # will fail if more than 1 duplicate
-        left_weight = np.linspace(1, 0, overlap)
-        right_weight = np.linspace(0, 1, overlap)
-        frequencies = [self.sweep_arrays[0].frequency[:overlap]]
-        amplitudes = [np.abs(self.sweep_arrays[0].s21_point[:overlap])]
-        for left, right in zip(self.sweep_arrays[:-1], self.sweep_arrays[1:]):
-            frequencies.append(left.frequency[overlap:])
-            amplitudes.append(left_weight * np.abs(left.s21_point[overlap:]) +
-                              right_weight * np.abs(right.s21_point[:overlap]))
-        frequencies.append(self.sweep_arrays[-1].frequency[overlap:])
-        amplitudes.append(np.abs(self.sweep_arrays[-1].s21_point[overlap:]))
-        frequency = np.concatenate(frequencies)
-        amplitude = np.concatenate(amplitudes)
-        if kernel is None:
-            width = int(n / 10)
-            kernel = np.exp(-np.linspace(-4, 4, width) ** 2)
-            kernel /= kernel.sum()
-        smoothed = np.convolve(kernel, amplitude, mode='same')
-        smoothed[:width] = smoothed[width + 1]
-        smoothed[-width:] = smoothed[-(width + 1)]
-        return frequency, amplitude, smoothed
+    @property
+    def s21_point_error(self):
+        return np.concatenate([sa.s21_point_error for sa in self.sweep_arrays])
+
+    def find_resonators(self, **kwargs):
+        """
+        Find and fit the resonators across the entire scan using find_resonators.find_resonators_fast(), to which the
+        keyword arguments are passed. The data are first merged with stitch().
+
+        Returns
+        -------
+        list(LinearResonatorWithCable)
+        """
+        stitched = self.stitch()
+        return find_resonators.find_resonators_fast(stitched.frequency, stitched.s21, stitched.s21_error, **kwargs)
+
+    def stitch(self, tolerance=None, background_width=None, percentile=90):
+        """
+        Merge all the sweep arrays onto one frequency grid, averaging where they overlap, and estimate the smooth
+        background. See kid_readout.analysis.scan.stitch() for the parameters.
+
+        Returns
+        -------
+        kid_readout.analysis.scan.Stitched
+        """
+        return scan.stitch(frequencies=[sa.frequency for sa in self.sweep_arrays],
+                           s21s=[sa.s21_point for sa in self.sweep_arrays],
+                           s21_errors=[sa.s21_point_error for sa in self.sweep_arrays],
+                           tolerance=tolerance, background_width=background_width, percentile=percentile)
@@ -14,6 +14,7 @@ import numpy as np
 import pandas as pd
 
 from kid_readout.measurement import classes
+from kid_readout.utils import timing
 
 CLASS_NAME = '_class'  # This is the string used by IO objects to save class names.
 VERSION = '_version'  # This is the string used by IO objects to save class versions.
@@ -658,6 +659,7 @@ class IO(object):
         """
         return node.class_name() + str(len(self.node_names()))
 
+    @timing.timed('io_write')
     def write(self, node, node_path=None):
         """
         Write the node to disk at the given node path. If no node path is specified, write at the root level using the
@@ -682,6 +684,7 @@ class IO(object):
         self._write_node(node, absolute_node_path)
         logger.info("Wrote {} to node path {}".format(node.__class__.__name__, absolute_node_path))
 
+    @timing.timed('io_read')
     def read(self, node_path, translate=None, force=False):
         """
         Read a measurement from disk and return it.
@@ -36,13 +36,13 @@ class DataBlock():
     def mean(self):
         if self._mean is None:
             if self._lpf_data is None:
-                self._lpf_data = fftfilt.fftfilt(lpf,self.data)[len(lpf):]*self.wavenorm
+                self._lpf_data = fftfilt.fft_filter(lpf).filter(self.data)[len(lpf):]*self.wavenorm
             self._mean = self._lpf_data.mean(0,dtype='complex')
         return self._mean
     def mean_error(self):
         if self._std is None:
             if self._lpf_data is None:
-                self._lpf_data = fftfilt.fftfilt(lpf,self.data)[len(lpf):]*self.wavenorm
+                self._lpf_data = fftfilt.fft_filter(lpf).filter(self.data)[len(lpf):]*self.wavenorm
             # the standard deviation is scaled by the number of independent samples
             # to compute the error on the mean.
             real_error = self._lpf_data.real.std(0)/np.sqrt(self._lpf_data.shape[0]/len(lpf))
@@ -118,16 +118,15 @@ class SweepGroup(object):
             indexes_to_calculate = np.arange(self.timestream_group.data.shape[0],dtype='int')
         else:
             indexes_to_calculate = np.flatnonzero(mask)
-        errors = np.zeros(indexes_to_calculate.shape[0], dtype='complex')
-        for output_index,input_index in enumerate(indexes_to_calculate):
-            filtered = kid_readout.analysis.timeseries.fftfilt.fftfilt(lpf, self.timestream_group.data[input_index,
-                                                                            :])[len(lpf):]
-            # the standard deviation is scaled by the number of independent samples
-            # to compute the error on the mean.
-            error_scaling = np.sqrt(float(len(filtered))/len(lpf))
-            real_error = filtered.real.std()/error_scaling
-            imag_error = filtered.imag.std()/error_scaling
-            errors[output_index] = real_error + 1j*imag_error
+        # Filter all of the selected timestreams at once; time is the last axis.
+        filtered = kid_readout.analysis.timeseries.fftfilt.fft_filter(lpf).filter(
+            self.timestream_group.data[indexes_to_calculate, :])[:, len(lpf):]
+        # the standard deviation is scaled by the number of independent samples
+        # to compute the error on the mean.
+        error_scaling = np.sqrt(float(filtered.shape[1])/len(lpf))
+        real_error = filtered.real.std(axis=1)/error_scaling
+        imag_error = filtered.imag.std(axis=1)/error_scaling
+        errors = (real_error + 1j*imag_error).astype('complex')
 
         return errors
 
@@ -1,10 +1,13 @@
 import numpy as np
+from testfixtures import TempDirectory
 
 from kid_readout.measurement import acquire
+from kid_readout.measurement.io import npy
 from kid_readout.roach.baseband import RoachBaseband
 from kid_readout.roach.heterodyne import RoachHeterodyne
 from kid_readout.roach.tests.mock_roach import MockRoach
 from kid_readout.roach.tests.mock_valon import MockValon
+from kid_readout.utils import timing
 
 
 def test_baseband_sweep():
@@ -30,6 +33,14 @@ def test_baseband_sweep():
     assert len(sweep.stream_arrays) == num_waveforms
     assert all([stream_array.s21_raw.shape[0] == num_tones for stream_array in sweep.stream_arrays])
 
+    # Pre-load as many waveforms as fit, and demodulate while capturing.
+    pipelined = acquire.run_pipelined_sweep(ri=ri, tone_banks=tone_banks, num_tone_samples=num_tone_samples,
+                                            length_seconds=length_seconds, state=state, description="description")
+    assert len(pipelined.stream_arrays) == num_waveforms
+    assert np.all(pipelined.frequency == sweep.frequency)
+    assert all([pipelined_array.s21_raw.shape == stream_array.s21_raw.shape
+                for pipelined_array, stream_array in zip(pipelined.stream_arrays, sweep.stream_arrays)])
+
 
 def test_heterodyne_sweep():
     num_tones = 16
@@ -54,3 +65,57 @@ def test_heterodyne_sweep():
     sweep = acquire.run_loaded_sweep(ri=ri, length_seconds=length_seconds, state=state, description="description")
     assert len(sweep.stream_arrays) == num_waveforms
     assert all([stream_array.s21_raw.shape[0] == num_tones for stream_array in sweep.stream_arrays])
+
+    # Pre-load as many waveforms as fit, and demodulate while capturing.
+    pipelined = acquire.run_pipelined_sweep(ri=ri, tone_banks=tone_banks, num_tone_samples=num_tone_samples,
+                                            length_seconds=length_seconds, state=state, description="description")
+    assert len(pipelined.stream_arrays) == num_waveforms
+    assert np.all(pipelined.frequency == sweep.frequency)
+    assert all([pipelined_array.s21_raw.shape == stream_array.s21_raw.shape
+                for pipelined_array, stream_array in zip(pipelined.stream_arrays, sweep.stream_arrays)])
+
+
+def test_adaptive_tone_banks():
+    f_r = np.array([100., 150.])
+    linewidth = np.array([0.01, 0.02])
+    tone_banks = acquire.adaptive_tone_banks(f_r, linewidth, 9, span_linewidths=4)
+    offsets = (np.array(tone_banks) - f_r) / linewidth
+    assert len(tone_banks) == 9
+    assert np.allclose(offsets[:, 0], offsets[:, 1])
+    assert np.allclose(offsets[[0, -1], 0], [-2, 2])
+    assert np.sum(np.abs(offsets[:, 0]) <= 0.5) > 9 / 2
+
+
+def test_adaptive_sweep():
+    num_tones = 16
+    ri = RoachBaseband(roach=MockRoach('roach'), initialize=False, adc_valon=MockValon())
+    center_frequencies = np.linspace(100, 200, num_tones)
+    sweep = acquire.run_adaptive_sweep(ri=ri, center_frequencies=center_frequencies, span=0.1, num_tone_samples=2**16,
+                                       num_coarse_banks=4, num_fine_banks=8, length_seconds=0.01,
+                                       description="description")
+    assert len(sweep.stream_arrays) == 4 + 8
+    assert sweep.num_channels == num_tones
+    assert sweep.sweep(0).frequency.size == 4 + 8
+
+
+def test_sweep_timing():
+    ri = RoachHeterodyne(roach=MockRoach('roach'), initialize=False, adc_valon=MockValon())
+    ri.lo_frequency = 1000
+    tone_banks = [1000 + np.linspace(-100, 100, 4) + offset for offset in np.linspace(-0.1, 0.1, 4)]
+    sweep = acquire.run_pipelined_sweep(ri=ri, tone_banks=tone_banks, num_tone_samples=2**16, length_seconds=0.01)
+    assert 'timing' not in sweep.state
+    timing.enable()
+    try:
+        sweep = acquire.run_pipelined_sweep(ri=ri, tone_banks=tone_banks, num_tone_samples=2**16, length_seconds=0.01,
+                                            poll_sync=True)
+    finally:
+        timing.enable(False)
+    assert sweep.state.timing['tone_synthesis']['count'] == 1
+    assert sweep.state.timing['waveform_load']['count'] == 1
+    assert sweep.state.timing['sync_wait']['count'] == len(tone_banks)
+    # The mock data is not captured or demodulated.
+    assert all([stream_array.state.timing == {} for stream_array in sweep.stream_arrays])
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        io.write(sweep, 'sweep')
+        assert io.read('sweep').state.timing == sweep.state.timing
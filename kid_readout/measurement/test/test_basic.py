@@ -1,6 +1,8 @@
 import numpy as np
+import pandas as pd
 import warnings
 
+from kid_readout.measurement import basic
 from kid_readout.measurement.test import utilities
 from kid_readout.analysis.timeseries import spectral_masks
 
@@ -69,6 +71,32 @@ def test_s21_raw_mean_error():
         assert issubclass(w[1].category, RuntimeWarning)  # From imag
 
 
+class TestStreamArray(object):
+
+    @classmethod
+    def setup(cls):
+        cls.sa = utilities.fake_stream_array()
+
+    def test_stream_view(self):
+        _ = self.sa.frequency
+        stream = self.sa.stream(3)
+        assert stream.state is self.sa.state
+        assert stream.roach_state is self.sa.roach_state
+        assert stream._frequency == self.sa.frequency[3]
+        assert not hasattr(stream, '_baseband_frequency')
+        assert stream.baseband_frequency == self.sa.baseband_frequency[3]
+        assert np.allclose(stream.s21_point, self.sa.s21_point[3])
+
+    def test_to_dataframe(self):
+        dataframe = self.sa.to_dataframe()
+        expected = pd.concat([self.sa.stream(number).to_dataframe(add_origin=False)
+                              for number in range(self.sa.tone_index.size)], ignore_index=True)
+        assert list(dataframe.columns) == list(expected.columns)
+        for column in expected.columns:
+            if column != 'analysis_epoch':
+                assert all(a == b for a, b in zip(dataframe[column], expected[column])), column
+
+
 class TestSweepArray(object):
 
     @classmethod
@@ -122,6 +150,50 @@ class TestSweepArray(object):
     def test_start_epoch(self):
         assert self.sa.start_epoch() == self.sa.stream_arrays[0].epoch
 
+    def test_background(self):
+        background = self.sa.background
+        assert self.sa.background is background
+        assert np.allclose(self.sa.s21_point_foreground, self.sa.s21_point / background)
+        assert np.allclose(background, self.sa.fit_background())
+        self.sa._delete_memoized_property_caches()
+        assert self.sa.background is not background
+        assert np.allclose(self.sa.background, background)
+
+    def test_sweep_view(self):
+        sweep = self.sa.sweep(5)
+        assert sweep.state is self.sa.state
+        assert all(stream.roach_state is stream_array.roach_state
+                   for stream, stream_array in zip(sweep.streams, self.sa.stream_arrays))
+        s21_point = np.array([np.mean(stream_array.s21_raw[5]) for stream_array in self.sa.stream_arrays])
+        frequency = np.array([stream_array.frequency[5] for stream_array in self.sa.stream_arrays])
+        assert np.allclose(sweep.s21_point, s21_point[np.argsort(frequency)])
+        assert np.all(sweep.frequency == np.sort(frequency))
+
+    def test_fit_backgrounds(self):
+        other = utilities.fake_sweep_array()
+        models = basic.fit_backgrounds([self.sa, other], amp_degree=2)
+        assert self.sa.background_model is models[0]
+        assert other.background_model is models[1]
+        assert np.allclose(other.background, other.fit_background(amp_degree=2))
+
+
+class TestScan(object):
+
+    @classmethod
+    def setup(cls):
+        cls.sweep_arrays = [utilities.fake_sweep_array(), utilities.fake_sweep_array()]
+        cls.scan = basic.Scan(cls.sweep_arrays)
+
+    def test_stitch(self):
+        stitched = self.scan.stitch()
+        sa0, sa1 = self.sweep_arrays
+        assert np.allclose(stitched.frequency, sa0.frequency)
+        assert np.all(stitched.counts == 2)
+        weight0 = 2 / np.abs(sa0.s21_point_error) ** 2
+        weight1 = 2 / np.abs(sa1.s21_point_error) ** 2
+        assert np.allclose(stitched.s21, (weight0 * sa0.s21_point + weight1 * sa1.s21_point) / (weight0 + weight1))
+        assert np.allclose(stitched.s21_foreground * stitched.background, stitched.s21)
+
 
 class TestSingleSweep(object):
 
@@ -181,7 +253,7 @@ class TestSingleSweepStream(object):
         self.sss.set_S()
         with warnings.catch_warnings(record=True) as ws:
             warnings.simplefilter('always')
-            self.sss.set_pca()  # This raises 40 ComplexWarnings
+            self.sss.set_pca()
             for w in ws:
                 assert issubclass(w.category, np.ComplexWarning)
         for attr in memoized:
@@ -202,3 +274,41 @@ class TestSingleSweepStream(object):
         self.sss.set_S(masking_function=spectral_masks.pulse_tube_mask)
 
 
+
+
+class TestSweepStreamArray(object):
+
+    @classmethod
+    def setup(cls):
+        cls.ssa = utilities.fake_sweep_stream_array(num_tones=4)
+
+    def test_compute_spectra(self):
+        # Deglitching draws random replacement samples, so use the same draws for the array and for the channels.
+        np.random.seed(123)
+        spectra = self.ssa.compute_spectra()
+        assert spectra.S_xx.shape == (self.ssa.num_channels, spectra.frequency.size)
+        np.random.seed(123)
+        for number in range(self.ssa.num_channels):
+            sss = self.ssa.sweep_stream(number)
+            sss.set_S()
+            assert np.allclose(sss.S_frequency, spectra.frequency)
+            assert np.allclose(sss.S_xx, spectra.S_xx[number])
+            assert np.allclose(sss.S_qq, spectra.S_qq[number])
+            assert np.allclose(sss.S_xq, spectra.S_xq[number])
+            assert np.allclose(sss.S_xx_variance, spectra.S_xx_variance[number])
+
+    def test_compute_spectra_mask(self):
+        self.ssa.compute_spectra(masking_function=spectral_masks.pulse_tube_mask, binned=False)
+
+    def test_compute_pca(self):
+        np.random.seed(123)
+        frequency, S_00, S_11, angles = self.ssa.compute_pca()
+        assert S_00.shape == S_11.shape == (self.ssa.num_channels, frequency.size)
+        np.random.seed(123)
+        for number in range(self.ssa.num_channels):
+            sss = self.ssa.sweep_stream(number)
+            sss.set_pca()
+            assert np.allclose(sss.pca_S_frequency, frequency)
+            assert np.allclose(sss.pca_S_00, S_00[number])
+            assert np.allclose(sss.pca_S_11, S_11[number])
+            assert np.allclose(sss.pca_angles, angles[:, number])
@@ -0,0 +1,107 @@
+import numpy as np
+
+from kid_readout.analysis.resonator import lmfit_resonator
+from kid_readout.measurement import tracking
+from kid_readout.roach.baseband import RoachBaseband
+from kid_readout.roach.tests.mock_roach import MockRoach
+from kid_readout.roach.tests.mock_valon import MockValon
+
+
+def fit_resonator(f_0, Q, Q_e):
+    frequency = f_0 * (1 + np.linspace(-5, 5, 101) / Q)
+    s21 = 0.5 * np.exp(-2j * np.pi * frequency * 30e-9) * (1 - (Q / Q_e) / (1 + 2j * Q * (frequency / f_0 - 1)))
+    errors = 1e-4 * (1 + 1j) * np.ones(frequency.size)
+    return lmfit_resonator.LinearResonatorWithCable(frequency=frequency, s21=s21, errors=errors)
+
+
+def test_resonator_tracker():
+    np.random.seed(123)
+    num_tone_samples = 2 ** 18
+    ri = RoachBaseband(roach=MockRoach('roach'), initialize=False, adc_valon=MockValon())
+    ri.set_tone_freqs(np.array([100., 150.]), nsamp=num_tone_samples)
+    stream_array = ri.get_measurement(num_seconds=0.01)
+    Q = 1e4
+    resonators = [fit_resonator(f_0, Q, 2 * Q) for f_0 in stream_array.frequency]
+    tracker = tracking.ResonatorTracker(ri, resonators, threshold=0.2)
+    linewidth = stream_array.frequency / Q
+    drift = np.array([0.5, 0.05]) * linewidth
+    for number, resonator in enumerate(resonators):
+        params = resonator.current_params.copy()
+        params['f_0'].value += drift[number]
+        s21 = resonator.model.eval(params=params, f=stream_array.frequency[number])
+        stream_array.s21_raw[number, :] = s21 + 1e-4 * np.random.randn(stream_array.s21_raw.shape[1])
+    assert np.allclose(tracker.estimate_resonance_frequency(stream_array), stream_array.frequency + drift,
+                       rtol=0, atol=0.01 * linewidth.min())
+    record = tracker.update(stream_array)
+    assert record.retuned
+    assert record.channel == [0]
+    assert len(tracker.retunes) == 1
+    resolution = 1e6 * ri.fs / num_tone_samples
+    new_frequency = ri.get_measurement(num_seconds=0.01).frequency
+    assert np.abs(new_frequency[0] - (stream_array.frequency[0] + drift[0])) <= resolution / 2
+    assert new_frequency[1] == stream_array.frequency[1]
+    assert np.allclose(record.tone_frequency, new_frequency)
+    # The tracker now expects the moved resonance, so the same data needs no further retune.
+    assert not tracker.update(stream_array).retuned
+    # Mock data is noise, which gives implausible estimates that are recorded but not acted on.
+    stream_array = tracker.get_measurement(num_seconds=0.01)
+    assert not stream_array.state.tracking.retuned
+    assert len(stream_array.state.tracking.drift) == 2
+
+
+def test_retune_keeps_other_banks():
+    np.random.seed(123)
+    num_tone_samples = 2 ** 18
+    ri = RoachBaseband(roach=MockRoach('roach'), initialize=False, adc_valon=MockValon())
+    bins = np.array([[20000, 30000], [40000, 50000]])
+    ri.set_tone_bins(bins.copy(), num_tone_samples)
+    ri.fft_bins = ri.calc_fft_bins(bins, num_tone_samples)
+    ri.select_bank(1)
+    ri.select_fft_bins(range(2))
+    stream_array = ri.get_measurement(num_seconds=0.01)
+    Q = 1e4
+    resonators = [fit_resonator(f_0, Q, 2 * Q) for f_0 in stream_array.frequency]
+    tracker = tracking.ResonatorTracker(ri, resonators, threshold=0.2)
+    drift = 0.5 * stream_array.frequency[0] / Q
+    for number, resonator in enumerate(resonators):
+        params = resonator.current_params.copy()
+        params['f_0'].value += drift * (number == 0)
+        s21 = resonator.model.eval(params=params, f=stream_array.frequency[number])
+        stream_array.s21_raw[number, :] = s21 + 1e-4 * np.random.randn(stream_array.s21_raw.shape[1])
+    assert tracker.update(stream_array).channel == [0]
+    assert ri.bank == 1
+    assert np.all(ri.tone_bins[0] == bins[0])
+    assert ri.tone_bins[1, 0] != bins[1, 0] and ri.tone_bins[1, 1] == bins[1, 1]
+    assert np.all(ri.get_measurement(num_seconds=0.01).frequency[1] == stream_array.frequency[1])
+
+
+def test_drift_below_half_a_bin_accumulates():
+    np.random.seed(123)
+    num_tone_samples = 2 ** 16
+    ri = RoachBaseband(roach=MockRoach('roach'), initialize=False, adc_valon=MockValon())
+    ri.set_tone_freqs(np.array([100., 150.]), nsamp=num_tone_samples)
+    stream_array = ri.get_measurement(num_seconds=0.01)
+    Q = 1e5
+    resonators = [fit_resonator(f_0, Q, 2 * Q) for f_0 in stream_array.frequency]
+    tracker = tracking.ResonatorTracker(ri, resonators, threshold=0.2)
+    linewidth = stream_array.frequency[0] / Q
+    resolution = 1e6 * ri.fs / num_tone_samples
+    assert 0.2 * linewidth < 0.4 * resolution
+    tone_bins = ri.tone_bins.copy()
+    written = ri.r.memory_bytes_written
+    for number, drift in enumerate([0.4 * resolution, 0.8 * resolution]):
+        for channel, resonator in enumerate(resonators):
+            params = resonator.current_params.copy()
+            params['f_0'].value += drift * (channel == 0)
+            s21 = resonator.model.eval(params=params, f=stream_array.frequency[channel])
+            stream_array.s21_raw[channel, :] = s21 + 1e-4 * np.random.randn(stream_array.s21_raw.shape[1])
+        record = tracker.update(stream_array)
+        if number == 0:
+            # The tone would move by zero bins, so nothing is reloaded and the drift is not forgotten.
+            assert not record.retuned
+            assert ri.r.memory_bytes_written == written
+            assert np.all(ri.tone_bins == tone_bins)
+        else:
+            assert record.channel == [0]
+            assert ri.tone_bins[0, 0] == tone_bins[0, 0] + 1 and ri.tone_bins[0, 1] == tone_bins[0, 1]
+            assert np.allclose(tracker.resonance_frequency[0], stream_array.frequency[0] + resolution)
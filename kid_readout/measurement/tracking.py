@@ -0,0 +1,134 @@
+"""
+Keep readout tones on resonance during long stream sessions.
+
+A ResonatorTracker holds one fitted resonator per channel, usually from the SingleSweep.resonator of each channel of a
+SweepArray. After each stream it inverts the resonator model on the streamed s21 data to estimate where each resonance
+is now, and when a resonance has moved by more than a fraction of its linewidth since the last tune, it moves that
+tone by the same amount, rounded to a whole tone bin. The tracking record is added to the state of each StreamArray, so the history of every retune
+is saved with the data. A full re-sweep is needed only when the resonance shape changes, not when it just moves.
+"""
+from __future__ import division
+import time
+import logging
+
+import numpy as np
+
+from kid_readout.roach import calculate
+from kid_readout.measurement import core
+
+logger = logging.getLogger(__name__)
+
+
+class ResonatorTracker(object):
+    """
+    Retune the tones of a RoachInterface to follow resonance frequency drift.
+
+    The channels are in the order of the StreamArrays from the interface, which is the order of their tone indices.
+    Retuning moves the drifted tones of the current bank and reloads the waveforms with the existing phases and
+    amplitudes, so no other tone moves; any other banks are unchanged, and the current bank and the readout selection
+    are restored.
+    """
+
+    def __init__(self, ri, resonators, threshold=0.2, max_linewidths=10):
+        """
+        Parameters
+        ----------
+        ri : RoachInterface
+            An instance of a subclass, with the tones to track loaded and selected.
+        resonators : iterable of BaseResonator
+            One fitted resonator per channel, with frequencies in Hz.
+        threshold : float
+            A tone is retuned when its resonance has moved by more than this fraction of the linewidth since the last
+            tune.
+        max_linewidths : float
+            A larger estimated drift, in linewidths, is treated as a failed estimate, such as from a lost resonance, and
+            the tone is left alone.
+        """
+        self.ri = ri
+        self.resonators = list(resonators)
+        self.threshold = threshold
+        self.max_linewidths = max_linewidths
+        # The resonance frequencies at which the tones are tuned; a retune moves these by the whole tone bins that the
+        # tones moved, so drift that is too small to move a tone accumulates until it does.
+        self.resonance_frequency = np.array([resonator.f_0 for resonator in self.resonators])
+        self.linewidth = np.array([resonator.f_0 / resonator.Q for resonator in self.resonators])
+        self.retunes = []
+
+    @classmethod
+    def from_sweep(cls, ri, sweep_array, threshold=0.2, max_linewidths=10):
+        """
+        Return a tracker that uses the fitted resonator of every channel of the given SweepArray.
+        """
+        return cls(ri, [sweep_array.sweep(number).resonator for number in range(sweep_array.num_channels)],
+                   threshold=threshold, max_linewidths=max_linewidths)
+
+    def estimate_resonance_frequency(self, stream_array):
+        """
+        Return the resonance frequency of each channel, in Hz, during the given StreamArray.
+
+        The resonator model is inverted to give the fractional detuning x = f / f_r - 1 of each tone, so the median of
+        f / (1 + x) over the stream is the resonance frequency; it does not depend on where the tone is.
+        """
+        resonance_frequency = np.empty(len(self.resonators))
+        for number, resonator in enumerate(self.resonators):
+            x, q = resonator.invert_raw(frequency=stream_array.frequency[number], s21_raw=stream_array.s21_raw[number])
+            resonance_frequency[number] = stream_array.frequency[number] / (1 + np.median(x))
+        return resonance_frequency
+
+    def update(self, stream_array):
+        """
+        Estimate the resonance frequencies during the given StreamArray and retune the tones whose resonances have
+        drifted by more than the threshold, and by no more than max_linewidths. A tone moves by the drift rounded to a
+        whole tone bin, so a drift of less than half a bin moves nothing and is not counted as a retune.
+
+        Returns
+        -------
+        StateDict
+            The tracking record: the estimated resonance frequencies and their drift since the last tune, in Hz, and
+            whether the tones were retuned; after a retune, also the retuned channels and the new tone frequencies.
+        """
+        resonance_frequency = self.estimate_resonance_frequency(stream_array)
+        drift = resonance_frequency - self.resonance_frequency
+        valid = np.abs(drift) <= self.max_linewidths * self.linewidth  # False if the estimate is nan.
+        if not np.all(valid):
+            logger.warning("Not retuning channels %s, with implausible drift" % np.flatnonzero(~valid).tolist())
+        drifted = valid & (np.abs(drift) > self.threshold * self.linewidth)
+        resolution = 1e6 * self.ri.fs / self.ri.tone_nsamp
+        offset_bins = np.zeros(drift.size, dtype='int')
+        offset_bins[drifted] = np.round(drift[drifted] / resolution).astype('int')
+        moved = offset_bins != 0
+        record = core.StateDict(epoch=time.time(), resonance_frequency=resonance_frequency.tolist(),
+                                drift=drift.tolist(), retuned=bool(np.any(moved)))
+        if record.retuned:
+            tone_frequency = self._retune(stream_array.tone_index[moved], offset_bins[moved])
+            self.resonance_frequency[moved] += resolution * offset_bins[moved]
+            record.channel = np.flatnonzero(moved).tolist()
+            record.tone_frequency = tone_frequency[stream_array.tone_index].tolist()
+            self.retunes.append(record)
+            logger.debug("Retuned channels %s by %s bins" % (record.channel, offset_bins[moved]))
+        return record
+
+    def get_measurement(self, num_seconds, state=None, **kwargs):
+        """
+        Return a StreamArray from ri.get_measurement(), then retune the tones for the next one if needed. The tracking
+        record from update() is stored in the state of the StreamArray under the key 'tracking'; a retune it records
+        applies to the streams that follow.
+        """
+        stream_array = self.ri.get_measurement(num_seconds, state=state, **kwargs)
+        stream_array.state['tracking'] = self.update(stream_array)
+        return stream_array
+
+    def _retune(self, tone_index, offset_bins):
+        # Move the given tones of the current bank by the given numbers of tone bins, reload every bank with the
+        # existing phases and amplitudes, and return the tone frequencies of the current bank.
+        ri = self.ri
+        bank = ri.bank
+        readout_selection = ri.readout_selection.copy()
+        tone_bins = ri.tone_bins.copy()
+        tone_bins[bank, tone_index] = np.mod(tone_bins[bank, tone_index] + offset_bins, ri.tone_nsamp)
+        ri.set_tone_bins(tone_bins, ri.tone_nsamp, amps=ri.amps, phases=ri.phases)
+        ri.fft_bins = ri.calc_fft_bins(tone_bins, ri.tone_nsamp)
+        ri.select_bank(bank)
+        ri.select_fft_bins(readout_selection)
+        ri.save_state()
+        return calculate.frequency(ri.get_state(), ri.tone_bins[bank, :])
@@ -12,6 +12,7 @@ import udp_catcher
 import tools
 from interface import RoachInterface
 from kid_readout.settings import ROACH1_VALON, ROACH1_IP, ROACH1_HOST_IP
+from kid_readout.utils import timing
 
 import logging
 logger = logging.getLogger(__name__)
@@ -71,7 +72,8 @@ class RoachBaseband(RoachInterface):
         if initialize:
             self.initialize()
 
-    def load_waveform(self, wave, start_offset=0, fast=True):
+    @timing.timed('waveform_load')
+    def load_waveform(self, wave, start_offset=0, fast=True, force=False):
         """
         Load waveform
         
@@ -79,17 +81,21 @@ class RoachBaseband(RoachInterface):
         
         fast : boolean
             decide what method for loading the dram 
+
+        force : boolean
+            if True, write the whole waveform even if skip_unchanged is True and the memory seems to hold it
+            already
         """
-        data = np.zeros((2 * wave.shape[0],), dtype='>i2')
+        data = np.zeros((wave.shape[0] // 2, 4), dtype='>i2')
         offset = self.wafer * 2
-        data[offset::4] = wave[::2]
-        data[offset + 1::4] = wave[1::2]
+        data[:, offset:offset + 2] = wave.reshape((-1, 2))
+        data.shape = (data.size,)
         start_offset = start_offset * data.shape[0]
         # self.r.write_int('dram_mask', data.shape[0]/4 - 1)
-        self._load_dram(data, start_offset=start_offset, fast=fast)
+        self._load_dram(data, start_offset=start_offset, fast=fast, force=force)
 
     def set_tone_freqs(self, freqs, nsamp, amps=None, load=True, normfact=None, readout_selection=None,
-                       phases=None, preset_norm=True):
+                       phases=None, preset_norm=True, optimize_phases=False):
         """
         Set the stimulus tones to generate
         
@@ -109,7 +115,8 @@ class RoachBaseband(RoachInterface):
         freqs = np.atleast_1d(freqs).astype('float')
         bins = np.round((freqs / self.fs) * nsamp).astype('int')
         actual_freqs = self.fs * bins / float(nsamp)
-        self.set_tone_bins(bins, nsamp, amps=amps, load=load, normfact=normfact,phases=phases, preset_norm=preset_norm)
+        self.set_tone_bins(bins, nsamp, amps=amps, load=load, normfact=normfact,phases=phases, preset_norm=preset_norm,
+                           optimize_phases=optimize_phases)
         self.fft_bins = self.calc_fft_bins(bins, nsamp)
         self.select_bank(0)
         readout_selection = range(self.fft_bins.shape[1])
@@ -134,7 +141,8 @@ class RoachBaseband(RoachInterface):
         self.save_state()
         return actual_freqs
 
-    def set_tone_bins(self, bins, nsamp, amps=None, load=True, normfact=None, phases=None, preset_norm=True):
+    def set_tone_bins(self, bins, nsamp, amps=None, load=True, normfact=None, phases=None, preset_norm=True,
+                      optimize_phases=False):
         """
         Set the stimulus tones by specific integer bins
         
@@ -147,35 +155,43 @@ class RoachBaseband(RoachInterface):
             specify the relative amplitude of each tone. Can set to zero to read out a portion
             of the spectrum with no stimulus tone.
         load : bool (debug only). If false, don't actually load the waveform, just calculate it.
+        optimize_phases : bool
+            If True and phases are not given, use phases from tools.optimize_phases that minimize the waveform peak,
+            and normalize by the exact peak; the phases are cached on disk, so only the first use of a tone set is slow.
         """
         if self.BYTES_PER_SAMPLE * nsamp > self.MEMORY_SIZE_BYTES:
             message = "Requested tone size ({:d} bytes) exceeds available memory ({:d} bytes)"
             raise ValueError(message.format(self.BYTES_PER_SAMPLE * nsamp, self.MEMORY_SIZE_BYTES))
         if bins.ndim == 1:
             bins.shape = (1, bins.shape[0])
-        nwaves = bins.shape[0]
-        spec = np.zeros((nwaves, nsamp // 2 + 1), dtype='complex')
         self.tone_bins = bins.copy()
         self.tone_nsamp = nsamp
-        if phases is None:
-            phases = np.random.random(bins.shape[1]) * 2 * np.pi
-        self.phases = phases.copy()
         if amps is None:
             amps = 1.0
+        optimal_wavenorm = None
+        if phases is None:
+            if optimize_phases:
+                phases, optimal_wavenorm = tools.optimize_phases(bins, nsamp, amps=amps, baseband=True)
+            else:
+                phases = np.random.random(bins.shape[1]) * 2 * np.pi
+        self.phases = phases.copy()
         self.amps = amps
-        for k in range(nwaves):
-            spec[k, bins[k, :]] = amps * np.exp(1j * phases)
-        wave = np.fft.irfft(spec, axis=1)
-        if preset_norm and not normfact:
-            self.wavenorm = tools.calc_wavenorm(bins.shape[1], nsamp, baseband=True)
+        values = amps * np.exp(1j * phases)
+        if optimal_wavenorm is not None and not normfact:
+            wavenorm = optimal_wavenorm
+        elif preset_norm and not normfact:
+            wavenorm = tools.calc_wavenorm(bins.shape[1], nsamp, baseband=True)
+        elif normfact is not None:
+            wavenorm = max([np.abs(tools.tone_waveform(bins[k], values, nsamp, baseband=True)).max()
+                            for k in range(bins.shape[0])])
+            wn = (2.0 / normfact) * len(bins) / float(nsamp)
+            logger.debug("Using user provide waveform normalization resulting in wavenorm %f versus optimal %f. "
+                         "Ratio is %f" % (wn,wavenorm,wavenorm/wn))
+            wavenorm = wn
         else:
-            self.wavenorm = np.abs(wave).max()
-            if normfact is not None:
-                wn = (2.0 / normfact) * len(bins) / float(nsamp)
-                logger.debug("Using user provide waveform normalization resulting in wavenorm %f versus optimal %f. "
-                             "Ratio is %f" % (wn,self.wavenorm,self.wavenorm/wn))
-                self.wavenorm = wn
-        qwave = np.round((wave / self.wavenorm) * (2 ** 15 - 1024)).astype('>i2')
+            wavenorm = None
+        # The banks are synthesized one at a time directly from their tone bins and quantized as they are made.
+        self.wavenorm, qwave, _ = tools.synthesize_waveforms(bins, values, nsamp, wavenorm=wavenorm, baseband=True)
         qwave.shape = (qwave.shape[0] * qwave.shape[1],)
         self.qwave = qwave
         if load:
@@ -184,20 +200,19 @@ class RoachBaseband(RoachInterface):
 
     def add_tone_bins(self, bins, amps=None, preset_norm=True):
         nsamp = self.tone_nsamp
-        spec = np.zeros((nsamp // 2 + 1,), dtype='complex')
         self.tone_bins = np.vstack((self.tone_bins, bins))
         phases = self.phases
         if amps is None:
             amps = 1.0
         # self.amps = amps  # TODO: Need to figure out how to deal with this
 
-        spec[bins] = amps * np.exp(1j * phases)
-        wave = np.fft.irfft(spec)
         if preset_norm:
-            self.wavenorm = tools.calc_wavenorm(self.tone_bins.shape[1], nsamp, baseband=True)
+            wavenorm = tools.calc_wavenorm(self.tone_bins.shape[1], nsamp, baseband=True)
         else:
-            self.wavenorm = np.abs(wave).max()
-        qwave = np.round((wave / self.wavenorm) * (2 ** 15 - 1024)).astype('>i2')
+            wavenorm = None
+        self.wavenorm, qwave, _ = tools.synthesize_waveforms(np.atleast_2d(bins), amps * np.exp(1j * phases), nsamp,
+                                                             wavenorm=wavenorm, baseband=True)
+        qwave.shape = (nsamp,)
         # self.qwave = qwave  # TODO: Deal with this, if we ever use it
         start_offset = self.tone_bins.shape[0] - 1
         self.load_waveform(qwave, start_offset=start_offset)
@@ -304,8 +319,8 @@ class RoachBaseband(RoachInterface):
 
 
     def get_data(self, nread=2, demod=True):
-        # TODO This is a temporary hack until we get the system simulation code in place
-        if self._using_mock_roach:
+        # Use tests.simulated_roach.SimulatedRoach for data that comes from a model of the system.
+        if self._using_fake_data:
             data = (np.random.standard_normal((nread * 4096, self.num_tones)) +
                     1j * np.random.standard_normal((nread * 4096, self.num_tones)))
             if self.r.sleep_for_fake_data:
@@ -351,9 +366,13 @@ class RoachBaseband(RoachInterface):
                                                 chans=self.fpga_fft_readout_indexes + chan_offset,
                                                 nfft=self.nfft, addr=(self.host_ip, 12345))  # , stream_reg, addr)
         if demod:
-            data = self.demodulate_data(data)
+            data, seqnos = self._demodulate_raw_data(data, seqnos)
         return data, seqnos
 
+    @timing.timed('demodulate')
+    def _demodulate_raw_data(self, data, seq_nos):
+        return self.demodulate_data(data), seq_nos
+
 
     def get_data_seconds_katcp(self, nseconds, demod=True, pow2=True):
         """
@@ -56,3 +56,59 @@ def start_server(bof_pid,roachip='roach'):
     remote_command = 'ssh root@%s "nohup /boffiles/udp/kid_ppc %s < /dev/null &> /dev/null &"' % (roachip,bof_pid)
     print remote_command
     b = check_output(remote_command, shell=True)
+
+
+class RemoteShell(object):
+    """
+    A shell on the ROACH PPC that stays open between commands, so running a command costs one round trip instead of
+    starting a new ssh process and connection.
+    """
+    _marker = '__kid_readout_remote_shell_done__'
+
+    def __init__(self, roachip='roach', command=None):
+        """
+        roachip : str
+            the host name of the ROACH.
+        command : list of str or None
+            the command that starts the shell; the default opens a shell on the ROACH over ssh.
+        """
+        self.roachip = roachip
+        if command is None:
+            command = ['ssh', '-T', 'root@%s' % roachip, 'sh']
+        self.command = command
+        self._process = None
+
+    def _start(self):
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT)
+
+    def run(self, command):
+        """
+        Run command in the remote shell and return its output, with stderr included.
+
+        Raises subprocess.CalledProcessError if the command exits with a nonzero status.
+        """
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+        self._process.stdin.write('%s 2>&1; echo %s $?\n' % (command, self._marker))
+        self._process.stdin.flush()
+        lines = []
+        while True:
+            line = self._process.stdout.readline()
+            if not line:
+                self._process = None
+                raise subprocess.CalledProcessError(-1, command, ''.join(lines))
+            if line.startswith(self._marker):
+                break
+            lines.append(line)
+        output = ''.join(lines)
+        returncode = int(line.split()[-1])
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command, output)
+        return output
+
+    def close(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.wait()
+        self._process = None
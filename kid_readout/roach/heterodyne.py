@@ -10,7 +10,9 @@ from scipy import signal
 import kid_readout.roach.udp_catcher
 from kid_readout.roach.demodulator import Demodulator, StreamDemodulator
 from kid_readout.roach.interface import RoachInterface
-from kid_readout.roach.tools import calc_wavenorm, find_best_iq_delay_adc
+from kid_readout.roach import tools
+from kid_readout.utils import timing
+from kid_readout.roach.tools import calc_wavenorm, find_best_iq_delay_adc, synthesize_waveforms, tone_waveform
 
 try:
     import numexpr
@@ -120,7 +122,8 @@ class RoachHeterodyne(RoachInterface):
         else:
             self.r.write_int('sync',0)
 
-    def load_waveforms(self, i_wave, q_wave, fast=True, start_offset=0):
+    @timing.timed('waveform_load')
+    def load_waveforms(self, i_wave, q_wave, fast=True, start_offset=0, force=False):
         """
         Load waveforms for the two DACs
 
@@ -128,13 +131,17 @@ class RoachHeterodyne(RoachInterface):
 
         fast : boolean
             decide what method for loading the dram
+
+        force : boolean
+            if True, write the whole waveform even if skip_unchanged is True and the memory seems to hold it
+            already
         """
-        data = np.zeros((2 * i_wave.shape[0],), dtype='>i2')
-        data[0::4] = i_wave[::2]
-        data[1::4] = i_wave[1::2]
-        data[2::4] = q_wave[::2]
-        data[3::4] = q_wave[1::2]
-        self._load_dram(data, fast=fast, start_offset=start_offset*data.shape[0])
+        # Each group of four DRAM samples holds two I samples followed by two Q samples.
+        data = np.empty((i_wave.shape[0] // 2, 4), dtype='>i2')
+        data[:, :2] = i_wave.reshape((-1, 2))
+        data[:, 2:] = q_wave.reshape((-1, 2))
+        data.shape = (data.size,)
+        self._load_dram(data, fast=fast, start_offset=start_offset*data.shape[0], force=force)
 
     def set_tone_freqs(self, freqs, nsamp, amps=None, preset_norm=True, **kwargs):
         baseband_freqs = freqs-self.lo_frequency
@@ -202,7 +209,8 @@ class RoachHeterodyne(RoachInterface):
         return actual_freqs
 
 
-    def set_tone_bins(self, bins, nsamp, amps=None, load=True, normfact=None, phases=None, preset_norm=True):
+    def set_tone_bins(self, bins, nsamp, amps=None, load=True, normfact=None, phases=None, preset_norm=True,
+                      optimize_phases=False):
         """
         Set the stimulus tones by specific integer bins
 
@@ -215,37 +223,44 @@ class RoachHeterodyne(RoachInterface):
             specify the relative amplitude of each tone. Can set to zero to read out a portion
             of the spectrum with no stimulus tone.
         load : bool (debug only). If false, don't actually load the waveform, just calculate it.
+        optimize_phases : bool
+            If True and phases are not given, use phases from tools.optimize_phases that minimize the waveform peak,
+            and normalize by the exact peak; the phases are cached on disk, so only the first use of a tone set is slow.
         """
         if self.BYTES_PER_SAMPLE * nsamp > self.MEMORY_SIZE_BYTES:
             message = "Requested tone size ({:d} bytes) exceeds available memory ({:d} bytes)"
             raise ValueError(message.format(self.BYTES_PER_SAMPLE * nsamp, self.MEMORY_SIZE_BYTES))
         if bins.ndim == 1:
             bins.shape = (1, bins.shape[0])
-        nwaves = bins.shape[0]
-        spec = np.zeros((nwaves, nsamp), dtype='complex')
         self.tone_bins = bins.copy()
         self.tone_nsamp = nsamp
         #this is to make sure phases are correct shape since we are reusing phases
-        if phases is None or phases.shape[0] != bins.shape[1]:
-            phases = np.random.random(bins.shape[1]) * 2 * np.pi
-        self.phases = phases.copy()
         if amps is None:
             amps = 1.0
+        optimal_wavenorm = None
+        if phases is None or phases.shape[0] != bins.shape[1]:
+            if optimize_phases:
+                phases, optimal_wavenorm = tools.optimize_phases(bins, nsamp, amps=amps)
+            else:
+                phases = np.random.random(bins.shape[1]) * 2 * np.pi
+        self.phases = phases.copy()
         self.amps = amps
-        for k in range(nwaves):
-            spec[k, bins[k, :]] = amps * np.exp(1j * phases)
-        wave = np.fft.ifft(spec, axis=1)
-        if preset_norm:
-            self.wavenorm = calc_wavenorm(bins.shape[1], nsamp)
+        values = amps * np.exp(1j * phases)
+        if optimal_wavenorm is not None:
+            wavenorm = optimal_wavenorm
+        elif preset_norm:
+            wavenorm = calc_wavenorm(bins.shape[1], nsamp)
         else:
-            self.wavenorm = np.abs(wave).max()
+            wavenorm = None
         if normfact is not None:
             wn = (2.0 / normfact) * len(bins) / float(nsamp)
-            print "ratio of current wavenorm to optimal:", self.wavenorm / wn
-            self.wavenorm = wn
-        q_rwave = np.round((wave.real / self.wavenorm) * (2 ** 15 - 1024)).astype('>i2')
-        q_iwave = np.round((wave.imag / self.wavenorm) * (2 ** 15 - 1024)).astype('>i2')
-        q_iwave = np.roll(q_iwave, self.iq_delay, axis=1)
+            if wavenorm is None:
+                wavenorm = max([np.abs(tone_waveform(bins[k], values, nsamp)).max() for k in range(bins.shape[0])])
+            print "ratio of current wavenorm to optimal:", wavenorm / wn
+            wavenorm = wn
+        # The banks are synthesized one at a time directly from their tone bins and quantized as they are made.
+        self.wavenorm, q_rwave, q_iwave = synthesize_waveforms(bins, values, nsamp, wavenorm=wavenorm,
+                                                               imag_shift=self.iq_delay)
         q_rwave.shape = (q_rwave.shape[0] * q_rwave.shape[1],)
         q_iwave.shape = (q_iwave.shape[0] * q_iwave.shape[1],)
         self.q_rwave = q_rwave
@@ -256,22 +271,20 @@ class RoachHeterodyne(RoachInterface):
 
     def add_tone_bins(self, bins, amps=None, preset_norm=True):
         nsamp = self.tone_nsamp
-        spec = np.zeros((nsamp,), dtype='complex')
         self.tone_bins = np.vstack((self.tone_bins, bins))
         phases = self.phases
         if amps is None:
             amps = 1.0
         # self.amps = amps  # TODO: Need to figure out how to deal with this
 
-        spec[bins] = amps * np.exp(1j * phases)
-        wave = np.fft.ifft(spec)
         if preset_norm:
-            self.wavenorm = calc_wavenorm(self.tone_bins.shape[1], nsamp)
+            wavenorm = calc_wavenorm(self.tone_bins.shape[1], nsamp)
         else:
-            self.wavenorm = np.abs(wave).max()
-        q_rwave = np.round((wave.real / self.wavenorm) * (2 ** 15 - 1024)).astype('>i2')
-        q_iwave = np.round((wave.imag / self.wavenorm) * (2 ** 15 - 1024)).astype('>i2')
-        q_iwave = np.roll(q_iwave, self.iq_delay, axis=0)
+            wavenorm = None
+        self.wavenorm, q_rwave, q_iwave = synthesize_waveforms(np.atleast_2d(bins), amps * np.exp(1j * phases), nsamp,
+                                                               wavenorm=wavenorm, imag_shift=self.iq_delay)
+        q_rwave.shape = (nsamp,)
+        q_iwave.shape = (nsamp,)
         start_offset = self.tone_bins.shape[0] - 1
         self.load_waveforms(q_rwave, q_iwave, start_offset=start_offset)
         self.save_state()
@@ -398,8 +411,8 @@ class RoachHeterodyne(RoachInterface):
         return chan_rate / samples_per_channel_per_block
 
     def get_data(self, nread=2, demod=True):
-        # TODO This is a temporary hack until we get the system simulation code in place
-        if self._using_mock_roach:
+        # Use tests.simulated_roach.SimulatedRoach for data that comes from a model of the system.
+        if self._using_fake_data:
             data = (np.random.standard_normal((nread * 4096, self.num_tones)) +
                     1j * np.random.standard_normal((nread * 4096, self.num_tones)))
             if self.r.sleep_for_fake_data:
@@ -417,9 +430,13 @@ class RoachHeterodyne(RoachInterface):
                                                 chans=udp_channel,
                                                 nfft=self.nfft//2, addr=(self.host_ip, 12345))  # , stream_reg, addr)
         if demod:
-            data = self.demodulate_data(data)
+            data, seqnos = self._demodulate_raw_data(data, seqnos)
         return data, seqnos
 
+    @timing.timed('demodulate')
+    def _demodulate_raw_data(self, data, seq_nos):
+        return self.demodulate_data(data), seq_nos
+
     def get_data_katcp(self, nread=10, demod=True):
         """
         Get a chunk of data
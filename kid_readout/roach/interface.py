@@ -1,9 +1,11 @@
+import copy
 import logging
 import os
 import sys
 import time
 import warnings
 import socket
+import hashlib
 import subprocess
 
 import numpy as np
@@ -11,16 +13,30 @@ import scipy
 import zlib
 
 import borph_utils
+from kid_readout.roach import transport
 from kid_readout.roach.tests.mock_roach import MockRoach
 from kid_readout.settings import BASE_DATA_DIR
 from kid_readout.roach import tools
 from kid_readout.measurement.core import StateDict
 from kid_readout.measurement.basic import StreamArray
 from kid_readout.measurement.misc import ADCSnap
+from kid_readout.utils import timing
 
 
 CONFIG_FILE_NAME_TEMPLATE = os.path.join(BASE_DATA_DIR,'%s_config.npz')
 
+# The PPC can only access 64 MB of DRAM at a time.
+DRAM_BANK_BYTES = 64 * 2 ** 20
+# Waveform memory is compared with what was last written in blocks of this size, which is a multiple of the 512-byte
+# blocks used by dd.
+DRAM_BLOCK_BYTES = 2 ** 16
+
+
+def _digest(block):
+    # The first eight bytes of the SHA-1 digest, as an integer.
+    return np.frombuffer(hashlib.sha1(block).digest()[:8], dtype='<u8')[0]
+
+
 logger = logging.getLogger(__name__)
 
 
@@ -60,9 +76,8 @@ class RoachInterface(object):
         if roach:
             self.r = roach
             # Check if we're using a fake ROACH for testing. If so, disable additional externalities
-            # This logic could be made more general if desired (i.e. has attribute mock
-            #  or type name matches regex including 'mock'
-            if type(roach) is MockRoach:
+            # This includes subclasses, such as the SimulatedRoach, that stream data like the hardware.
+            if isinstance(roach, MockRoach):
                 self._using_mock_roach = True
         else:  # pragma: no cover
             from corr.katcp_wrapper import FpgaClient
@@ -144,6 +159,12 @@ class RoachInterface(object):
         self.wafer = None
         self.raw_adc_ns = 2 ** 12  # number of samples in the raw ADC buffer
         self.nfft = None
+        # If True, waveform loads skip the blocks of memory that this interface has already written with the same
+        # data; nothing else may write to the waveform memory of the board while this is set.
+        self.skip_unchanged = False
+        # Digests of the blocks of waveform memory as last written by this interface, with zero meaning unknown
+        self._memory_block_digests = np.zeros(0, dtype='uint64')
+        self._transport = None
         # Boffile specific register names
         self._fpga_output_buffer = None
 
@@ -165,6 +186,22 @@ class RoachInterface(object):
             self.fs = 512.0
         self.bank = self.get_current_bank()
 
+    @property
+    def transport(self):
+        """
+        The transport used for batched register access and memory writes, which is created on first use.
+
+        A ROACH1 running a boffile uses the BORPH files over persistent ssh connections shared by every interface to
+        the same board; otherwise every request goes through the FpgaClient.
+        """
+        if self._transport is None:
+            self._update_bof_pid()
+            if self._using_mock_roach or self.is_roach2 or not self.bof_pid:
+                self._transport = transport.KatcpTransport(self.r)
+            else:
+                self._transport = transport.get_borph_transport(self.roachip, self.bof_pid)
+        return self._transport
+
     # FPGA Functions
     def _update_bof_pid(self):
         if self.is_roach2:
@@ -178,6 +215,14 @@ class RoachInterface(object):
                 self.bof_pid = None
     #            raise e
 
+    @property
+    def _using_fake_data(self):
+        """
+        True if get_data() should return random numbers because the MockRoach does not stream data; a SimulatedRoach
+        streams UDP packets like the hardware, so its data goes through the normal capture and demodulation code.
+        """
+        return self._using_mock_roach and not self.r.simulates_data
+
     def max_num_waveforms(self, num_tone_samples):
         return self.MEMORY_SIZE_BYTES // (self.BYTES_PER_SAMPLE * num_tone_samples)
 
@@ -260,8 +305,9 @@ class RoachInterface(object):
                           reference_sequence_number = reference_sequence_number
                           )
         if include_registers:
-            for register in self.initial_values_for_writeable_registers:
-                roach_state[register] = self.r.read_int(register)
+            registers = list(self.initial_values_for_writeable_registers)
+            for register, value in zip(registers, self.transport.read_registers(registers).astype('int32')):
+                roach_state[register] = int(value)
         return roach_state
 
     @property
@@ -441,6 +487,8 @@ class RoachInterface(object):
 
         """
         reprogrammed = False
+        # The waveform memory belongs to the board, which something else may have written since the last load.
+        self._memory_block_digests = np.zeros(0, dtype='uint64')
         if use_config:
             try:
                 state = np.load(self._config_file_name)
@@ -489,6 +537,7 @@ class RoachInterface(object):
                 logger.exception("Unable to write to ROACH scratchpad register. Something is very wrong")
                 raise RuntimeError("Unable to write to ROACH scratchpad register. Something is very wrong")
             self.bof_pid = None
+            self._transport = None
             self._update_bof_pid()
             self.set_fft_gain(4)
             self.r.write_int('dacctrl', 2)
@@ -549,37 +598,85 @@ class RoachInterface(object):
         self.r.write_int('dram_rst', 2)
 
     # TODO: This should raise a RoachError if data is too large to fit in memory.
-    def _load_dram(self, data, start_offset=0, fast=True):
+    def _load_dram(self, data, start_offset=0, fast=True, force=False):
+        """
+        Write data to the DRAM, starting start_offset samples from the beginning.
+
+        If skip_unchanged is True, only the blocks of DRAM_BLOCK_BYTES that differ from what this interface last wrote
+        are sent, so reloading a waveform or changing one bank of a multi-bank waveform costs only the banks that
+        changed; otherwise, or if force is True, everything is written.
+        """
         if fast:
             load_dram = self._load_dram_ssh
         else:
             load_dram = self._load_dram_katcp
-        nbytes = data.nbytes
-        logger.info("Writing %.1f kB to DRAM", (nbytes/2.**10))
-        # PPC can only access 64MB at a time, so need to break the data into chunks of this size
-        bank_size = (64 * 2 ** 20)
-        nbanks, rem = divmod(nbytes, bank_size)
-        if rem:
-            nbanks += 1
-        if nbanks == 0:
-            nbanks = 1
-        bank_size_units = bank_size / data.itemsize  # calculate how many entries in the data array fit in one 64 MB bank
-
-        start_offset_bytes = start_offset * data.itemsize
-        bank_offset = start_offset_bytes // bank_size
-        start_offset_bytes = start_offset_bytes - bank_size * bank_offset
-        logger.debug("bank_offset= %d  start_offset=%d  start_offset_bytes=%d", bank_offset , start_offset,
-                    start_offset_bytes)
-        for bank in range(nbanks):
-            logger.debug("writing DRAM bank %d", (bank + bank_offset))
-            self.r.write_int('dram_controller', bank + bank_offset)
-            load_dram(data[bank * bank_size_units:(bank + 1) * bank_size_units], offset_bytes=start_offset_bytes)
-
-    def _load_dram_katcp(self, data, tries=2):
+        data = np.ascontiguousarray(data)
+        regions, digests = self._changed_memory_regions(data, start_offset * data.itemsize, force=force)
+        logger.info("Writing %.1f kB of %.1f kB to DRAM", sum([end - begin for begin, end in regions]) / 2. ** 10,
+                    data.nbytes / 2. ** 10)
+        for begin, end in regions:
+            offset_bytes = start_offset * data.itemsize + begin
+            chunk = data[begin // data.itemsize:end // data.itemsize]
+            # Break the data into pieces that each lie within one 64 MB bank.
+            position = 0
+            while position < chunk.nbytes:
+                bank, bank_offset_bytes = divmod(offset_bytes + position, DRAM_BANK_BYTES)
+                size = min(DRAM_BANK_BYTES - bank_offset_bytes, chunk.nbytes - position)
+                logger.debug("writing %d bytes to DRAM bank %d at offset %d", size, bank, bank_offset_bytes)
+                self.r.write_int('dram_controller', bank)
+                load_dram(chunk[position // data.itemsize:(position + size) // data.itemsize],
+                          offset_bytes=bank_offset_bytes)
+                position += size
+        self._record_memory_digests(start_offset * data.itemsize, digests)
+
+    def _changed_memory_regions(self, data, start_bytes, force=False):
+        """
+        Return the (begin, end) byte ranges of data that differ from the waveform memory, and the digests of its blocks.
+
+        If skip_unchanged is True, the memory is compared in blocks of DRAM_BLOCK_BYTES using digests of what this
+        interface last wrote, which are kept only in memory and cleared by initialize(). Data that does not start on a
+        block boundary is always written in full, as is everything if force is True or skip_unchanged is False, in
+        which case the digests are None. The blocks that are about to be written are marked as unknown, so if the
+        write fails they are written again next time; pass the digests to _record_memory_digests() after it succeeds.
+        """
+        if not self.skip_unchanged:
+            self._memory_block_digests = np.zeros(0, dtype='uint64')
+            return [(0, data.nbytes)], None
+        first_block = start_bytes // DRAM_BLOCK_BYTES
+        aligned = start_bytes == first_block * DRAM_BLOCK_BYTES
+        num_blocks = -(-(start_bytes + data.nbytes) // DRAM_BLOCK_BYTES) - first_block
+        if self._memory_block_digests.size < first_block + num_blocks:
+            self._memory_block_digests = np.concatenate(
+                (self._memory_block_digests,
+                 np.zeros(first_block + num_blocks - self._memory_block_digests.size, dtype='uint64')))
+        known = self._memory_block_digests[first_block:first_block + num_blocks]
+        if not aligned:
+            known[:] = 0
+            return [(0, data.nbytes)], np.zeros(num_blocks, dtype='uint64')
+        raw = data.view('uint8')
+        digests = np.array([_digest(raw[k * DRAM_BLOCK_BYTES:(k + 1) * DRAM_BLOCK_BYTES]) for k in range(num_blocks)],
+                           dtype='uint64')
+        changed = (digests != known) | (known == 0) | force
+        known[changed] = 0
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], changed.astype('int8'), [0]))))
+        regions = [(begin * DRAM_BLOCK_BYTES, min(end * DRAM_BLOCK_BYTES, data.nbytes))
+                   for begin, end in zip(edges[::2], edges[1::2])]
+        return regions, digests
+
+    def _record_memory_digests(self, start_bytes, digests):
+        """
+        Record that the blocks with the given digests, returned by _changed_memory_regions(), have been written.
+        """
+        if digests is None:
+            return
+        first_block = start_bytes // DRAM_BLOCK_BYTES
+        self._memory_block_digests[first_block:first_block + digests.size] = digests
+
+    def _load_dram_katcp(self, data, offset_bytes=0, tries=2):
         while tries > 0:
             try:
                 self._pause_dram()
-                self.r.write_dram(data.tostring())
+                self.r.write_dram(data.tostring(), offset=offset_bytes)
                 self._unpause_dram()
                 return
             except Exception, e:
@@ -587,22 +684,11 @@ class RoachInterface(object):
             tries = tries - 1
         raise Exception("Writing to dram failed!")
 
-    def _load_dram_ssh(self, data, offset_bytes=0, datafile='boffiles/dram.bin'):
-        offset_blocks = offset_bytes / 512  #dd uses blocks of 512 bytes by default
+    def _load_dram_ssh(self, data, offset_bytes=0):
         self._update_bof_pid()
         self._pause_dram()
-        if self._using_mock_roach:
-            time.sleep(0.01) #TODO: Can make this take a realistic amount of time if desired
-        else:
-            data.tofile(os.path.join(self.nfs_root, datafile))
-            dram_file = '/proc/%d/hw/ioreg/dram_memory' % self.bof_pid
-            datafile = '/' + datafile
-            # TODO: Verify that this change is fine.
-            # This was using borph_utils.check_output(), which seems to be the same as subprocess.check_output().
-            # Capture stderr to stdout because dd prints to stderr.
-            command = 'ssh root@%s "dd seek=%d if=%s of=%s"' % (self.roachip, offset_blocks, datafile, dram_file)
-            result = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
-            logger.debug(result)
+        # The data is streamed over the board's open connection rather than staged through a file on the NFS root.
+        self.transport.write_memory('dram_memory', data, offset_bytes=offset_bytes)
         self._unpause_dram()
 
     def _sync(self,loopback=None):
@@ -613,9 +699,40 @@ class RoachInterface(object):
             base_value = 2
         else:
             base_value = 0
-        self.r.write_int('sync', 0+base_value)
-        self.r.write_int('sync', 1+base_value)
-        self.r.write_int('sync', 0+base_value)
+        self.transport.write_registers([('sync', 0+base_value), ('sync', 1+base_value), ('sync', 0+base_value)])
+
+    @timing.timed('sync_wait')
+    def wait_for_sync(self, timeout=0.1, num_buffers=2):
+        """
+        Wait until the output buffer has switched num_buffers times since the call, so that data read afterward was
+        produced after the last sync, or until timeout seconds have passed.
+
+        If the output buffer register can't be read, this sleeps for the full timeout, which is what callers did before.
+
+        Returns
+        -------
+        bool
+            True if the buffer switches were seen, False if the wait timed out.
+        """
+        if self._using_mock_roach:
+            return True
+        deadline = time.time() + timeout
+        regname = '%s_addr' % self._fpga_output_buffer
+        try:
+            last = self.r.read_uint(regname) & 0x1000
+            switches = 0
+            while switches < num_buffers:
+                if time.time() > deadline:
+                    return False
+                current = self.r.read_uint(regname) & 0x1000
+                if current != last:
+                    switches += 1
+                    last = current
+            return True
+        except Exception:
+            logger.debug("Could not poll %s; sleeping for %.3f s" % (regname, timeout))
+            time.sleep(max(0, deadline - time.time()))
+            return False
 
     ### Other hardware functions (attenuator, valon)
     def set_attenuator(self, attendb, gpio_reg='gpioa', data_bit=0x08, clk_bit=0x04, le_bit=0x02):
@@ -624,6 +741,8 @@ class RoachInterface(object):
             self.r.write_int(gpio_reg, 0x00)
         except RuntimeError:
             raise RuntimeError("ROACH not programmed, cannot set attenuators")
+        # The bits are clocked out in one batch of register writes.
+        writes = []
         mask = 0x20
         for j in range(6):
             if atten & mask:
@@ -631,11 +750,9 @@ class RoachInterface(object):
             else:
                 data = 0x00
             mask = mask >> 1
-            self.r.write_int(gpio_reg, data)
-            self.r.write_int(gpio_reg, data | clk_bit)
-            self.r.write_int(gpio_reg, data)
-        self.r.write_int(gpio_reg, le_bit)
-        self.r.write_int(gpio_reg, 0x00)
+            writes.extend([(gpio_reg, data), (gpio_reg, data | clk_bit), (gpio_reg, data)])
+        writes.extend([(gpio_reg, le_bit), (gpio_reg, 0x00)])
+        self.transport.write_registers(writes)
 
     def set_adc_attenuator(self, attendb):
         raise NotImplementedError("ADC attenuator is no longer adjustable.")
@@ -687,7 +804,7 @@ class RoachInterface(object):
     def blocks_per_second_per_channel(self):
         raise NotImplementedError("blocks_per_second needs to be implemented for this subclass")
 
-    def get_measurement(self, num_seconds, power_of_two=True, demod=True, **kwargs):
+    def _num_measurement_blocks(self, num_seconds, power_of_two=True):
         num_blocks = self.blocks_per_second*num_seconds
         if num_blocks == 0:
             num_blocks = 1 # we have to get at least one block
@@ -696,32 +813,50 @@ class RoachInterface(object):
             if log2 < 0:
                 log2 = 0
             num_blocks = 2 ** log2
-        return self.get_measurement_blocks(num_blocks, demod=demod, **kwargs)
+        return num_blocks
+
+    def get_measurement(self, num_seconds, power_of_two=True, demod=True, **kwargs):
+        return self.get_measurement_blocks(self._num_measurement_blocks(num_seconds, power_of_two), demod=demod,
+                                           **kwargs)
 
     def get_measurement_blocks(self, num_blocks, demod=True, **kwargs):
-        epoch = time.time()  # This will be improved
-        data, seqnos = self.get_data(num_blocks, demod=demod)
-        sequence_start_number = int(seqnos[0])  # The numpy datatype causes IO problems.
-        if np.isscalar(self.amps):
-            tone_amplitude = self.amps * np.ones(self.tone_bins.shape[1], dtype='float')
-        else:
-            tone_amplitude = self.amps.copy()
-        output_order = self.readout_selection.argsort()
-        measurement = StreamArray(tone_bin=self.tone_bins[self.bank, :].copy(),
-                                  tone_amplitude=tone_amplitude,  # already copied
-                                  tone_phase=self.phases.copy(),
-                                  tone_index=self.readout_selection.copy()[output_order],
-                                  filterbank_bin=self.fft_bins[self.bank, self.readout_selection].copy()[output_order],
-                                  epoch=epoch,
-                                  sequence_start_number=sequence_start_number,
-                                  s21_raw=data[:,output_order].T,  # transpose for now, because measurements are
-                                          # organized channel,time
-                                  data_demodulated=demod,
-                                  roach_state=self.get_state(),
-                                  **kwargs)
-        return measurement
+        return self.capture_measurement_blocks(num_blocks, demod=demod).finish(**kwargs)
+
+    def capture_measurement(self, num_seconds, power_of_two=True, demod=True):
+        """
+        Read raw data for a measurement of the given length, as get_measurement does, without demodulating it.
+
+        Returns
+        -------
+        Capture
+            call its finish() method, with the keyword arguments for get_measurement, to get the StreamArray.
+        """
+        return self.capture_measurement_blocks(self._num_measurement_blocks(num_seconds, power_of_two), demod=demod)
+
+    def capture_measurement_blocks(self, num_blocks, demod=True):
+        """
+        Read raw data for a measurement of num_blocks blocks, as get_measurement_blocks does, without demodulating it.
+
+        The returned Capture holds a snapshot of the readout, so its finish() method can run in another thread while
+        this interface moves on to the next tone bank. If timing is enabled, the Capture also holds the timing recorders
+        that were active during the read, so that the demodulation in finish() is recorded with the capture.
+        """
+        with timing.measurement_recording() as recorder:
+            epoch = time.time()  # This will be improved
+            data, seqnos = self.get_data(num_blocks, demod=False)
+            recorders = timing.active_recorders()
+        return Capture(copy.copy(self), data, seqnos, epoch=epoch, demod=demod, roach_state=self.get_state(),
+                       recorder=recorder, recorders=recorders)
+
+    def _demodulate_raw_data(self, data, seq_nos):
+        """
+        Return the demodulated data and sequence numbers, as get_data(demod=True) does, from the output of
+        get_data(demod=False).
+        """
+        raise NotImplementedError("_demodulate_raw_data needs to be implemented for this subclass")
 
     ### Tried and true readout function
+    @timing.timed('capture')
     def _read_data(self, nread, bufname, verbose=False):
         """
         Low level data reading loop, common to both readouts
@@ -819,6 +954,58 @@ class RoachInterface(object):
                         n, tot, (n * 2 ** 12 / tot), idle / (n * 1.0)))
 
 
+class Capture(object):
+    """
+    Raw data read from the ROACH, with a snapshot of the readout that produced it.
+
+    The snapshot is a shallow copy of the interface taken right after the read. The interface replaces its tone and
+    readout arrays rather than modifying them, so the snapshot still describes this data after the interface has moved
+    on to another bank.
+    """
+
+    def __init__(self, readout, data, seq_nos, epoch, demod, roach_state, recorder=None, recorders=()):
+        self.readout = readout
+        self.data = data
+        self.seq_nos = seq_nos
+        self.epoch = epoch
+        self.demod = demod
+        self.roach_state = roach_state
+        # The recorder of this measurement, or None if timing is disabled, and all of the recorders active at capture.
+        self.recorder = recorder
+        self.recorders = recorders
+
+    def finish(self, **kwargs):
+        """
+        Demodulate the data, if requested, and return it as a StreamArray; kwargs are passed to the StreamArray. If
+        timing is enabled, the timing summary of the capture and demodulation is stored in its state.
+        """
+        ri = self.readout
+        data, seq_nos = self.data, self.seq_nos
+        # The fake mock data is noise that get_data never demodulates.
+        if self.demod and not ri._using_fake_data:
+            with timing.resume(self.recorders):
+                data, seq_nos = ri._demodulate_raw_data(data, seq_nos)
+        sequence_start_number = int(seq_nos[0])  # The numpy datatype causes IO problems.
+        if np.isscalar(ri.amps):
+            tone_amplitude = ri.amps * np.ones(ri.tone_bins.shape[1], dtype='float')
+        else:
+            tone_amplitude = ri.amps.copy()
+        output_order = ri.readout_selection.argsort()
+        stream_array = StreamArray(tone_bin=ri.tone_bins[ri.bank, :].copy(),
+                                   tone_amplitude=tone_amplitude,  # already copied
+                                   tone_phase=ri.phases.copy(),
+                                   tone_index=ri.readout_selection.copy()[output_order],
+                                   filterbank_bin=ri.fft_bins[ri.bank, ri.readout_selection].copy()[output_order],
+                                   epoch=self.epoch,
+                                   sequence_start_number=sequence_start_number,
+                                   s21_raw=data[:, output_order].T,  # transpose for now, because measurements are
+                                           # organized channel,time
+                                   data_demodulated=self.demod,
+                                   roach_state=self.roach_state,
+                                   **kwargs)
+        return timing.attach(stream_array, self.recorder)
+
+
 class RoachError(Exception):
     """
     This class is raised on Roach-specific errors.
@@ -5,6 +5,8 @@ from contextlib import closing
 import logging
 logger = logging.getLogger(__name__)
 
+from kid_readout.utils import timing
+
 try:
     # must compile cython code by running: python setup.py build_ext --inplace
     import decode
@@ -13,6 +15,7 @@ except ImportError:
     have_decode=False
 
 
+@timing.timed('capture')
 def get_udp_packets(ri,npkts,addr=('10.0.0.1',55555)):
     ri.r.write_int('txrst',2)
 
@@ -49,13 +52,15 @@ def get_udp_packets(ri,npkts,addr=('10.0.0.1',55555)):
                     logger.warning("Timed out waiting for packets from the ROACH")
                     break
 
+    timing.count('packets', len(pkts))
     return pkts
 
 
 def get_udp_data(ri,npkts,nchans,addr=('10.0.0.1',55555), verbose=False, fast=False):
     pkts = get_udp_packets(ri, npkts, addr=addr)
     if fast:
-        darray, seqnos, num_bad_pkts, num_dropped_pkts = decode.decode_packets_fast(pkts,nchans)
+        with timing.span('decode'):
+            darray, seqnos, num_bad_pkts, num_dropped_pkts = decode.decode_packets_fast(pkts,nchans)
     else:
         darray, seqnos, num_bad_pkts, num_dropped_pkts = decode_packets(pkts,nchans,ri.fpga_cycles_per_filterbank_frame)
     if num_bad_pkts or num_dropped_pkts:
@@ -66,6 +71,7 @@ def get_udp_data(ri,npkts,nchans,addr=('10.0.0.1',55555), verbose=False, fast=Fa
     return darray,seqnos
 
 
+@timing.timed('decode')
 def decode_packets(plist,nchans,clocks_per_filterbank_frame):
     assert(nchans>0)
     plist = plist[1:]
@@ -16,6 +16,7 @@ from interface import RoachInterface
 from baseband import RoachBaseband
 import kid_readout.roach.r2_udp_catcher
 from kid_readout import settings
+from kid_readout.utils import timing
 
 logger = logging.getLogger(__name__)
 
@@ -78,12 +79,15 @@ class Roach2Baseband(RoachBaseband):
             logger.debug("Calibrating QDR")
             q.qdr_cal()
             logger.info("Succesfully recalibrated QDR")
+        # The calibration check writes test patterns into the waveform memory.
+        self._memory_block_digests = np.zeros(0, dtype='uint64')
 
     def max_num_waveforms(self, num_tone_samples):
         """The ROACH2 code currently allows for only one waveform."""
         return 1
 
-    def load_waveform(self, wave, start_offset=0, fast=True):
+    @timing.timed('waveform_load')
+    def load_waveform(self, wave, start_offset=0, fast=True, force=False):
         """
         Load waveform
 
@@ -91,14 +95,22 @@ class Roach2Baseband(RoachBaseband):
 
         fast : boolean
             decide what method for loading the dram
+
+        force : boolean
+            if True, write the whole waveform even if skip_unchanged is True and the memory seems to hold it
+            already
         """
-        data = np.zeros((2 * wave.shape[0],), dtype='>i2')
+        data = np.zeros((wave.shape[0] // 2, 4), dtype='>i2')
         offset = (1-self.wafer) * 2
-        data[offset::4] = wave[::2]
-        data[offset + 1::4] = wave[1::2]
+        data[:, offset:offset + 2] = wave.reshape((-1, 2))
+        data.shape = (data.size,)
         #start_offset = start_offset * data.shape[0]
         # self.r.write_int('dram_mask', data.shape[0]/4 - 1)
-        self.r.blindwrite('qdr0_memory', data.tostring())
+        # If skip_unchanged is True, only the blocks that differ from what was last written are sent.
+        regions, digests = self._changed_memory_regions(data, 0, force=force)
+        for begin, end in regions:
+            self.r.blindwrite('qdr0_memory', data[begin // data.itemsize:end // data.itemsize].tostring(), offset=begin)
+        self._record_memory_digests(0, digests)
         self._unpause_dram()
 
     def _pause_dram(self):
@@ -107,8 +119,8 @@ class Roach2Baseband(RoachBaseband):
         self.r.write_int('qdr_en',1)
 
     def get_data(self, nread=2, demod=True):
-        # TODO This is a temporary hack until we get the system simulation code in place
-        if self._using_mock_roach:
+        # Use tests.simulated_roach.SimulatedRoach for data that comes from a model of the system.
+        if self._using_fake_data:
             data = (np.random.standard_normal((nread * 4096, self.num_tones)) +
                     1j * np.random.standard_normal((nread * 4096, self.num_tones)))
             if self.r.sleep_for_fake_data:
@@ -126,11 +138,16 @@ class Roach2Baseband(RoachBaseband):
         if self.phase0 is None:
             self.phase0 = seq_nos[0]
         if demod:
-            seq_nos -= self.phase0
-            if fast:
-                data = self.demodulate_stream(data, seq_nos)
-            else:
-                data = self.demodulate_data(data)
+            data, seq_nos = self._demodulate_raw_data(data, seq_nos, fast=fast)
+        return data, seq_nos
+
+    @timing.timed('demodulate')
+    def _demodulate_raw_data(self, data, seq_nos, fast=False):
+        seq_nos = seq_nos - self.phase0
+        if fast:
+            data = self.demodulate_stream(data, seq_nos)
+        else:
+            data = self.demodulate_data(data)
         return data, seq_nos
 
     def select_fft_bins(self, readout_selection=None, sync=True):
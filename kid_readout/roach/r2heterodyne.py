@@ -12,6 +12,7 @@ from scipy import signal
 import kid_readout.roach.r2_udp_catcher
 from heterodyne import RoachHeterodyne
 from kid_readout.roach.demodulator import Demodulator
+from kid_readout.utils import timing
 
 logger = logging.getLogger(__name__)
 
@@ -71,15 +72,20 @@ class Roach2Heterodyne(RoachHeterodyne):
             logger.debug("Calibrating QDR")
             q.qdr_cal()
             logger.info("Successfully recalibrated QDR")
+        # The calibration check writes test patterns into the waveform memory.
+        self._memory_block_digests = np.zeros(0, dtype='uint64')
 
     def max_num_waveforms(self, num_tone_samples):
         """The ROACH2 code currently allows for only one waveform."""
         return 1
 
-    def set_tone_bins(self, bins, nsamp, amps=None, load=True, normfact=None, phases=None, preset_norm=True):
-        super(Roach2Heterodyne,self).set_tone_bins(bins=bins, nsamp=nsamp, amps=amps, load=load, normfact=normfact, phases=phases, preset_norm=preset_norm)
+    def set_tone_bins(self, bins, nsamp, amps=None, load=True, normfact=None, phases=None, preset_norm=True,
+                      optimize_phases=False):
+        super(Roach2Heterodyne,self).set_tone_bins(bins=bins, nsamp=nsamp, amps=amps, load=load, normfact=normfact, phases=phases, preset_norm=preset_norm,
+                                                   optimize_phases=optimize_phases)
 
-    def load_waveforms(self, i_wave, q_wave, fast=True, start_offset=0):
+    @timing.timed('waveform_load')
+    def load_waveforms(self, i_wave, q_wave, fast=True, start_offset=0, force=False):
         """
         Load waveforms for the two DACs
 
@@ -87,15 +93,21 @@ class Roach2Heterodyne(RoachHeterodyne):
 
         fast : boolean
             decide what method for loading the dram
+
+        force : boolean
+            if True, write the whole waveform even if skip_unchanged is True and the memory seems to hold it
+            already
         """
         #somehow the r2 qdr has the dac0/1 outputs switched...
-        data = np.zeros((2 * i_wave.shape[0],), dtype='>i2')
-        data[0::4] = q_wave[::2]
-        data[1::4] = q_wave[1::2]
-        data[2::4] = i_wave[::2]
-        data[3::4] = i_wave[1::2]
-
-        self.r.blindwrite('qdr0_memory', data.tostring())
+        data = np.empty((i_wave.shape[0] // 2, 4), dtype='>i2')
+        data[:, :2] = q_wave.reshape((-1, 2))
+        data[:, 2:] = i_wave.reshape((-1, 2))
+        data.shape = (data.size,)
+        # If skip_unchanged is True, only the blocks that differ from what was last written are sent.
+        regions, digests = self._changed_memory_regions(data, 0, force=force)
+        for begin, end in regions:
+            self.r.blindwrite('qdr0_memory', data[begin // data.itemsize:end // data.itemsize].tostring(), offset=begin)
+        self._record_memory_digests(0, digests)
         self._unpause_dram()
 
     def _pause_dram(self):
@@ -111,14 +123,18 @@ class Roach2Heterodyne(RoachHeterodyne):
         if self.phase0 is None:
             self.phase0 = seq_nos[0]
         if demod:
-            seq_nos -= self.phase0
-            if fast:
-                data = self.demodulate_stream(data, seq_nos)
-            else:
-                data = self.demodulate_data(data, seq_nos)
-            data = data*self.wavenorm
+            data, seq_nos = self._demodulate_raw_data(data, seq_nos, fast=fast)
         return data, seq_nos
 
+    @timing.timed('demodulate')
+    def _demodulate_raw_data(self, data, seq_nos, fast=False):
+        seq_nos = seq_nos - self.phase0
+        if fast:
+            data = self.demodulate_stream(data, seq_nos)
+        else:
+            data = self.demodulate_data(data, seq_nos)
+        return data*self.wavenorm, seq_nos
+
     @property
     def blocks_per_second_per_channel(self):
         chan_rate = self.fs * 1e6 / (self.nfft)  # samples per second for one tone_index
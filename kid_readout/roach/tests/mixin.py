@@ -14,7 +14,7 @@ this, and in any case it's probably easier to write tests if each class can expe
 import numpy as np
 
 from kid_readout.measurement import core
-from kid_readout.roach import calculate
+from kid_readout.roach import calculate, tools
 
 
 class RoachMixin(object):
@@ -39,6 +39,14 @@ class RoachMixin(object):
                                             preset_norm=True)
             assert self.ri.wavenorm >= 0.99 * actual_wavenorm  # guarantees the wave won't overflow
 
+    def test_optimized_phases(self):
+        self.ri.set_tone_baseband_freqs(np.linspace(100, 120, 16), nsamp=2 ** 14, optimize_phases=True)
+        optimal_wavenorm = self.ri.wavenorm
+        assert optimal_wavenorm < tools.calc_wavenorm(16, 2 ** 14, baseband=not self.ri.heterodyne)
+        self.ri.set_tone_baseband_freqs(np.linspace(100, 120, 16), nsamp=2 ** 14, phases=self.ri.phases,
+                                        preset_norm=False)
+        assert np.allclose(self.ri.wavenorm, optimal_wavenorm)
+
     def test_calculate_modulation_period(self):
         roach_state = core.StateDict(modulation_rate=7, modulation_output=2, heterodyne=True)
         assert calculate.modulation_period_samples(roach_state) == 256
@@ -218,4 +226,43 @@ class MockMixin(object):
     """
     This class contains tests specifically for the MockRoach and MockValon classes.
     """
-    pass
+
+    def test_incremental_waveform_load(self):
+        frequencies = np.linspace(100, 120, 8)
+        self.ri.set_tone_baseband_freqs(frequencies, nsamp=2 ** 16)
+        written = self.ri.r.memory_bytes_written
+        # By default every load writes the whole waveform.
+        self.ri.set_tone_baseband_freqs(frequencies, nsamp=2 ** 16, phases=self.ri.phases)
+        assert self.ri.r.memory_bytes_written > written
+        self.ri.skip_unchanged = True
+        try:
+            self.ri.set_tone_baseband_freqs(frequencies, nsamp=2 ** 16, phases=self.ri.phases)
+            written = self.ri.r.memory_bytes_written
+            self.ri.set_tone_baseband_freqs(frequencies, nsamp=2 ** 16, phases=self.ri.phases)
+            assert self.ri.r.memory_bytes_written == written
+            self.ri.set_tone_baseband_freqs(frequencies + 1, nsamp=2 ** 16, phases=self.ri.phases)
+            assert self.ri.r.memory_bytes_written > written
+        finally:
+            self.ri.skip_unchanged = False
+
+    def test_failed_waveform_load_is_retried(self):
+        frequencies = np.linspace(100, 120, 8)
+        self.ri.skip_unchanged = True
+        try:
+            self.ri.set_tone_baseband_freqs(frequencies, nsamp=2 ** 16)
+
+            def fail(*args, **kwargs):
+                raise IOError("write failed")
+
+            self.ri.r.write_dram = self.ri.r.blindwrite = fail
+            try:
+                self.ri.set_tone_baseband_freqs(frequencies + 1, nsamp=2 ** 16, phases=self.ri.phases)
+            except IOError:
+                pass
+            finally:
+                del self.ri.r.write_dram, self.ri.r.blindwrite
+            written = self.ri.r.memory_bytes_written
+            self.ri.set_tone_baseband_freqs(frequencies + 1, nsamp=2 ** 16, phases=self.ri.phases)
+            assert self.ri.r.memory_bytes_written > written
+        finally:
+            self.ri.skip_unchanged = False
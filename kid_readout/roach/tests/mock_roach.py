@@ -1,14 +1,29 @@
 __author__ = 'gjones'
 
+import time
+
 
 class MockRoach(object):
 
+    # A MockRoach does not stream data, so interfaces return random numbers from get_data().
+    simulates_data = False
+
     def __init__(self, host, port=7147, tb_limit=20, timeout=10.0, logger=None,
-                 _fpga_clk=256.0, sleep_for_fake_data=False):
+                 _fpga_clk=256.0, sleep_for_fake_data=False, memory_write_latency=0, memory_bytes_per_second=None):
+        """
+        The memory parameters make writes to DRAM and QDR take a realistic amount of time: each write sleeps for
+        memory_write_latency seconds plus the time to send the data at memory_bytes_per_second, if that is not None.
+        """
         self._fpga_clk = _fpga_clk
         self._is_programmed = False
         self._boffile_list = []
         self.sleep_for_fake_data = sleep_for_fake_data
+        self.memory_write_latency = memory_write_latency
+        self.memory_bytes_per_second = memory_bytes_per_second
+        self.registers = {}
+        # Memory contents as bytearrays, keyed by device name or by ('dram', bank) for DRAM.
+        self.memory = {}
+        self.memory_bytes_written = 0
 
     def is_connected(self):
         return True
@@ -46,7 +61,7 @@ class MockRoach(object):
         return 0
 
     def write_int(self, device_name, integer, blindwrite=False, offset=0):
-        pass
+        self.registers[device_name] = integer
 
     def read_uint(self, device_name, offset=0):
         return 0
@@ -59,7 +74,22 @@ class MockRoach(object):
         return self._fpga_clk
 
     def blindwrite(self,device_name, data, offset=0):
-        pass
+        self._write_memory(device_name, data, offset)
+
+    def write_dram(self, data, offset=0, verbose=False):
+        self._write_memory(('dram', self.registers.get('dram_controller', 0)), data, offset)
+
+    def _write_memory(self, key, data, offset):
+        memory = self.memory.setdefault(key, bytearray())
+        if len(memory) < offset + len(data):
+            memory.extend(bytearray(offset + len(data) - len(memory)))
+        memory[offset:offset + len(data)] = data
+        self.memory_bytes_written += len(data)
+        delay = self.memory_write_latency
+        if self.memory_bytes_per_second is not None:
+            delay += len(data) / float(self.memory_bytes_per_second)
+        if delay:
+            time.sleep(delay)
 
     def tap_start(self, tap_dev, device, mac, ip, port):
         pass
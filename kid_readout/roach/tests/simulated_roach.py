@@ -0,0 +1,387 @@
+"""
+A simulated ROACH that streams UDP packets computed from a model of the readout system.
+
+The SimulatedRoach is a MockRoach that, when an interface starts a stream, sends packets to the interface's host_ip from
+a background thread, in the ROACH1 or ROACH2 format, at the rate of the hardware. Interfaces treat it like any other
+MockRoach, except that get_data() captures, decodes and demodulates the packets with the same code used for the
+hardware, so every stage from the socket to the analysis can be tested and benchmarked without a ROACH.
+
+The content of each channel comes from a SimulatedSystem: the tone passes through the cable and a set of resonators,
+whose frequencies can drift and are shifted by random glitches, and amplifier noise is added in ADC counts. The model
+s21 is mapped to raw filterbank samples by inverting the interface's own demodulation, which supplies the tone
+rotation, the filterbank passband correction and the waveform normalization, so the demodulated data equal the model
+plus noise. The simulation therefore tests capture, sequence number handling, decoding and analysis; it is not an
+independent check of the demodulation conventions.
+
+Usage:
+ri = RoachHeterodyne(roach=SimulatedRoach('roach', system=system), host_ip='127.0.0.1', initialize=False,
+                     adc_valon=MockValon())
+ri.r.attach(ri)
+"""
+from __future__ import division
+import copy
+import time
+import socket
+import struct
+import logging
+import threading
+
+import numpy as np
+
+from kid_readout.analysis.resonator import equations
+from kid_readout.roach import calculate
+from kid_readout.roach.tests.mock_roach import MockRoach
+
+logger = logging.getLogger(__name__)
+
+ROACH1_PORT = 12345
+ROACH2_PORT = 55555
+COUNTER_MODULUS = 2 ** 32
+
+
+class SimulatedResonator(object):
+    """
+    A linear resonator whose frequency drifts at a constant rate.
+    """
+
+    def __init__(self, f_0, Q, Q_e_real, Q_e_imag=0, drift_rate=0):
+        """
+        Parameters
+        ----------
+        f_0 : float
+            The resonance frequency at time zero, in Hz.
+        Q, Q_e_real, Q_e_imag : float
+            The loaded quality factor and the real and imaginary parts of the coupling quality factor.
+        drift_rate : float
+            The rate of change of the resonance frequency, in Hz per second.
+        """
+        self.f_0 = f_0
+        self.Q = Q
+        self.Q_e_real = Q_e_real
+        self.Q_e_imag = Q_e_imag
+        self.drift_rate = drift_rate
+
+    def s21(self, frequency, f_0):
+        return equations.linear_resonator(frequency, f_0, self.Q, self.Q_e_real, self.Q_e_imag)
+
+
+class SimulatedSystem(object):
+    """
+    The signal path between the DAC and the ADC: the cable, the resonators, glitches and amplifier noise.
+    """
+
+    def __init__(self, resonators=(), cable_delay=30e-9, cable_phase=0, cable_amplitude=1, gain=None, noise=10,
+                 glitch_rate=0, glitch_fraction=1e-5, glitch_time_constant=1e-3, seed=None):
+        """
+        Parameters
+        ----------
+        resonators : iterable of SimulatedResonator
+            The resonators on the feedline; their transmissions multiply.
+        cable_delay, cable_phase, cable_amplitude : float
+            The cable delay in seconds, the phase at zero frequency and the off-resonance transmission.
+        gain : float or None
+            The demodulated value of a tone with unit amplitude and unit transmission. The demodulation gain differs
+            by orders of magnitude between interfaces, so the default None chooses the value for which such a tone is
+            2 ** 13 ADC counts in the raw data of the channel with the smallest demodulation gain.
+        noise : float
+            The rms amplifier noise in each quadrature of the filterbank output, in ADC counts.
+        glitch_rate : float
+            The mean rate of glitches, in glitches per second. A glitch lowers every resonance frequency by the
+            fraction glitch_fraction, and the shift decays exponentially with time constant glitch_time_constant.
+        seed : int or None
+            The seed for the noise and glitch times.
+        """
+        self.resonators = list(resonators)
+        self.cable_delay = cable_delay
+        self.cable_phase = cable_phase
+        self.cable_amplitude = cable_amplitude
+        self.gain = gain
+        self.noise = noise
+        self.glitch_rate = glitch_rate
+        self.glitch_fraction = glitch_fraction
+        self.glitch_time_constant = glitch_time_constant
+        self.random = np.random.RandomState(seed)
+        self.glitch_times = np.zeros(0)
+        self._last_glitch_time = 0
+
+    def s21(self, frequency, time):
+        """
+        Return the transmission at the given tone frequencies, in Hz, and times, in seconds, as an array with shape
+        (time.size, frequency.size).
+        """
+        frequency = np.atleast_1d(frequency)[np.newaxis, :]
+        time = np.atleast_1d(time)[:, np.newaxis]
+        s21 = equations.general_cable(frequency, self.cable_delay, self.cable_phase, 0, self.cable_amplitude, 0)
+        s21 = s21 * np.ones(time.shape)
+        shift = self.glitch_shift(time)
+        for resonator in self.resonators:
+            s21 = s21 * resonator.s21(frequency, (resonator.f_0 + resonator.drift_rate * time) * (1 - shift))
+        return s21
+
+    def glitch_shift(self, time):
+        """
+        Return the fractional frequency shift caused by glitches at the given times, which should not decrease from
+        one call to the next.
+        """
+        if self.glitch_rate:
+            while self._last_glitch_time <= np.max(time):
+                self._last_glitch_time += self.random.exponential(1 / self.glitch_rate)
+                self.glitch_times = np.append(self.glitch_times, self._last_glitch_time)
+            # Glitches more than 30 time constants old are negligible.
+            self.glitch_times = self.glitch_times[self.glitch_times > np.min(time) - 30 * self.glitch_time_constant]
+        elapsed = np.asarray(time)[..., np.newaxis] - self.glitch_times
+        decay = np.where(elapsed >= 0, np.exp(-np.clip(elapsed, 0, None) / self.glitch_time_constant), 0)
+        return self.glitch_fraction * decay.sum(axis=-1)
+
+    def amplifier_noise(self, shape):
+        return self.noise * (self.random.standard_normal(shape) + 1j * self.random.standard_normal(shape))
+
+
+class SimulatedRoach(MockRoach):
+    """
+    A MockRoach that streams UDP packets from a SimulatedSystem while the attached interface is capturing data.
+
+    A ROACH1 streams while the 'streamid' register is nonzero. A ROACH2 streams whenever 'txrst' is zero, so call
+    close() to stop it.
+    """
+
+    simulates_data = True
+
+    def __init__(self, host, system=None, drop_rate=0, initial_counter=None, realtime=True, seed=None, **kwargs):
+        """
+        Parameters
+        ----------
+        host : str
+            As for MockRoach.
+        system : SimulatedSystem or None
+            The model of the signal path; the default has no resonators.
+        drop_rate : float
+            The probability that each packet is lost.
+        initial_counter : int or None
+            The first value of the packet counter, which wraps at 2 ** 32; the default is random.
+        realtime : bool
+            If True, send packets at the rate of the hardware; otherwise, send them as fast as possible, which can
+            overflow the socket buffer.
+        seed : int or None
+            The seed for packet drops and the initial counter.
+        kwargs
+            Keyword arguments passed to MockRoach.
+        """
+        super(SimulatedRoach, self).__init__(host, **kwargs)
+        if system is None:
+            system = SimulatedSystem()
+        self.system = system
+        self.drop_rate = drop_rate
+        self.realtime = realtime
+        self.random = np.random.RandomState(seed)
+        if initial_counter is None:
+            initial_counter = self.random.randint(0, 2 ** 31) * 2
+        self.initial_counter = initial_counter
+        self.interface = None
+        # The number of samples per channel sent since the simulation started; this is the simulation clock.
+        self.sample_number = 0
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def attach(self, ri):
+        """
+        Use the tones and readout selection of the given RoachInterface to compute the data.
+        """
+        self.interface = ri
+
+    def write_int(self, device_name, integer, blindwrite=False, offset=0):
+        super(SimulatedRoach, self).write_int(device_name, integer, blindwrite=blindwrite, offset=offset)
+        if device_name == 'streamid':
+            self._stop_streaming()
+            if integer:
+                self._start_streaming(Roach1Packets(self.interface, streamid=integer))
+        elif device_name == 'txrst':
+            self._stop_streaming()
+            if not integer:
+                self._start_streaming(Roach2Packets(self.interface))
+
+    def close(self):
+        """
+        Stop streaming.
+        """
+        self._stop_streaming()
+
+    def _start_streaming(self, packets):
+        if self.interface is None:
+            raise RuntimeError("Call attach() with the interface before streaming.")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._stream, args=(packets,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stop_streaming(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _stream(self, packets):
+        channels = SimulatedChannels(self.interface, self.system)
+        address = (self.interface.host_ip, packets.port)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Each stream starts on a group boundary, so the counters line up with the packets.
+        self.sample_number = -(-self.sample_number // packets.samples_per_group) * packets.samples_per_group
+        start_time = time.time()
+        start_sample = self.sample_number
+        try:
+            while not self._stop.is_set():
+                first_sample = self.sample_number
+                raw = channels.raw(first_sample, packets.samples_per_group)
+                for packet in packets.encode(raw, first_sample, self.initial_counter):
+                    if self.drop_rate and self.random.random_sample() < self.drop_rate:
+                        self.packets_dropped += 1
+                        continue
+                    try:
+                        sock.sendto(packet, address)
+                        self.packets_sent += 1
+                    except socket.error as e:
+                        logger.debug("Failed to send packet: %s" % e)
+                self.sample_number += packets.samples_per_group
+                if self.realtime:
+                    lag = (self.sample_number - start_sample) / channels.sample_rate - (time.time() - start_time)
+                    if lag > 0:
+                        time.sleep(lag)
+        finally:
+            sock.close()
+
+
+class SimulatedChannels(object):
+    """
+    The raw filterbank samples of the channels selected by an interface, computed from a SimulatedSystem.
+    """
+
+    def __init__(self, ri, system):
+        self.system = system
+        state = ri.get_state()
+        self.sample_rate = calculate.stream_sample_rate(state)
+        self.readout_selection = np.array(ri.readout_selection)
+        tone_bins = ri.tone_bins[ri.bank, self.readout_selection]
+        self.frequency = calculate.frequency(state, tone_bins)
+        if np.isscalar(ri.amps):
+            self.amplitude = ri.amps * np.ones(self.readout_selection.size)
+        else:
+            self.amplitude = np.asarray(ri.amps)[self.readout_selection]
+        self.demodulation_gain, self.rotation, self.antilinear = demodulation_gain(ri)
+        if system.gain is None:
+            self.gain = 2 ** 13 * np.abs(self.demodulation_gain).min()
+        else:
+            self.gain = system.gain
+
+    def raw(self, first_sample, num_samples):
+        """
+        Return the complex filterbank samples for the given per-channel sample numbers, with shape
+        (num_samples, number of channels).
+        """
+        n = np.arange(first_sample, first_sample + num_samples)
+        s21 = self.gain * self.amplitude * self.system.s21(self.frequency, n / self.sample_rate)
+        # Demodulation multiplies sample n by gain * exp(1j * rotation * n), or conjugates that product.
+        raw = s21 / (self.demodulation_gain * np.exp(1j * np.outer(n, self.rotation)))
+        raw[:, self.antilinear] = np.conj(raw[:, self.antilinear])
+        return raw + self.system.amplifier_noise(raw.shape)
+
+
+def demodulation_gain(ri):
+    """
+    Return the factors that the interface's demodulation applies to each channel of the raw data.
+
+    Demodulation multiplies sample n of each channel by gain * exp(1j * rotation * n) and, for some baseband channels,
+    conjugates the product. The factors are found by demodulating two samples of constant data on a copy of the
+    interface.
+
+    Returns
+    -------
+    gain : numpy.ndarray (complex)
+    rotation : numpy.ndarray (float)
+        The phase advance per sample, in radians.
+    antilinear : numpy.ndarray (bool)
+        True for the channels whose demodulated data are conjugated.
+    """
+    probe = copy.copy(ri)
+    if getattr(probe, 'phase0', 0) is None:
+        probe.phase0 = 0
+    seq_nos = np.zeros(2, dtype='int64') + getattr(probe, 'phase0', 0)
+    ones = np.ones((2, probe.readout_selection.size), dtype='complex')
+    real = probe._demodulate_raw_data(ones, seq_nos)[0]
+    imaginary = probe._demodulate_raw_data(1j * ones, seq_nos)[0]
+    # Linear channels give demod(1j) = 1j * demod(1); conjugated channels give -1j * demod(1).
+    antilinear = np.abs(imaginary[0] + 1j * real[0]) < np.abs(imaginary[0] - 1j * real[0])
+    gain = real[0]
+    rotation = np.angle(real[1] / real[0])
+    gain[antilinear] = np.conj(gain[antilinear])
+    rotation[antilinear] = -rotation[antilinear]
+    return gain, rotation, antilinear
+
+
+class Roach1Packets(object):
+    """
+    The ROACH1 packet format decoded by udp_catcher: a 12-byte header of four uint16 fields (zero, the index of the
+    packet in its chunk of 16, the stream id and a channel id) and a uint32 counter, followed by 256 big-endian complex
+    int16 samples.
+    """
+
+    port = ROACH1_PORT
+    packets_per_chunk = 16
+    samples_per_packet = 256
+
+    def __init__(self, ri, streamid):
+        self.streamid = streamid
+        num_channels = np.array(ri.readout_selection).size
+        self.samples_per_group = self.packets_per_chunk * self.samples_per_packet // num_channels
+        # These match the channel ids and counter increment used by get_data_udp().
+        if ri.heterodyne:
+            nfft = ri.nfft // 2
+            channel_ids = (ri.fpga_fft_readout_indexes // 2 + 1) % nfft
+        else:
+            nfft = ri.nfft
+            channel_ids = ri.fpga_fft_readout_indexes + 1
+        # The decoder orders the channels relative to the channel id of the first packet.
+        self.channel_id = int(channel_ids[-1])
+        self.counter_increment = nfft * 2 ** 12 // num_channels
+
+    def encode(self, raw, first_sample, initial_counter):
+        chunk = first_sample // self.samples_per_group
+        counter = (initial_counter + chunk * self.counter_increment) % COUNTER_MODULUS
+        payload = _quantize(raw, '>i2').reshape((self.packets_per_chunk, -1))
+        return [struct.pack('>4HI', 0, index, self.streamid, self.channel_id, counter) + payload[index].tostring()
+                for index in range(self.packets_per_chunk)]
+
+
+class Roach2Packets(object):
+    """
+    The ROACH2 packet format decoded by r2_udp_catcher: 1024 little-endian complex int16 samples followed by a 32-bit
+    counter of FPGA clock cycles.
+    """
+
+    port = ROACH2_PORT
+    samples_per_packet = 1024
+    packets_per_group = 16
+
+    def __init__(self, ri):
+        num_channels = np.array(ri.readout_selection).size
+        self.samples_per_channel_per_packet = self.samples_per_packet // num_channels
+        self.samples_per_group = self.packets_per_group * self.samples_per_channel_per_packet
+        self.counter_increment = ri.fpga_cycles_per_filterbank_frame * self.samples_per_packet // num_channels
+
+    def encode(self, raw, first_sample, initial_counter):
+        first_packet = first_sample // self.samples_per_channel_per_packet
+        payload = _quantize(raw, '<i2').reshape((self.packets_per_group, -1))
+        packets = []
+        for index in range(self.packets_per_group):
+            counter = (initial_counter + (first_packet + index) * self.counter_increment) % COUNTER_MODULUS
+            packets.append(payload[index].tostring() + struct.pack('<I', counter))
+        return packets
+
+
+def _quantize(raw, dtype):
+    # Interleave the real and imaginary parts and round them to 16-bit integers, as the FPGA does.
+    interleaved = np.empty(raw.shape + (2,))
+    interleaved[..., 0] = raw.real
+    interleaved[..., 1] = raw.imag
+    return np.clip(np.round(interleaved), -2 ** 15, 2 ** 15 - 1).astype(dtype).ravel()
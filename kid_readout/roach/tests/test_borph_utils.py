@@ -0,0 +1,19 @@
+import subprocess
+
+from kid_readout.roach import borph_utils
+
+
+def test_remote_shell():
+    shell = borph_utils.RemoteShell(command=['sh'])
+    try:
+        assert shell.run('echo one') == 'one\n'
+        process = shell._process
+        assert shell.run('echo two; echo three 1>&2') == 'two\nthree\n'
+        assert shell._process is process
+        try:
+            shell.run('false')
+            assert False
+        except subprocess.CalledProcessError as error:
+            assert error.returncode == 1
+    finally:
+        shell.close()
@@ -1,6 +1,8 @@
 """
 This module runs tests on the ROACH1 in baseband mode using mock hardware.
 """
+import numpy as np
+
 from kid_readout.roach.baseband import RoachBaseband
 from kid_readout.roach.tests.mock_roach import MockRoach
 from kid_readout.roach.tests.mock_valon import MockValon
@@ -12,3 +14,15 @@ class TestRoach1BasebandMock(RoachMixin, Roach1Mixin, BasebandSoftwareMixin, Moc
     @classmethod
     def setup_class(cls):
         cls.ri = RoachBaseband(roach=MockRoach('roach'), adc_valon=MockValon(), initialize=False)
+
+
+def test_wafers_share_memory():
+    # Both wafers write the whole interleaved image, zero-filling the columns of the other, so neither may skip blocks.
+    roach = MockRoach('roach')
+    wafers = [RoachBaseband(roach=roach, wafer=wafer, adc_valon=MockValon(), initialize=False) for wafer in range(2)]
+    wafers[0].set_tone_freqs(np.array([100., 110.]), nsamp=2 ** 16)
+    image = roach.memory[('dram', 0)][:]
+    wafers[1].set_tone_freqs(np.array([120., 130.]), nsamp=2 ** 16)
+    assert roach.memory[('dram', 0)] != image
+    wafers[0].set_tone_freqs(np.array([100., 110.]), nsamp=2 ** 16, phases=wafers[0].phases)
+    assert roach.memory[('dram', 0)] == image
@@ -1,6 +1,8 @@
 """
 This module runs tests on the ROACH1 in heterodyne mode using mock hardware.
 """
+import numpy as np
+
 from kid_readout.roach.heterodyne import RoachHeterodyne
 from kid_readout.roach.tests.mock_roach import MockRoach
 from kid_readout.roach.tests.mock_valon import MockValon
@@ -13,3 +15,29 @@ class TestRoach1HeterodyneMock(RoachMixin, Roach1Mixin, HeterodyneSoftwareMixin,
     def setup_class(cls):
         cls.ri = RoachHeterodyne(roach=MockRoach('roach'), adc_valon=MockValon(), lo_valon=MockValon(),
                                  initialize=False)
+
+
+def test_load_changed_banks():
+    ri = RoachHeterodyne(roach=MockRoach('roach'), adc_valon=MockValon(), lo_valon=MockValon(), initialize=False)
+    ri.skip_unchanged = True
+    nsamp = 2 ** 16
+    bank_bytes = 4 * nsamp
+    bins = np.array([[100, 2000, 30000], [200, 3000, 40000], [300, 4000, 50000]])
+    phases = np.array([0, 1., 2.])
+    ri.set_tone_bins(bins.copy(), nsamp, phases=phases)
+    assert ri.r.memory_bytes_written == bins.shape[0] * bank_bytes
+    bins[1] += 7
+    ri.set_tone_bins(bins.copy(), nsamp, phases=phases)
+    assert ri.r.memory_bytes_written == (bins.shape[0] + 1) * bank_bytes
+    image = np.zeros((bins.shape[0] * nsamp // 2, 4), dtype='>i2')
+    image[:, :2] = ri.q_rwave.reshape((-1, 2))
+    image[:, 2:] = ri.q_iwave.reshape((-1, 2))
+    assert ri.r.memory[('dram', 0)] == bytearray(image.tostring())
+    ri.add_tone_bins(np.array([400, 5000, 60000]))
+    assert ri.r.memory_bytes_written == (bins.shape[0] + 2) * bank_bytes
+    assert len(ri.r.memory[('dram', 0)]) == (bins.shape[0] + 1) * bank_bytes
+    written = ri.r.memory_bytes_written
+    ri.load_waveforms(ri.q_rwave, ri.q_iwave)
+    assert ri.r.memory_bytes_written == written
+    ri.load_waveforms(ri.q_rwave, ri.q_iwave, force=True)
+    assert ri.r.memory_bytes_written == written + ri.q_rwave.nbytes + ri.q_iwave.nbytes
@@ -0,0 +1,95 @@
+import numpy as np
+
+from kid_readout.roach.heterodyne import RoachHeterodyne
+from kid_readout.roach.r2heterodyne import Roach2Heterodyne
+from kid_readout.roach.baseband import RoachBaseband
+from kid_readout.roach.tests.mock_valon import MockValon
+from kid_readout.roach.tests.simulated_roach import (SimulatedRoach, SimulatedSystem, SimulatedResonator,
+                                                     SimulatedChannels)
+from kid_readout.utils import timing
+
+
+def setup_interface(cls, sim, **kwargs):
+    ri = cls(roach=sim, host_ip='127.0.0.1', initialize=False, adc_valon=MockValon(), **kwargs)
+    sim.attach(ri)
+    if ri.heterodyne:
+        ri.lo_frequency = 1000.
+        ri.set_tone_freqs(1000 + np.array([10.3, 20., -30., 5.]), nsamp=2 ** 16)
+    else:
+        ri.set_tone_freqs(np.array([101.3, 120., 130., 105.]), nsamp=2 ** 16)
+    ri.select_fft_bins(range(4))
+    return ri
+
+
+def check_model(cls, num_captures=2, **kwargs):
+    system = SimulatedSystem(resonators=[SimulatedResonator(1010.3e6, 2e4, 4e4)], noise=1, seed=0)
+    sim = SimulatedRoach('roach', system=system, seed=1, initial_counter=kwargs.pop('initial_counter', None))
+    try:
+        ri = setup_interface(cls, sim, **kwargs)
+        gain = SimulatedChannels(ri, system).gain
+        for capture in range(num_captures):
+            stream_array = ri.get_measurement(num_seconds=0.05)
+            assert np.all(np.isfinite(stream_array.s21_raw))
+            expected = gain * ri.amps * system.s21(stream_array.frequency, 0)[0]
+            ratio = stream_array.s21_raw.mean(axis=1) / expected
+            if ri.heterodyne:
+                assert np.allclose(ratio, 1, atol=1e-3)
+            else:
+                # Baseband demodulation counts samples from the start of each capture, so a tone that is not at the
+                # center of its filterbank bin has an arbitrary phase, as it does on the hardware.
+                assert np.allclose(np.abs(ratio), 1, atol=1e-3)
+    finally:
+        sim.close()
+
+
+def test_roach1_heterodyne():
+    check_model(RoachHeterodyne)
+
+
+def test_roach2_heterodyne():
+    check_model(Roach2Heterodyne, lo_valon=MockValon())
+
+
+def test_roach1_baseband():
+    check_model(RoachBaseband)
+
+
+def test_counter_wrap():
+    check_model(RoachHeterodyne, initial_counter=2 ** 32 - 3 * 2 ** 23)
+    check_model(Roach2Heterodyne, initial_counter=2 ** 32 - 3 * 2 ** 21, lo_valon=MockValon())
+
+
+def test_dropped_packets():
+    sim = SimulatedRoach('roach', system=SimulatedSystem(noise=1, seed=0), drop_rate=0.2, seed=2)
+    try:
+        ri = setup_interface(Roach2Heterodyne, sim, lo_valon=MockValon())
+        data, seq_nos = ri.get_data(16, demod=False)
+        assert sim.packets_dropped
+        assert data.shape == (16 * 1024 // 4, 4)
+        assert np.any(np.isnan(data))
+    finally:
+        sim.close()
+
+
+def test_glitches():
+    resonator = SimulatedResonator(100e6, 1e4, 2e4)
+    system = SimulatedSystem(resonators=[resonator], glitch_rate=100, glitch_fraction=1e-4, seed=0)
+    time = np.linspace(0, 1, 1000)
+    shift = system.glitch_shift(time)
+    assert np.all(shift >= 0)
+    assert shift.max() >= system.glitch_fraction
+    assert system.s21(resonator.f_0, time).shape == (time.size, 1)
+
+
+def test_timing():
+    sim = SimulatedRoach('roach', system=SimulatedSystem(noise=1, seed=0), seed=3)
+    timing.enable()
+    try:
+        ri = setup_interface(RoachHeterodyne, sim)
+        stream_array = ri.get_measurement(num_seconds=0.05)
+    finally:
+        timing.enable(False)
+        sim.close()
+    summary = stream_array.state.timing
+    assert sorted(summary.keys()) == ['capture', 'decode', 'demodulate', 'packets']
+    assert summary['packets']['count'] == stream_array.s21_raw.size // 256  # Each ROACH1 packet has 256 samples.
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from kid_readout.roach import tools
+
+
+def test_tone_waveform():
+    np.random.seed(123)
+    nsamp = 2 ** 12
+    for num_tones in [1, 7, tools.SPARSE_SYNTHESIS_MAX_TONES, 100]:
+        values = np.exp(2j * np.pi * np.random.random(num_tones))
+        bins = np.random.randint(0, nsamp, size=num_tones)
+        bins[-1] = bins[0]  # A repeated bin takes the last value, as with indexed assignment.
+        spec = np.zeros((nsamp,), dtype='complex')
+        spec[bins] = values
+        assert np.allclose(tools.tone_waveform(bins, values, nsamp), np.fft.ifft(spec), rtol=0, atol=1e-12)
+        bins = np.random.randint(0, nsamp // 2 + 1, size=num_tones)
+        bins[0] = 0
+        bins[-1] = nsamp // 2
+        spec = np.zeros((nsamp // 2 + 1,), dtype='complex')
+        spec[bins] = values
+        assert np.allclose(tools.tone_waveform(bins, values, nsamp, baseband=True), np.fft.irfft(spec), rtol=0,
+                           atol=1e-12)
+
+
+def test_synthesize_waveforms():
+    np.random.seed(123)
+    nsamp = 2 ** 10
+    bins = np.random.randint(0, nsamp, size=(3, 5))
+    values = 0.5 * np.exp(2j * np.pi * np.random.random(5))
+    spec = np.zeros((3, nsamp), dtype='complex')
+    for k in range(3):
+        spec[k, bins[k]] = values
+    wave = np.fft.ifft(spec, axis=1)
+    wavenorm = np.abs(wave).max()
+    real = np.round((wave.real / wavenorm) * (2 ** 15 - 1024)).astype('>i2')
+    imag = np.roll(np.round((wave.imag / wavenorm) * (2 ** 15 - 1024)).astype('>i2'), 2, axis=1)
+    synthesized_wavenorm, synthesized_real, synthesized_imag = tools.synthesize_waveforms(bins, values, nsamp,
+                                                                                          imag_shift=2)
+    assert np.allclose(synthesized_wavenorm, wavenorm, rtol=1e-12, atol=0)
+    assert synthesized_real.dtype == np.dtype('>i2')
+    assert np.abs(synthesized_real.astype('int') - real).max() <= 1
+    assert np.abs(synthesized_imag.astype('int') - imag).max() <= 1
+    wavenorm, real, imag = tools.synthesize_waveforms(bins[:, :2], 1, nsamp, wavenorm=1e-3, baseband=True)
+    assert wavenorm == 1e-3
+    assert real.shape == (3, nsamp)
+    assert imag is None
+
+
+def test_optimize_phases():
+    nsamp = 2 ** 12
+    bins = 100 + 37 * np.arange(32)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        phases, wavenorm = tools.optimize_phases(np.vstack((bins, bins + 5)), nsamp, cache_dir=cache_dir)
+        wave = tools.tone_waveform(bins, np.exp(1j * phases), nsamp)
+        random_wave = tools.tone_waveform(bins, np.exp(2j * np.pi * np.random.RandomState(0).random_sample(32)), nsamp)
+        assert np.abs(wave).max() < 0.75 * np.abs(random_wave).max()
+        assert np.allclose(wavenorm, np.abs(wave).max(), rtol=1e-12, atol=0)
+        assert len(os.listdir(cache_dir)) == 1
+        cached_phases, cached_wavenorm = tools.optimize_phases(np.vstack((bins, bins + 5)), nsamp, cache_dir=cache_dir)
+        assert np.all(cached_phases == phases)
+        assert cached_wavenorm == wavenorm
+        phases, wavenorm = tools.optimize_phases(bins, nsamp, baseband=True, num_iterations=5, cache_dir=None)
+        assert np.allclose(wavenorm, np.abs(tools.tone_waveform(bins, np.exp(1j * phases), nsamp, baseband=True)).max())
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,49 @@
+import os
+import shutil
+import getpass
+import tempfile
+
+import numpy as np
+
+from kid_readout.roach import transport
+from kid_readout.roach.tests.mock_roach import MockRoach
+
+
+def test_loopback_transport():
+    ioreg_directory = tempfile.mkdtemp()
+    loopback = transport.LoopbackTransport(ioreg_directory)
+    try:
+        loopback.write_registers([('sync', 1), ('sync', 2), ('gpioa', 0xdeadbeef)])
+        assert np.all(loopback.read_registers(['sync', 'gpioa', 'sync']) == [2, 0xdeadbeef, 2])
+        with open(os.path.join(ioreg_directory, 'gpioa'), 'rb') as f:
+            assert f.read() == '\xde\xad\xbe\xef'
+        data = np.arange(1000, dtype='>i2')
+        loopback.write_memory('dram_memory', data, offset_bytes=1024)
+        with open(os.path.join(ioreg_directory, 'dram_memory'), 'rb') as f:
+            contents = f.read()
+        assert len(contents) == 1024 + data.nbytes
+        assert contents[1024:] == data.tostring()
+        assert loopback.read('dram_memory', 6, offset_bytes=1024 + 2) == data[1:4].tostring()
+        try:
+            loopback.write_memory('dram_memory', data, offset_bytes=100)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        loopback.close()
+        shutil.rmtree(ioreg_directory)
+
+
+def test_katcp_transport():
+    roach = MockRoach('roach')
+    katcp = transport.KatcpTransport(roach)
+    katcp.write_registers([('dram_controller', 1), ('sync', 3)])
+    assert roach.registers == {'dram_controller': 1, 'sync': 3}
+    assert np.all(katcp.read_registers(['sync']) == [0])  # MockRoach always reads zero.
+    katcp.write_memory('dram_memory', np.arange(4, dtype='>i2'), offset_bytes=8)
+    assert roach.memory[('dram', 1)][8:] == np.arange(4, dtype='>i2').tostring()
+
+
+def test_control_path_is_per_user():
+    borph = transport.BorphTransport('roach', '/proc/1/hw/ioreg', control_directory='/tmp')
+    assert borph.control_path == '/tmp/kid_readout_ssh_%s_roach' % getpass.getuser()
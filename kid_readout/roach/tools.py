@@ -1,7 +1,9 @@
 """
 Misc utils related to the ROACH hardware
 """
+import os
 import time
+import hashlib
 import logging
 import warnings
 
@@ -11,6 +13,8 @@ from matplotlib import pyplot as plt
 
 from kid_readout.utils.misc import dB
 from kid_readout.measurement import acquire
+from kid_readout.settings import CACHE_DIR
+from kid_readout.utils import timing
 
 logger = logging.getLogger(__name__)
 
@@ -123,6 +127,215 @@ def calc_wavenorm(ntones, nsamp, baseband=False):
     return wavenorm
 
 
+# Waveforms with at most this many tones are synthesized directly from their few nonzero bins; above it a dense FFT of
+# one bank is faster.
+SPARSE_SYNTHESIS_MAX_TONES = 32
+
+# The full scale of the quantized DAC waveforms, which leaves some headroom below the int16 limit.
+DAC_FULL_SCALE = 2 ** 15 - 1024
+
+
+def tone_waveform(bins, values, nsamp, baseband=False):
+    """
+    Return one bank's waveform from its tone spectrum.
+
+    The result equals np.fft.ifft of a length-nsamp spectrum (or np.fft.irfft of a length nsamp // 2 + 1 spectrum if
+    baseband is True) that is zero except spec[bins] = values, but the dense spectrum is never built when there are
+    few tones. Writing the sample index as n = cols * p + j, each tone is the outer product of a phasor in p and one in
+    j, so the sum over tones is a single (rows x ntones) by (ntones x cols) matrix product.
+
+    bins : array of ints
+        the tone bins; a repeated bin takes the last of its values, as with indexed assignment.
+    values : complex or array of complex, broadcast against bins
+        the spectrum values at the bins.
+    nsamp : int, must be a power of 2
+        the number of samples in the waveform.
+    baseband : bool
+        if True, return the real waveform with a one-sided spectrum.
+
+    returns: array of complex (or float if baseband) with shape (nsamp,)
+    """
+    bins = np.asarray(bins, dtype='int64').ravel()
+    values = np.broadcast_to(values, bins.shape)
+    if bins.size > SPARSE_SYNTHESIS_MAX_TONES:
+        if baseband:
+            spec = np.zeros((nsamp // 2 + 1,), dtype='complex')
+            spec[bins] = values
+            return np.fft.irfft(spec, nsamp)
+        spec = np.zeros((nsamp,), dtype='complex')
+        spec[bins] = values
+        return np.fft.ifft(spec)
+    bins = bins % nsamp
+    unique_bins, last = np.unique(bins[::-1], return_index=True)
+    values = values[::-1][last].astype('complex')
+    if baseband:
+        # The negative frequencies of the real waveform double every bin except DC and Nyquist.
+        values = values * np.where((unique_bins == 0) | (unique_bins == nsamp // 2), 1, 2)
+    outer, inner = _tone_phasors(unique_bins, nsamp)
+    wave = np.dot(outer.T * (values / nsamp), inner).reshape((nsamp,))
+    if baseband:
+        return wave.real.copy()
+    return wave
+
+
+def tone_spectrum(wave, bins):
+    """
+    Return np.fft.fft(wave)[bins] without computing the rest of the spectrum when there are few bins.
+
+    wave : array of float or complex with a length that is a power of 2
+    bins : array of ints
+
+    returns: array of complex with the shape of bins
+    """
+    bins = np.asarray(bins, dtype='int64')
+    nsamp = wave.shape[0]
+    if bins.size > SPARSE_SYNTHESIS_MAX_TONES:
+        return np.fft.fft(wave)[bins]
+    outer, inner = _tone_phasors(bins.ravel() % nsamp, nsamp)
+    rows, cols = outer.shape[1], inner.shape[1]
+    partial = np.dot(outer.conj(), wave.reshape((rows, cols)))
+    return np.sum(partial * inner.conj(), axis=1).reshape(bins.shape)
+
+
+def _tone_phasors(bins, nsamp):
+    # With n = cols * p + j, exp(2 pi i b n / nsamp) is outer[b, p] * inner[b, j]. Reducing the phases modulo nsamp
+    # as integers keeps them exact for any sample index.
+    rows = 2 ** (int(np.log2(nsamp)) // 2)
+    cols = nsamp // rows
+    outer = np.exp((2j * np.pi / nsamp) * ((bins[:, None] * cols * np.arange(rows)) % nsamp))
+    inner = np.exp((2j * np.pi / nsamp) * ((bins[:, None] * np.arange(cols)) % nsamp))
+    return outer, inner
+
+
+def optimize_phases(bins, nsamp, amps=1.0, baseband=False, num_iterations=100, clip_level=1.5,
+                    cache_dir=CACHE_DIR):
+    """
+    Choose tone phases that minimize the peak of the waveform, and return the exact waveform normalization.
+
+    Starting from the better of Newman phases and random phases, the iterative clipping algorithm clips the waveform
+    at clip_level times its RMS and keeps the phases of the clipped waveform at the tone bins, which moves power out
+    of the peaks. This helps most for regularly spaced tones; for tones scattered over the whole spectrum the peak is
+    set mostly by chance alignments, and the main gain is the exact normalization instead of calc_wavenorm. The phases
+    are optimized for the first bank; every bank uses the same phases, and for heterodyne waveforms a bank whose bins
+    are all shifted by the same amount has exactly the same envelope. The result depends only on the arguments, so it
+    is saved in cache_dir and loaded on later calls.
+
+    bins : array of ints, shape (ntones,) or (nwaves, ntones)
+        the tone bins, as passed to set_tone_bins.
+    nsamp : int, must be a power of 2
+        the number of samples in the waveforms.
+    amps : float or array of floats with length ntones
+        the tone amplitudes.
+    baseband : bool
+        if True, optimize real waveforms with one-sided spectra.
+    num_iterations : int
+        the number of clipping iterations.
+    clip_level : float
+        the clipping level relative to the RMS of the waveform.
+    cache_dir : str or None
+        the directory in which results are saved; if None, nothing is saved or loaded.
+
+    returns: phases, wavenorm
+        the array of ntones phases and the maximum absolute value of the waveforms of all banks with these phases,
+        which is the value to pass as wavenorm for a waveform that just reaches full scale.
+    """
+    bins = np.atleast_2d(np.asarray(bins, dtype='int64'))
+    amps = np.broadcast_to(np.asarray(amps, dtype='float'), (bins.shape[1],))
+    key = hashlib.sha1(bins.tobytes() + amps.tobytes() +
+                       repr((nsamp, baseband, num_iterations, clip_level)).encode()).hexdigest()[:16]
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, 'tone_phases_{}.npz'.format(key))
+        if os.path.exists(filename):
+            try:
+                with np.load(filename) as npz:
+                    if np.array_equal(npz['bins'], bins) and np.array_equal(npz['amps'], amps):
+                        return npz['phases'], float(npz['wavenorm'])
+            except Exception as exception:
+                logger.warning("Could not load {}: {}".format(filename, exception))
+
+    def peak(phases):
+        return np.abs(tone_waveform(bins[0], amps * np.exp(1j * phases), nsamp, baseband=baseband)).max()
+
+    ntones = bins.shape[1]
+    newman = np.pi * np.arange(ntones) ** 2 / ntones
+    random_phases = np.random.RandomState(123).random_sample(ntones) * 2 * np.pi
+    phases = min(newman, random_phases, key=peak)
+    best_phases, best_peak = phases, peak(phases)
+    for iteration in range(num_iterations):
+        wave = tone_waveform(bins[0], amps * np.exp(1j * phases), nsamp, baseband=baseband)
+        magnitude = np.abs(wave)
+        wave_peak = magnitude.max()
+        if wave_peak < best_peak:
+            best_phases, best_peak = phases, wave_peak
+        level = clip_level * np.sqrt(np.mean(magnitude ** 2))
+        clipped = wave * np.minimum(1, level / np.maximum(magnitude, level))
+        spectrum = tone_spectrum(clipped, bins[0])
+        # Tones with zero amplitude keep their phase.
+        phases = np.where(amps > 0, np.angle(spectrum), phases)
+    wavenorm = max([np.abs(tone_waveform(bins[k], amps * np.exp(1j * best_phases), nsamp, baseband=baseband)).max()
+                    for k in range(bins.shape[0])])
+    if filename is not None:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            np.savez(filename, bins=bins, amps=amps, phases=best_phases, wavenorm=wavenorm)
+        except (IOError, OSError) as exception:
+            logger.warning("Could not save {}: {}".format(filename, exception))
+    return best_phases, wavenorm
+
+
+@timing.timed('tone_synthesis')
+def synthesize_waveforms(bins, values, nsamp, wavenorm=None, baseband=False, imag_shift=0):
+    """
+    Synthesize and quantize the waveforms of many banks, one bank at a time.
+
+    Only one bank's floating-point waveform exists at any time, so the memory used is that of the int16 output rather
+    than of dense (nwaves, nsamp) complex spectra and waveforms.
+
+    bins : 2d array of ints, shape (nwaves, ntones)
+        the tone bins of each bank.
+    values : complex or array of complex, broadcast against each row of bins
+        the spectrum values at the bins.
+    nsamp : int, must be a power of 2
+        the number of samples in each waveform.
+    wavenorm : float or None
+        the waveform value that maps to full scale; if None, use the maximum magnitude of all the waveforms, which
+        requires synthesizing them twice.
+    baseband : bool
+        if True, synthesize real waveforms; otherwise complex.
+    imag_shift : int
+        the imaginary part of each complex waveform is rolled by this many samples, as np.roll would.
+
+    returns: wavenorm, real, imag
+        the normalization used and the quantized real and imaginary parts as big-endian int16 arrays of shape
+        (nwaves, nsamp); imag is None if baseband is True.
+    """
+    bins = np.atleast_2d(bins)
+    nwaves = bins.shape[0]
+    if wavenorm is None:
+        wavenorm = max([np.abs(tone_waveform(bins[k], values, nsamp, baseband=baseband)).max()
+                        for k in range(nwaves)])
+    real = np.empty((nwaves, nsamp), dtype='>i2')
+    if baseband:
+        imag = None
+    else:
+        imag = np.empty((nwaves, nsamp), dtype='>i2')
+    for k in range(nwaves):
+        wave = tone_waveform(bins[k], values, nsamp, baseband=baseband)
+        real[k] = _quantize(wave.real, wavenorm)
+        if not baseband:
+            imag[k] = np.roll(_quantize(wave.imag, wavenorm), imag_shift)
+    return wavenorm, real, imag
+
+
+def _quantize(wave, wavenorm):
+    # This is np.round((wave / wavenorm) * DAC_FULL_SCALE), computed in place in one temporary array.
+    scaled = np.divide(wave, wavenorm)
+    scaled *= DAC_FULL_SCALE
+    return np.rint(scaled, out=scaled)
+
+
 def find_best_iq_delay_adc(ri, iq_delay_range=np.arange(-4, 5), make_plot=False):
     tone_baseband_frequencies = ri.tone_baseband_frequencies
     total_rejections = []
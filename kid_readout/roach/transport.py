@@ -0,0 +1,183 @@
+"""
+Transports for register and memory access on a ROACH.
+
+A transport batches register reads and writes so that a group of them costs one round trip, and writes memory images
+over a connection that stays open. KatcpTransport works with any FpgaClient, including MockRoach, and sends one katcp
+request per register. BorphTransport works on the ROACH1, whose PPC exposes every register and memory as a file under
+/proc/<bof_pid>/hw/ioreg: it keeps one shell open on the PPC for register access, and streams memory images through an
+ssh connection that is multiplexed over a single persistent master connection per board, so no data is staged on the
+NFS root and no new ssh connection is made per command. LoopbackTransport runs the same shell commands locally on a
+directory of files that stands in for the ioreg directory, for tests.
+"""
+import os
+import struct
+import getpass
+import logging
+import tempfile
+import subprocess
+
+import numpy as np
+
+from kid_readout.roach.borph_utils import RemoteShell
+
+logger = logging.getLogger(__name__)
+
+
+class KatcpTransport(object):
+    """
+    Register and memory access through an FpgaClient, with one katcp request per register.
+    """
+
+    def __init__(self, fpga):
+        self.fpga = fpga
+
+    def read_registers(self, names):
+        """
+        Return the values of the named 32-bit registers as an array of unsigned integers, in the given order.
+        """
+        return np.array([self.fpga.read_uint(name) for name in names], dtype='uint32')
+
+    def write_registers(self, values):
+        """
+        Write a sequence of (name, value) pairs to 32-bit registers, in order; a register may appear more than once.
+        """
+        for name, value in values:
+            self.fpga.write_int(name, value)
+
+    def read(self, name, size, offset_bytes=0):
+        """
+        Return size bytes of the named memory, starting offset_bytes from its beginning.
+        """
+        return self.fpga.read(name, size, offset=offset_bytes)
+
+    def write_memory(self, name, data, offset_bytes=0):
+        """
+        Write the array data to the named memory, starting offset_bytes from its beginning; the DRAM is 'dram_memory'.
+        """
+        if name == 'dram_memory':
+            self.fpga.write_dram(data.tostring(), offset=offset_bytes)
+        else:
+            self.fpga.blindwrite(name, data.tostring(), offset=offset_bytes)
+
+    def close(self):
+        pass
+
+
+class BorphTransport(object):
+    """
+    Register and memory access through the BORPH ioreg files of a ROACH1, over persistent ssh connections.
+    """
+
+    def __init__(self, host, ioreg_directory, control_directory=None):
+        """
+        host : str
+            the host name of the ROACH.
+        ioreg_directory : str
+            the directory on the ROACH that contains the register files, /proc/<bof_pid>/hw/ioreg.
+        control_directory : str or None
+            the local directory for the ssh master connection socket, which is named for the user and the host; the
+            default is the temporary directory.
+        """
+        self.host = host
+        self.ioreg_directory = ioreg_directory
+        if control_directory is None:
+            control_directory = tempfile.gettempdir()
+        # The socket name includes the user name so that users who share a machine do not share connections.
+        self.control_path = os.path.join(control_directory, 'kid_readout_ssh_%s_%s' % (getpass.getuser(), host))
+        self._shell = None
+
+    def _argv(self, command):
+        # Every ssh process shares the master connection, which stays open for ten minutes after the last use.
+        return ['ssh', '-T', '-o', 'ControlMaster=auto', '-o', 'ControlPath=%s' % self.control_path,
+                '-o', 'ControlPersist=600', 'root@%s' % self.host, command]
+
+    def _path(self, name):
+        return os.path.join(self.ioreg_directory, name)
+
+    def _run(self, command):
+        if self._shell is None:
+            self._shell = RemoteShell(self.host, command=self._argv('sh'))
+        return self._shell.run(command)
+
+    def read_registers(self, names):
+        """
+        Return the values of the named 32-bit registers as an array of unsigned integers, in the given order.
+        """
+        if not names:
+            return np.zeros(0, dtype='uint32')
+        output = self._run('cat %s | od -A n -t x1 -v' % ' '.join([self._path(name) for name in names]))
+        raw = bytearray([int(token, 16) for token in output.split()])
+        return np.frombuffer(bytes(raw), dtype='>u4').astype('uint32')
+
+    def write_registers(self, values):
+        """
+        Write a sequence of (name, value) pairs to 32-bit registers, in order; a register may appear more than once.
+        """
+        commands = []
+        for name, value in values:
+            escaped = ''.join(['\\%03o' % ord(byte) for byte in struct.pack('>I', value & 0xffffffff)])
+            commands.append("printf '%s' > %s" % (escaped, self._path(name)))
+        if commands:
+            self._run(' && '.join(commands))
+
+    def read(self, name, size, offset_bytes=0):
+        """
+        Return size bytes of the named memory, starting offset_bytes from its beginning.
+        """
+        output = self._run('dd if=%s bs=1 skip=%d count=%d 2>/dev/null | od -A n -t x1 -v'
+                           % (self._path(name), offset_bytes, size))
+        return bytes(bytearray([int(token, 16) for token in output.split()]))
+
+    def write_memory(self, name, data, offset_bytes=0):
+        """
+        Write the array data to the named memory, starting offset_bytes from its beginning, which must be a multiple
+        of the 512-byte dd block size. The data is streamed over the multiplexed ssh connection.
+        """
+        if offset_bytes % 512:
+            raise ValueError("Memory offset %d is not a multiple of the 512-byte dd block size" % offset_bytes)
+        command = 'dd of=%s seek=%d 2>&1' % (self._path(name), offset_bytes // 512)
+        process = subprocess.Popen(self._argv(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output, _ = process.communicate(data.tostring())
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, output)
+        logger.debug(output)
+
+    def close(self):
+        if self._shell is not None:
+            self._shell.close()
+            self._shell = None
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['ssh', '-o', 'ControlPath=%s' % self.control_path, '-O', 'exit', 'root@%s' % self.host],
+                            stdout=devnull, stderr=devnull)
+
+
+class LoopbackTransport(BorphTransport):
+    """
+    A BorphTransport that runs its shell commands locally on a directory of files standing in for the ioreg directory.
+    """
+
+    def __init__(self, ioreg_directory):
+        super(LoopbackTransport, self).__init__(host='localhost', ioreg_directory=ioreg_directory)
+
+    def _argv(self, command):
+        return ['sh', '-c', command]
+
+    def close(self):
+        if self._shell is not None:
+            self._shell.close()
+            self._shell = None
+
+
+_borph_transports = {}
+
+
+def get_borph_transport(host, bof_pid):
+    """
+    Return the BorphTransport for the given board and process, which is shared by every caller so that each board
+    has one set of connections.
+    """
+    key = (host, bof_pid)
+    if key not in _borph_transports:
+        _borph_transports[key] = BorphTransport(host, '/proc/%d/hw/ioreg' % bof_pid)
+    return _borph_transports[key]
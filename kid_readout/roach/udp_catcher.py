@@ -7,10 +7,13 @@ import cPickle
 
 import numpy as np
 
+from kid_readout.utils import timing
+
 # TODO: verify that the log levels are correct here.
 logger = logging.getLogger(__name__)
 
 
+@timing.timed('capture')
 def get_udp_packets(ri, npkts, streamid, stream_reg='streamid', addr=('192.168.1.1', 12345)):
     ri.r.write_int(stream_reg, 0)
     with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
@@ -35,6 +38,7 @@ def get_udp_packets(ri, npkts, streamid, stream_reg='streamid', addr=('192.168.1
                 logger.warning("Did not receive UDP data.")
                 break
         ri.r.write_int(stream_reg, 0)
+    timing.count('packets', len(pkts))
     return pkts
 
 
@@ -56,6 +60,7 @@ pkt_size = hdr_size + 1024
 null_pkt = "\x00" * 1024
 
 
+@timing.timed('decode')
 def decode_packets(plist, streamid, chans, nfft, pkts_per_chunk=16, capture_failures=False):
     nchan = chans.shape[0]
     mcnt_inc = nfft * 2 ** 12 / nchan
@@ -36,6 +36,9 @@ LOG_DIR = '/tmp'
 # The path of the directory containing temperature log files.
 TEMPERATURE_LOG_DIR = None
 
+# The path of the directory in which cached calculations, such as lookup tables, are saved; it is created if necessary.
+CACHE_DIR = _os.path.join('/tmp', 'kid_readout_cache')
+
 # ROACH1
 ROACH1_IP = None
 ROACH1_VALON = None
@@ -0,0 +1,65 @@
+import threading
+
+from kid_readout.utils import timing
+
+
+def test_spans():
+    @timing.timed('decorated')
+    def decorated(value):
+        return value
+
+    # Nothing is recorded, and the functions still work, when no recorder is active.
+    assert timing.span('nothing') is timing.span('anything')
+    assert decorated(1) == 1
+    with timing.recording() as outer:
+        with timing.span('outer'):
+            with timing.recording() as inner:
+                assert decorated(2) == 2
+                timing.count('packets', 16)
+        try:
+            with timing.span('failed'):
+                raise ValueError()
+        except ValueError:
+            pass
+    assert timing.active_recorders() == ()
+    inner_summary = inner.summary()
+    assert sorted(inner_summary.keys()) == ['decorated', 'packets']
+    assert inner_summary['packets'] == {'count': 16}
+    outer_summary = outer.summary()
+    assert sorted(outer_summary.keys()) == ['decorated', 'failed', 'outer', 'packets']
+    assert outer_summary['outer']['count'] == 1
+    assert outer_summary['outer']['seconds'] >= outer_summary['decorated']['seconds']
+    assert outer_summary['outer']['max_seconds'] == outer_summary['outer']['seconds']
+
+
+def test_resume_in_thread():
+    with timing.recording() as recorder:
+        recorders = timing.active_recorders()
+
+    def work():
+        with timing.resume(recorders):
+            with timing.span('worker'):
+                pass
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    assert recorder.summary()['worker']['count'] == 1
+
+
+def test_measurement_recording():
+    class Measurement(object):
+        def __init__(self):
+            self.state = {}
+
+    @timing.recorded
+    def measure():
+        with timing.span('measure'):
+            return Measurement()
+
+    assert 'timing' not in measure().state
+    timing.enable()
+    try:
+        assert measure().state['timing']['measure']['count'] == 1
+    finally:
+        timing.enable(False)
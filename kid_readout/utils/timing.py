@@ -0,0 +1,219 @@
+"""
+Lightweight timing of the hot paths of the readout.
+
+The code that synthesizes tones, loads waveforms, waits for sync, captures and decodes packets, demodulates, and
+reads and writes files marks its work with span() or the timed() decorator. A span is recorded only while a Recorder
+is active in the current thread, so when nothing is recording it costs one attribute lookup:
+
+with timing.recording() as recorder:
+    sweep_array = acquire.run_sweep(...)
+print recorder.summary()
+
+If enable() has been called, each measurement acquired by acquire and RoachInterface records its own spans and stores
+their summary in the 'timing' entry of its state, so files carry the performance profile of the measurements in them.
+The summary maps each span name to a dict with the number of spans, their total time in seconds and the longest one.
+
+The clock is timeit.default_timer, which on Python 2 has microsecond resolution on Linux.
+"""
+from __future__ import division
+import functools
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+_local = threading.local()
+
+# If True, measurements record their own spans and store the summary in their state; see enable().
+enabled = False
+
+
+class Recorder(object):
+    """
+    Accumulate the count, total time and longest time of spans by name. Recorders are thread-safe, because a capture
+    may be demodulated in a different thread from the one that read it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = {}
+        self._seconds = {}
+        self._max_seconds = {}
+
+    def add(self, name, seconds):
+        """
+        Record one span with the given name and duration in seconds.
+        """
+        with self._lock:
+            self._count[name] = self._count.get(name, 0) + 1
+            self._seconds[name] = self._seconds.get(name, 0) + seconds
+            self._max_seconds[name] = max(self._max_seconds.get(name, 0), seconds)
+
+    def count(self, name, number=1):
+        """
+        Add the given number to a counter that has no duration, such as a number of packets.
+        """
+        with self._lock:
+            self._count[name] = self._count.get(name, 0) + number
+
+    def summary(self):
+        """
+        Return a dict that maps each name to a dict with its count and, for spans, the total and longest durations in
+        seconds; the values are valid measurement state.
+        """
+        with self._lock:
+            summary = {}
+            for name, count in self._count.items():
+                summary[name] = {'count': count}
+                if name in self._seconds:
+                    summary[name]['seconds'] = self._seconds[name]
+                    summary[name]['max_seconds'] = self._max_seconds[name]
+            return summary
+
+
+class _Span(object):
+
+    __slots__ = ('name', 'recorders', 'start')
+
+    def __init__(self, name, recorders):
+        self.name = name
+        self.recorders = recorders
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = default_timer() - self.start
+        for recorder in self.recorders:
+            recorder.add(self.name, seconds)
+        return False
+
+
+class _NullSpan(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def enable(value=True):
+    """
+    Make measurements record their timing in their state if value is True, and stop if it is False.
+    """
+    global enabled
+    enabled = value
+
+
+def active_recorders():
+    """
+    Return a tuple of the Recorders that are active in the current thread, from the outermost to the innermost.
+    """
+    return getattr(_local, 'recorders', ())
+
+
+@contextmanager
+def recording(recorder=None):
+    """
+    Record the spans in the current thread into the given Recorder, or a new one, as well as into any that are already
+    active, while the context is active. The context value is the Recorder.
+    """
+    if recorder is None:
+        recorder = Recorder()
+    with resume((recorder,)):
+        yield recorder
+
+
+@contextmanager
+def resume(recorders):
+    """
+    Record the spans in the current thread into the given Recorders, as well as into any that are already active, while
+    the context is active. Pass the result of active_recorders() to continue recording in another thread.
+    """
+    previous = active_recorders()
+    _local.recorders = previous + tuple([recorder for recorder in recorders if recorder not in previous])
+    try:
+        yield
+    finally:
+        _local.recorders = previous
+
+
+@contextmanager
+def measurement_recording():
+    """
+    If timing is enabled, record the spans into a new Recorder, which is the context value; otherwise, the context value
+    is None and nothing new is recorded. Pass the value to attach() with the measurement.
+    """
+    if enabled:
+        with recording() as recorder:
+            yield recorder
+    else:
+        yield None
+
+
+def attach(measurement, recorder):
+    """
+    Store the summary of the given Recorder in the 'timing' entry of the state of the given measurement, unless the
+    recorder is None, and return the measurement.
+    """
+    if recorder is not None:
+        measurement.state['timing'] = recorder.summary()
+    return measurement
+
+
+def span(name):
+    """
+    Return a context manager that records the time spent in its block, under the given name, into the active Recorders.
+    """
+    recorders = getattr(_local, 'recorders', None)
+    if not recorders:
+        return _null_span
+    return _Span(name, recorders)
+
+
+def count(name, number=1):
+    """
+    Add the given number to the named counter of the active Recorders.
+    """
+    for recorder in getattr(_local, 'recorders', ()):
+        recorder.count(name, number)
+
+
+def timed(name):
+    """
+    Return a decorator that records every call of the function it decorates as a span with the given name.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            recorders = getattr(_local, 'recorders', None)
+            if not recorders:
+                return function(*args, **kwargs)
+            with _Span(name, recorders):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def recorded(function):
+    """
+    Decorate a function that returns a measurement so that, if timing is enabled, the spans recorded during each call
+    are stored in the state of the measurement; see attach().
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with measurement_recording() as recorder:
+            measurement = function(*args, **kwargs)
+        return attach(measurement, recorder)
+
+    return wrapper